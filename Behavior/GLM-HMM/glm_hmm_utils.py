@@ -2,7 +2,9 @@ import numpy as np
 from scipy.stats import bernoulli
 from GLM import glm
 from sklearn import preprocessing
-from os.path import join
+import os
+import runpy
+from os.path import join, isfile, getmtime
 import sys
 import ssm
 import autograd.numpy as np
@@ -367,7 +369,7 @@ def launch_glm_hmm_job(inpt, y, session, mask, session_fold_lookup_table, K, D,
                 prior_sigma,
                 global_fit,
                 params_for_initialization,
-                save_title=join(save_directory, 'glm_hmm_raw_parameters_itr_' + str(iter) + '.npz'))
+                save_title=glm_hmm_output_file(save_directory, iter))
 
 
 def create_violation_mask(violation_idx, T):
@@ -386,3 +388,52 @@ def create_violation_mask(violation_idx, T):
     ) == T, "violation and non-violation idx do not include all dta!"
     return nonviolation_idx, np.expand_dims(mask, axis=1)
 
+
+def glm_hmm_output_file(save_directory, iter):
+    return join(save_directory, 'glm_hmm_raw_parameters_itr_' + str(iter) + '.npz')
+
+
+def is_up_to_date(output_files, input_files):
+    """
+    Whether all output files exist and are newer than all (existing) input files
+    :param output_files: list of files a task writes
+    :param input_files: list of files a task reads
+    :return: bool
+    """
+    if not all(isfile(f) for f in output_files):
+        return False
+    oldest_output = min([getmtime(f) for f in output_files], default=np.inf)
+    return all(getmtime(f) <= oldest_output for f in input_files if isfile(f))
+
+
+def run_glm_hmm_task(animal_file, session_fold_lookup_file, K, fold, iter, global_fit,
+                     init_param_file, save_directory, D=1, C=2, N_em_iters=300,
+                     transition_alpha=1, prior_sigma=100):
+    """
+    Load the data and fit a single GLM-HMM (one K, fold and initialization), so that all fits
+    can be run as independent tasks on a process pool
+    :param animal_file: processed data of one animal or of all animals concatenated
+    :param session_fold_lookup_file: session fold lookup table belonging to animal_file
+    :param init_param_file: GLM weights (global fit) or best global parameters (individual fit)
+    :return: path to the saved parameters
+    """
+    session_fold_lookup_table = load_session_fold_lookup(session_fold_lookup_file)
+    inpt, y, session = load_data(animal_file)
+    #  append a column of ones to inpt to represent the bias covariate:
+    inpt = np.hstack((inpt, np.ones((len(inpt), 1))))
+    y = y.astype('int')
+    # Identify violations for exclusion:
+    violation_idx = np.where(y == -1)[0]
+    _, mask = create_violation_mask(violation_idx, inpt.shape[0])
+    os.makedirs(save_directory, exist_ok=True)
+    launch_glm_hmm_job(inpt, y, session, mask, session_fold_lookup_table, K, D, C, N_em_iters,
+                       transition_alpha, prior_sigma, fold, iter, global_fit, init_param_file,
+                       save_directory)
+    return glm_hmm_output_file(save_directory, iter)
+
+
+def run_pipeline_script(script):
+    """
+    Run one of the numbered pipeline scripts as if it was started from the command line
+    """
+    runpy.run_path(script, run_name='__main__')
@@ -3,24 +3,198 @@
 """
 Created on Fri May 27 15:32:47 2022
 By: Guido Meijer
+
+Runs the complete GLM-HMM pipeline (scripts 1 to 9) on a local process pool. The GLM-HMM fits
+of script 4 (global fit) and script 7 (individual fits) are expanded into one task per K, fold,
+initialization (and animal). A stage is started as soon as the stages it depends on are
+finished and tasks whose output exists and is newer than their input are skipped.
 """
 
+from os.path import join, dirname, realpath
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from serotonin_functions import paths
+from glm_hmm_utils import (load_animal_list, glm_hmm_output_file, is_up_to_date, run_glm_hmm_task,
+                           run_pipeline_script)
+
+# Settings
+N_CORES = None  # number of worker processes, None uses all cores
+RERUN_STAGES = []  # stages to run even if their output is up to date
+Ks = [2, 3, 4, 5]  # number of latent states (scripts 5, 6, 8 and 9 expect 2 to 5)
+NUM_FOLDS = 5
+N_INITIALIZATIONS = 20  # number of times to initialize each fit
+N_EM_ITERS = 300  # number of EM iterations
+D = 1  # data (observations) dimension
+C = 2  # number of output types/categories
+GLOBAL_PRIOR_SIGMA = 100
+GLOBAL_TRANSITION_ALPHA = 1  # perform mle
+INDIVIDUAL_PRIOR_SIGMA = 2
+INDIVIDUAL_TRANSITION_ALPHA = 2
+
+# Paths
+_, data_path = paths()
+script_dir = dirname(realpath(__file__))
+data_dir = join(data_path, 'GLM-HMM')
+animal_dir = join(data_dir, 'data_by_animal')
+results_dir = join(data_dir, 'results')
+individual_dir = join(results_dir, 'individual_fit')
+
+
+# Every stage returns a list of tasks: (function, arguments, output files, input files). When
+# the input files are None the outputs of the stages it depends on are used.
+def script_task(script, outputs):
+    return run_pipeline_script, (join(script_dir, script),), outputs, None
+
+
+def animals():
+    return load_animal_list(join(animal_dir, 'animal_list.npz'))
+
+
+def design_matrix_tasks():
+    return [script_task('1_create_design_mat.py', [join(data_dir, 'all_animals_concat.npz'),
+                                                   join(animal_dir, 'animal_list.npz')])]
+
+
+def glm_global_tasks():
+    return [script_task('2_fit_glm_all_animals_together.py', [
+        join(results_dir, 'GLM', 'fold_' + str(fold), 'variables_of_interest_iter_0.npz')
+        for fold in range(NUM_FOLDS)])]
+
+
+def glm_individual_tasks():
+    return [script_task('3_fit_glm_animals_separately.py', [
+        join(individual_dir, animal, 'GLM', 'fold_' + str(fold), 'variables_of_interest_iter_0.npz')
+        for animal in animals() for fold in range(NUM_FOLDS)])]
+
+
+def glm_hmm_global_tasks():
+    animal_file = join(data_dir, 'all_animals_concat.npz')
+    lookup_file = join(data_dir, 'all_animals_concat_session_fold_lookup.npz')
+    tasks = []
+    for K in Ks:
+        for fold in range(NUM_FOLDS):
+            init_param_file = join(results_dir, 'GLM', 'fold_' + str(fold),
+                                   'variables_of_interest_iter_0.npz')
+            for iter in range(N_INITIALIZATIONS):
+                save_directory = join(results_dir, 'GLM_HMM_K_' + str(K), 'fold_' + str(fold),
+                                      'iter_' + str(iter))
+                tasks.append((run_glm_hmm_task,
+                              (animal_file, lookup_file, K, fold, iter, True, init_param_file,
+                               save_directory, D, C, N_EM_ITERS, GLOBAL_TRANSITION_ALPHA,
+                               GLOBAL_PRIOR_SIGMA),
+                              [glm_hmm_output_file(save_directory, iter)],
+                              [animal_file, lookup_file, init_param_file]))
+    return tasks
+
+
+def post_processing_global_tasks():
+    return [script_task('5_apply_post_processing_global.py', [
+        join(results_dir, 'best_init_cvbt_dict.json'), join(results_dir, 'cvbt_folds_model.npz')])]
+
+
+def best_params_tasks():
+    return [script_task('6_get_best_params_for_individual_initialization.py', [
+        join(data_dir, 'best_params', 'best_params_K_' + str(K) + '.npz') for K in Ks])]
+
+
+def glm_hmm_individual_tasks():
+    tasks = []
+    for animal in animals():
+        animal_file = join(animal_dir, animal + '_processed.npz')
+        lookup_file = join(animal_dir, animal + '_session_fold_lookup.npz')
+        for K in Ks:
+            init_param_file = join(data_dir, 'best_params', 'best_params_K_' + str(K) + '.npz')
+            for fold in range(NUM_FOLDS):
+                for iter in range(N_INITIALIZATIONS):
+                    save_directory = join(individual_dir, animal, 'GLM_HMM_K_' + str(K),
+                                          'fold_' + str(fold), 'iter_' + str(iter))
+                    tasks.append((run_glm_hmm_task,
+                                  (animal_file, lookup_file, K, fold, iter, False, init_param_file,
+                                   save_directory, D, C, N_EM_ITERS, INDIVIDUAL_TRANSITION_ALPHA,
+                                   INDIVIDUAL_PRIOR_SIGMA),
+                                  [glm_hmm_output_file(save_directory, iter)],
+                                  [animal_file, lookup_file, init_param_file]))
+    return tasks
+
+
+def post_processing_individual_tasks():
+    return [script_task('8_apply_post_processing_individual.py', [
+        join(individual_dir, animal, 'best_init_cvbt_dict.json') for animal in animals()])]
+
+
+def predictive_accuracy_tasks():
+    return [script_task('9_calculate_predictive_accuracy.py', [
+        join(individual_dir, animal, 'predictive_accuracy_mat.npz') for animal in animals()])]
+
+
+# Stages with the stages they depend on
+STAGES = {
+    'design_matrix': (design_matrix_tasks, []),
+    'glm_global': (glm_global_tasks, ['design_matrix']),
+    'glm_individual': (glm_individual_tasks, ['design_matrix']),
+    'glm_hmm_global': (glm_hmm_global_tasks, ['glm_global']),
+    'post_processing_global': (post_processing_global_tasks, ['glm_hmm_global']),
+    'best_params': (best_params_tasks, ['post_processing_global']),
+    'glm_hmm_individual': (glm_hmm_individual_tasks, ['design_matrix', 'best_params']),
+    'post_processing_individual': (post_processing_individual_tasks,
+                                   ['glm_individual', 'glm_hmm_individual']),
+    'predictive_accuracy': (predictive_accuracy_tasks, ['post_processing_individual'])}
+
+
+def run_pipeline(stages, n_workers=None, rerun_stages=[]):
+    """
+    Run all tasks of all stages on a process pool, a stage is expanded into its tasks once all
+    the stages it depends on are finished. Returns the finished and the failed stages.
+    """
+    stage_outputs, n_unfinished, futures = dict(), dict(), dict()
+    finished, failed = set(), set()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while len(finished | failed) < len(stages):
+
+            # Start all stages of which the dependencies are finished
+            started_stage = False
+            for stage, (make_tasks, depends_on) in stages.items():
+                if (stage in stage_outputs) or (stage in failed):
+                    continue
+                if len(failed & set(depends_on)) > 0:
+                    print(f'Skipping {stage}, it depends on a failed stage')
+                    failed.add(stage)
+                    continue
+                if not set(depends_on) <= finished:
+                    continue
+                all_tasks = make_tasks()
+                stage_outputs[stage] = [f for task in all_tasks for f in task[2]]
+                dependency_outputs = [f for dep in depends_on for f in stage_outputs[dep]]
+                tasks = [task for task in all_tasks if (stage in rerun_stages) or not is_up_to_date(
+                    task[2], dependency_outputs if task[3] is None else task[3])]
+                print(f'Starting {stage}: running {len(tasks)} of {len(all_tasks)} tasks')
+                n_unfinished[stage] = len(tasks)
+                for func, args, _, _ in tasks:
+                    futures[executor.submit(func, *args)] = stage
+                if len(tasks) == 0:
+                    finished.add(stage)
+                started_stage = True
+            if len(futures) == 0:
+                if started_stage:
+                    continue
+                break
+
+            # Wait for the next task to finish
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = futures.pop(future)
+                n_unfinished[stage] -= 1
+                try:
+                    future.result()
+                except Exception as err:
+                    print(f'Task of {stage} failed: {err}')
+                    failed.add(stage)
+                if (n_unfinished[stage] == 0) & (stage not in failed):
+                    print(f'Finished {stage}')
+                    finished.add(stage)
+    return finished, failed
+
 
-print('Creating design matrix..')
-runfile('1_create_design_mat.py')
-print('Fitting GLM for all animals together..')
-runfile('2_fit_glm_all_animals_together.py')
-print('Fitting GLM for animals seperately')
-runfile('3_fit_glm_animals_separately.py')
-print('Running inference global model..')
-runfile('4_run_inference_global_fit.py')
-print('Applying post processing..')
-runfile('5_apply_post_processing_global.py')
-print('Getting best parameters for indiviual initialization')
-runfile('6_get_best_params_for_individual_initialization.py')
-print('Running inference individual fits')
-runfile('7_run_inference_individual_fit.py')
-print('Applying post processing')
-runfile('8_apply_post_processing_individual.py')
-print('Calculating predictive accuracy')
-runfile('9_calculate_predictive_accuracy.py')
\ No newline at end of file
+if __name__ == '__main__':
+    finished, failed = run_pipeline(STAGES, n_workers=N_CORES, rerun_stages=RERUN_STAGES)
+    if len(failed) > 0:
+        print(f'Failed stages: {", ".join(sorted(failed))}')
@@ -8,21 +8,16 @@ By: Guido Meijer
 import numpy as np
 from os.path import join, isfile
 import pandas as pd
-from scipy.stats import pearsonr
 from scipy.signal import gaussian
-from sklearn.cross_decomposition import CCA
-from sklearn.decomposition import PCA
-from sklearn.model_selection import LeaveOneOut, KFold
 from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, calculate_peths, get_neuron_qc)
+                                 get_artifact_neurons, calculate_peths, get_neuron_qc, jpecc,
+                                 pca_time_bins)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
 one = ONE()
-cca = CCA(n_components=1, max_iter=1000)
-pca = PCA(n_components=10)
 
 # Settings
 OVERWRITE = False  # whether to overwrite existing runs
@@ -39,6 +34,7 @@ K_FOLD_SHUFFLE = True  # whether to use a random subset of trials for fitting an
 K_FOLD_BOOTSTRAPS = 100  # how often to repeat the random trial selection
 MIN_FR = 0.5  # minimum firing rate over the whole recording
 N_PC = 10  # number of PCs to use
+N_THREADS = 4  # number of threads for the CCA over time bins
 
 # Paths
 fig_path, save_path = paths()
@@ -47,8 +43,6 @@ fig_path, save_path = paths()
 REGION_PAIRS = [['M2', 'mPFC'], ['M2', 'OFC']]
 np.random.seed(42)  # fix random seed for reproducibility
 n_time_bins = int((PRE_TIME + POST_TIME) / WIN_SIZE)
-lio = LeaveOneOut()
-kfold = KFold(n_splits=K_FOLD, shuffle=K_FOLD_SHUFFLE)
 if SMOOTHING > 0:
     w = n_time_bins - 1 if n_time_bins % 2 == 0 else n_time_bins
     window = gaussian(w, std=SMOOTHING / WIN_SIZE)
@@ -138,9 +132,7 @@ for i, eid in enumerate(np.unique(rec['eid'])):
                         binned_spks_opto[tt, :, :] = binned_spks_opto[tt, :, :] - psth_opto['means']
 
                 # Perform PCA
-                pca_opto[region] = np.empty([binned_spks_opto.shape[0], N_PC, binned_spks_opto.shape[2]])
-                for tb in range(binned_spks_opto.shape[2]):
-                    pca_opto[region][:, :, tb] = pca.fit_transform(binned_spks_opto[:, :, tb])
+                pca_opto[region], _ = pca_time_bins(binned_spks_opto, n_components=N_PC)
 
     # Perform CCA per region pair
     print('Starting CCA per region pair')
@@ -158,38 +150,18 @@ for i, eid in enumerate(np.unique(rec['eid'])):
             print(f'Calculating {region_1}-{region_2}')
 
             # Run CCA per combination of two timebins
-            r_opto = np.empty((n_time_bins, n_time_bins))
-            r_opto_bootstraps = np.empty((n_time_bins, n_time_bins, K_FOLD_BOOTSTRAPS * 2))
-            for tb_1 in range(n_time_bins):
-                for tb_2 in range(n_time_bins):
-                    opto_x = np.empty(pca_opto[region_1][:, :, 0].shape[0])
-                    opto_y = np.empty(pca_opto[region_1][:, :, 0].shape[0])
-                    if CROSS_VAL is None:
-                        opto_x, opto_y = cca.fit_transform(pca_opto[region_1][:, :, tb_1],
-                                                           pca_opto[region_2][:, :, tb_2])
-                        _, r_opto[tb_1, tb_2] = pearsonr(opto_x.T[0], opto_y.T[0])
-                    elif CROSS_VAL == 'k-fold':
-                        r_splits = []
-                        for kk in range(K_FOLD_BOOTSTRAPS):
-                            for train_index, test_index in kfold.split(pca_opto[region_1][:, :, 0]):
-                                cca.fit(pca_opto[region_1][train_index, :, tb_1],
-                                        pca_opto[region_2][train_index, :, tb_2])
-                                x, y = cca.transform(pca_opto[region_1][test_index, :, tb_1],
-                                                     pca_opto[region_2][test_index, :, tb_2])
-                                r_splits.append(pearsonr(x.T[0], y.T[0])[0])
-                                r_opto_bootstraps[tb_1, tb_2, kk] = pearsonr(x.T[0], y.T[0])[0]
-                        r_opto[tb_1, tb_2] = np.median(r_splits)
-
-                    elif CROSS_VAL == 'leave-one-out':
-                        for train_index, test_index in lio.split(pca_opto[region_1][:, :, tb]):
-                            cca.fit(pca_opto[region_1][train_index, :, tb_1],
-                                    pca_opto[region_2][train_index, :, tb_2])
-                            x, y = cca.transform(pca_opto[region_1][test_index, :, tb_1],
-                                                 pca_opto[region_2][test_index, :, tb_2])
-                            opto_x[test_index] = x.T
-                            opto_y[test_index] = y.T
-                        r_opto[tb_1, tb_2], _ = pearsonr(opto_x, opto_y)
-
+            n_trials = pca_opto[region_1].shape[0]
+            if CROSS_VAL is None:
+                r_opto, _, _ = jpecc(pca_opto[region_1], pca_opto[region_2],
+                                     n_splits=1, n_bootstraps=1, n_threads=N_THREADS)
+            elif CROSS_VAL == 'k-fold':
+                r_opto, _, _ = jpecc(pca_opto[region_1], pca_opto[region_2],
+                                     n_splits=K_FOLD, n_bootstraps=K_FOLD_BOOTSTRAPS,
+                                     shuffle=K_FOLD_SHUFFLE, seed=42, n_threads=N_THREADS)
+            elif CROSS_VAL == 'leave-one-out':
+                r_opto, _, _ = jpecc(pca_opto[region_1], pca_opto[region_2],
+                                     n_splits=n_trials, n_bootstraps=1, shuffle=False,
+                                     pool_folds=True, n_threads=N_THREADS)
 
             # Add to dataframe
             cca_df = pd.concat((cca_df, pd.DataFrame(index=[cca_df.shape[0]], data={
@@ -8,20 +8,15 @@ By: Guido Meijer
 import numpy as np
 from os.path import join, isfile
 import pandas as pd
-from scipy.stats import pearsonr
 from scipy.signal import gaussian
-from sklearn.cross_decomposition import CCA
-from sklearn.decomposition import PCA
-from sklearn.model_selection import KFold
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, calculate_peths, get_neuron_qc)
+                                 get_artifact_neurons, calculate_peths, get_neuron_qc, jpecc,
+                                 pca_time_bins)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
 one = ONE()
-cca = CCA(n_components=1, max_iter=5000)
-pca = PCA(n_components=10)
 
 # Settings
 OVERWRITE = False  # whether to overwrite existing runs
@@ -38,6 +33,7 @@ SUBTRACT_MEAN = False  # whether to subtract the mean PSTH from each trial
 DIV_BASELINE = True  # whether to divide over baseline + 1 spk/s
 K_FOLD = 5  # k in k-fold
 K_FOLD_BOOTSTRAPS = 100  # how often to repeat the random trial selection
+N_THREADS = 4  # number of threads for the CCA over time bins
 MIN_FR = 0.5  # minimum firing rate over the whole recording
 
 # Paths
@@ -59,7 +55,6 @@ REGION_PAIRS = [['M2', 'mPFC'], ['M2', 'OFC']]
 
 np.random.seed(42)  # fix random seed for reproducibility
 n_time_bins = int((PRE_TIME + POST_TIME) / WIN_SIZE)
-kfold = KFold(n_splits=K_FOLD, shuffle=True)
 if SMOOTHING > 0:
     w = n_time_bins - 1 if n_time_bins % 2 == 0 else n_time_bins
     window = gaussian(w, std=SMOOTHING / WIN_SIZE)
@@ -161,9 +156,7 @@ for i, eid in enumerate(np.unique(rec['eid'])):
                 spks_opto[region] = binned_spks_opto
 
                 # Perform PCA
-                pca_opto[region] = np.empty([binned_spks_opto.shape[0], N_PC, binned_spks_opto.shape[2]])
-                for tb in range(binned_spks_opto.shape[2]):
-                    pca_opto[region][:, :, tb] = pca.fit_transform(binned_spks_opto[:, :, tb])
+                pca_opto[region], _ = pca_time_bins(binned_spks_opto, n_components=N_PC)
 
 
     # Perform CCA per region pair
@@ -181,48 +174,19 @@ for i, eid in enumerate(np.unique(rec['eid'])):
         if (region_1 in pca_opto.keys()) & (region_2 in pca_opto.keys()):
             print(f'Calculating {region_1}-{region_2}')
 
-            # Run CCA per combination of two timebins
-            r_mean = np.empty((n_time_bins - int(MAX_DELAY/WIN_SIZE)*2, (int(MAX_DELAY/WIN_SIZE) * 2)+1))
-            r_std = np.empty((n_time_bins - int(MAX_DELAY/WIN_SIZE)*2, (int(MAX_DELAY/WIN_SIZE) * 2)+1))
+            # Run CCA per combination of two timebins, pooling the held-out trials of all folds
+            _, _, r_boot = jpecc(pca_opto[region_1], pca_opto[region_2], n_splits=K_FOLD,
+                                 n_bootstraps=K_FOLD_BOOTSTRAPS, pool_folds=True, seed=42,
+                                 n_threads=N_THREADS)
+
+            # Only keep time bin pairs within the maximum delay
+            n_delay = int(MAX_DELAY/WIN_SIZE)
+            tb_1 = np.arange(n_delay, r_boot.shape[1] - n_delay)
+            tb_2 = tb_1[:, None] + np.arange(-n_delay, n_delay + 1)[None, :]
+            r_mean = np.mean(r_boot[:, tb_1[:, None], tb_2], axis=0)
+            r_std = np.std(r_boot[:, tb_1[:, None], tb_2], axis=0)
             delta_time = np.arange(-MAX_DELAY, MAX_DELAY + WIN_SIZE, WIN_SIZE)
 
-            for it_1, time_1 in enumerate(psth_opto['tscale'][int(MAX_DELAY/WIN_SIZE) : -int(MAX_DELAY/WIN_SIZE)]):
-                if np.mod(it_1, 20) == 0:
-                    print(f'Timebin {it_1} of {n_time_bins}..')
-                for it_2, time_2 in enumerate(psth_opto['tscale'][(psth_opto['tscale'] >= time_1 - MAX_DELAY - (WIN_SIZE/2))
-                                                                  & (psth_opto['tscale'] <= time_1 + MAX_DELAY + (WIN_SIZE/2))]):
-
-                    # Get timebin index
-                    tb_1 = np.where(psth_opto['tscale'] == time_1)[0][0]
-                    tb_2 = np.where(psth_opto['tscale'] == time_2)[0][0]
-
-                    # Get activity matrix
-                    if PCA:
-                        act_mat = pca_opto
-                    else:
-                        act_mat = spks_opto
-
-                    # Run CCA
-                    opto_x = np.empty(pca_opto[region_1][:, :, 0].shape[0])
-                    opto_y = np.empty(pca_opto[region_1][:, :, 0].shape[0])
-
-                    r_boot = []
-                    for kk in range(K_FOLD_BOOTSTRAPS):
-                        r_splits = []
-                        x_test, y_test = np.empty(opto_train_times.shape[0]), np.empty(opto_train_times.shape[0])
-                        for train_index, test_index in kfold.split(pca_opto[region_1][:, :, 0]):
-                            cca.fit(pca_opto[region_1][train_index, :, tb_1],
-                                    pca_opto[region_2][train_index, :, tb_2])
-                            x, y = cca.transform(pca_opto[region_1][test_index, :, tb_1],
-                                                 pca_opto[region_2][test_index, :, tb_2])
-                            x_test[test_index] = x.T[0]
-                            y_test[test_index] = y.T[0]
-                            r_splits.append(pearsonr(x.T[0], y.T[0])[0])
-                        #r_boot.append(np.mean(r_splits))
-                        r_boot.append(pearsonr(x_test, y_test)[0])
-                    r_mean[it_1, it_2] = np.mean(r_boot)
-                    r_std[it_1, it_2] = np.std(r_boot)
-
             # Add to dataframe
             cca_df = pd.concat((cca_df, pd.DataFrame(index=[cca_df.shape[0]], data={
                 'subject': subject, 'date': date, 'eid': eid, 'region_1': region_1, 'region_2': region_2,
@@ -11,12 +11,12 @@ import pandas as pd
 from scipy.stats import pearsonr
 from scipy.signal import gaussian
 from sklearn.cross_decomposition import CCA
-from sklearn.decomposition import PCA
 from sklearn.model_selection import LeaveOneOut, KFold
 from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_trials,
-                                 get_artifact_neurons, calculate_peths, load_passive_opto_times)
+                                 get_artifact_neurons, calculate_peths, load_passive_opto_times,
+                                 pca_time_bins)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -40,7 +40,6 @@ FIT_TIME = 1.2  # timewindow relative to opto stim to use to fit CCA axes
 
 # Initialize
 cca = CCA(n_components=N_MODES, max_iter=1000)
-pca = PCA(n_components=10)
 
 # Paths
 fig_path, save_path = paths()
@@ -149,16 +148,7 @@ for i, eid in enumerate(np.unique(rec['eid'])):
                         binned_spks_opto[tt, :, :] = binned_spks_opto[tt, :, :] - psth_opto['means']
 
                 # Perform PCA
-                fit_tb = np.argmin(np.abs(FIT_TIME - psth_opto['tscale']))
-                pca_fit[region] = pca.fit(binned_spks_opto[:, :, fit_tb])
-                pca_opto[region][:, :] = pca_fit[region][fit_tb].transform(binned_spks_opto[:, :, fit_tb])
-
-
-                pca_opto[region] = np.empty([binned_spks_opto.shape[0], N_PC, binned_spks_opto.shape[2]])
-                pca_fit[region] = np.empty(binned_spks_opto.shape[2]).astype(object)
-                for tb in range(binned_spks_opto.shape[2]):
-                    pca_fit[region][tb] = pca.fit(binned_spks_opto[:, :, tb])
-                    pca_opto[region][:, :, tb] = pca_fit[region][tb].transform(binned_spks_opto[:, :, tb])
+                pca_opto[region], _ = pca_time_bins(binned_spks_opto, n_components=N_PC)
 
 
 
@@ -181,12 +171,8 @@ for i, eid in enumerate(np.unique(rec['eid'])):
                         binned_spks_no_opto[tt, :, :] = binned_spks_no_opto[tt, :, :] - psth_no_opto['means']
 
                 # Perform PCA
-                pca_opto[region] = np.empty([binned_spks_opto.shape[0], N_PC, binned_spks_opto.shape[2]])
-                for tb in range(binned_spks_opto.shape[2]):
-                    pca_opto[region][:, :, tb] = pca.fit_transform(binned_spks_opto[:, :, tb])
-                pca_no_opto[region] = np.empty([binned_spks_no_opto.shape[0], N_PC, binned_spks_no_opto.shape[2]])
-                for tb in range(binned_spks_no_opto.shape[2]):
-                    pca_no_opto[region][:, :, tb] = pca.fit_transform(binned_spks_no_opto[:, :, tb])
+                pca_opto[region], _ = pca_time_bins(binned_spks_opto, n_components=N_PC)
+                pca_no_opto[region], _ = pca_time_bins(binned_spks_no_opto, n_components=N_PC)
 
     # Perform CCA per region pair
     print('Starting CCA per region pair')
@@ -11,17 +11,15 @@ import pandas as pd
 from scipy.stats import pearsonr
 from scipy.signal import gaussian
 from sklearn.cross_decomposition import CCA
-from sklearn.decomposition import PCA
 from sklearn.model_selection import LeaveOneOut, KFold
 from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, calculate_peths)
+                                 get_artifact_neurons, calculate_peths, pca_time_bins)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
 one = ONE()
-pca = PCA(n_components=10)
 
 # Settings
 OVERWRITE = False  # whether to overwrite existing runs
@@ -143,9 +141,7 @@ for i, eid in enumerate(np.unique(rec['eid'])):
                 spks_opto[region] = binned_spks_opto
 
                 # Perform PCA
-                pca_opto[region] = np.empty([binned_spks_opto.shape[0], N_PC, binned_spks_opto.shape[2]])
-                for tb in range(binned_spks_opto.shape[2]):
-                    pca_opto[region][:, :, tb] = pca.fit_transform(binned_spks_opto[:, :, tb])
+                pca_opto[region], _ = pca_time_bins(binned_spks_opto, n_components=N_PC)
 
 
     # Perform CCA per region pair
@@ -12,10 +12,9 @@ from sklearn.model_selection import KFold
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 import brainbox.io.one as bbone
 from brainbox.task.closed_loop import generate_pseudo_blocks
-from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.population.decode import classify, get_spike_counts_in_bins
 from serotonin_functions import (query_ephys_sessions, load_trials, paths, remap, load_subjects,
-                                 behavioral_criterion)
+                                 behavioral_criterion, neuron_qc_pass, get_spike_sorting_collection)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -72,6 +71,7 @@ for i, eid in enumerate(eids):
     # Load in neural data
     spikes, clusters, channels = bbone.load_spike_sorting_with_channel(
         eid, aligned=True, one=one, dataset_types=['spikes.amps', 'spikes.depths'], brain_atlas=ba)
+    pids, probe_names = one.eid2pid(eid)
 
     for p, probe in enumerate(spikes.keys()):
         if 'acronym' not in clusters[probe].keys():
@@ -83,11 +83,9 @@ for i, eid in enumerate(eids):
             if ('metrics' in clusters[probe].keys()) & (clusters[probe]['metrics'].shape[0] == clusters[probe]['channels'].shape[0]):
                 clusters_pass = np.where(clusters[probe]['metrics']['label'] == 1)[0]
             else:
-                print('Calculating neuron QC metrics..')
-                qc_metrics, _ = spike_sorting_metrics(spikes[probe].times, spikes[probe].clusters,
-                                                      spikes[probe].amps, spikes[probe].depths,
-                                                      cluster_ids=np.arange(clusters[probe].channels.size))
-                clusters_pass = np.where(qc_metrics['label'] == 1)[0]
+                clusters_pass = neuron_qc_pass(
+                    pids[list(probe_names).index(probe)], one=one,
+                    collection=get_spike_sorting_collection(eid, probe, one))
         else:
             clusters_pass = np.unique(spikes[probe].clusters)
         spikes[probe].times = spikes[probe].times[np.isin(spikes[probe].clusters, clusters_pass)]
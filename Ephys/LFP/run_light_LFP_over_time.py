@@ -14,7 +14,7 @@ from serotonin_functions import figure_style
 import brainbox.io.one as bbone
 from scipy.signal import periodogram
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 load_lfp)
+                                 load_lfp_epochs)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -32,9 +32,12 @@ BIN_SIZE = 0.25
 THETA = [5, 15]
 BETA = [15, 35]
 GAMMA = [50, 120]
+LFP_FS = 2500  # sampling rate of the LFP
+CACHE_EPOCHS = True  # keep the LFP epochs on disk for the next run
 fig_path, save_path = paths()
 fig_path = join(fig_path, 'Ephys', 'LFP')
 save_path = join(save_path, 'LFP')
+epoch_window = [BIN_CENTERS[0] - BIN_SIZE, BIN_CENTERS[-1] + BIN_SIZE]
 
 # Query sessions
 rec = query_ephys_sessions(one=one)
@@ -68,18 +71,6 @@ for i in rec.index.values:
             print(f'No brain regions found for {eid}')
             continue
 
-        # Load in lfp
-        if DESTRIPED_LFP and not isfile(join(save_path, f'{subject}_{date}_{probe}_cleaned_lfp.npy')):
-            print(f'Artifact removal not run for {subject}, {date}')
-            continue
-        elif DESTRIPED_LFP:
-            lfp = np.load(join(save_path, f'{subject}_{date}_{probe}_cleaned_lfp.npy'))
-            time = np.load(join(save_path, f'{subject}_{date}_{probe}_timestamps.npy'))
-        else:
-            lfp, time = load_lfp(eid, probe, time_start=opto_on_times[0]-10,
-                                 time_end=opto_on_times[-1]+10,
-                                 relative_to='begin', one=one)
-
         # Load in channels
         collections = one.list_collections(eid)
         if f'alf/{probe}/pykilosort' in collections:
@@ -87,6 +78,27 @@ for i in rec.index.values:
         else:
             collection = f'alf/{probe}'
         chan_ind = one.load_dataset(eid, dataset='channels.rawInd.npy', collection=collection)
+        lfp_chan = np.unique(chan_ind)
+
+        # Load in lfp epochs (pulse trains x channels x samples)
+        if DESTRIPED_LFP and not isfile(join(save_path, f'{subject}_{date}_{probe}_cleaned_lfp.npy')):
+            print(f'Artifact removal not run for {subject}, {date}')
+            continue
+        elif DESTRIPED_LFP:
+            lfp = np.load(join(save_path, f'{subject}_{date}_{probe}_cleaned_lfp.npy'), mmap_mode='r')
+            time = np.load(join(save_path, f'{subject}_{date}_{probe}_timestamps.npy'))
+            epoch_time = np.arange(*np.round(np.array(epoch_window) * LFP_FS)) / LFP_FS
+            first_samples = np.searchsorted(time, opto_train_times + epoch_window[0])
+
+            # Only read the samples of the epochs, samples after the end of the recording are NaN
+            epochs = np.full((first_samples.size, lfp_chan.size, epoch_time.size), np.nan,
+                             dtype=np.float32)
+            for j, first_sample in enumerate(first_samples):
+                last_sample = min(first_sample + epoch_time.size, lfp.shape[1])
+                epochs[j, :, :last_sample - first_sample] = lfp[lfp_chan, first_sample:last_sample]
+        else:
+            epochs, epoch_time = load_lfp_epochs(eid, probe, opto_train_times, epoch_window,
+                                                 channels=lfp_chan, cache=CACHE_EPOCHS, one=one)
 
         # Remap to Beryl atlas
         channels[probe]['acronym'] = remap(channels[probe]['atlas_id'])
@@ -96,31 +108,35 @@ for i in rec.index.values:
             lfp_df = pd.DataFrame()
             print(f'Processing {region}')
             region_chan = chan_ind[channels[probe]['acronym'] == region]
-            for t, pulse_onset in enumerate(opto_train_times):
-                theta, beta, gamma = np.zeros(BIN_CENTERS.shape), np.zeros(BIN_CENTERS.shape), np.zeros(BIN_CENTERS.shape)
-                for b, bin_center in enumerate(BIN_CENTERS):
-                    f, Pxx = periodogram(
-                        lfp[np.ix_(np.isin(np.arange(lfp.shape[0]), region_chan),
-                                   (time > pulse_onset + (bin_center - (BIN_SIZE / 2)))
-                                   & (time < pulse_onset + (bin_center + (BIN_SIZE / 2))))],
-                        fs=2500)
-                    Pxx = np.mean(Pxx, axis=0)
-                    theta[b] = Pxx[(f >= THETA[0]) & (f <= THETA[1])].mean()
-                    beta[b] = Pxx[(f >= BETA[0]) & (f <= BETA[1])].mean()
-                    gamma[b] = Pxx[(f >= GAMMA[0]) & (f <= GAMMA[1])].mean()
-
-                # Baseline subtraction
-                theta_p = ((theta - theta[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean())
-                           / theta[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean()) * 100
-                beta_p = ((beta - beta[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean())
-                          / beta[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean()) * 100
-                gamma_p = ((gamma - gamma[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean())
-                           / gamma[(BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])].mean()) * 100
-
-                # Add to dataframe
-                lfp_df = lfp_df.append(pd.DataFrame(data={
-                    'theta': theta, 'theta_perc': theta_p, 'beta': beta, 'beta_perc': beta_p,
-                    'gamma': gamma, 'gamma_perc': gamma_p, 'time': BIN_CENTERS}), ignore_index=True)
+            region_epochs = epochs[:, np.isin(lfp_chan, region_chan)]
+
+            # Power per pulse train and time bin
+            theta = np.zeros((opto_train_times.shape[0], BIN_CENTERS.shape[0]))
+            beta, gamma = np.zeros(theta.shape), np.zeros(theta.shape)
+            for b, bin_center in enumerate(BIN_CENTERS):
+                f, Pxx = periodogram(
+                    region_epochs[:, :, (epoch_time > bin_center - (BIN_SIZE / 2))
+                                  & (epoch_time < bin_center + (BIN_SIZE / 2))], fs=LFP_FS, axis=-1)
+                Pxx = np.mean(Pxx, axis=1)
+                theta[:, b] = Pxx[:, (f >= THETA[0]) & (f <= THETA[1])].mean(axis=1)
+                beta[:, b] = Pxx[:, (f >= BETA[0]) & (f <= BETA[1])].mean(axis=1)
+                gamma[:, b] = Pxx[:, (f >= GAMMA[0]) & (f <= GAMMA[1])].mean(axis=1)
+
+            # Baseline subtraction
+            baseline_bins = (BIN_CENTERS >= BASELINE[0]) & (BIN_CENTERS <= BASELINE[1])
+            theta_p = ((theta - theta[:, baseline_bins].mean(axis=1)[:, None])
+                       / theta[:, baseline_bins].mean(axis=1)[:, None]) * 100
+            beta_p = ((beta - beta[:, baseline_bins].mean(axis=1)[:, None])
+                      / beta[:, baseline_bins].mean(axis=1)[:, None]) * 100
+            gamma_p = ((gamma - gamma[:, baseline_bins].mean(axis=1)[:, None])
+                       / gamma[:, baseline_bins].mean(axis=1)[:, None]) * 100
+
+            # Add to dataframe
+            lfp_df = pd.DataFrame(data={
+                'theta': theta.flatten(), 'theta_perc': theta_p.flatten(), 'beta': beta.flatten(),
+                'beta_perc': beta_p.flatten(), 'gamma': gamma.flatten(),
+                'gamma_perc': gamma_p.flatten(),
+                'time': np.tile(BIN_CENTERS, opto_train_times.shape[0])})
 
             # Add to overall dataframe
             #asd
@@ -139,10 +155,10 @@ for i in rec.index.values:
 
             ch_plot = np.random.choice(region_chan)
             plot_pulse_times = (opto_on_times - opto_on_times[0]) * 1000
-            ax3.plot((time[((time > opto_on_times[0] - 0.01) & (time < opto_on_times[0] + 0.2))]\
-                      - opto_on_times[0]) * 1000, lfp[ch_plot, ((time > opto_on_times[0] - 0.01)
-                                                                   & (time < opto_on_times[0] + 0.2))],
-                     zorder=2)
+            first_pulse = opto_on_times[0] - opto_train_times[0]
+            plot_samples = (epoch_time > first_pulse - 0.01) & (epoch_time < first_pulse + 0.2)
+            ax3.plot((epoch_time[plot_samples] - first_pulse) * 1000,
+                     epochs[0, np.searchsorted(lfp_chan, ch_plot), plot_samples], zorder=2)
             y_lim = ax3.get_ylim()
             for pp in range(10):
                 ax3.plot([plot_pulse_times[pp], plot_pulse_times[pp]], y_lim, ls='--', color='r',
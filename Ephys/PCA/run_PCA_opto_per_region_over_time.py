@@ -16,7 +16,7 @@ from brainbox.io.one import SpikeSortingLoader
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, get_neuron_qc)
+                                 is_artifact, get_neuron_qc)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 one = ONE()
@@ -50,7 +50,6 @@ else:
     pca_df = pd.read_csv(join(save_path, 'pca_regions.csv'))
     pca_dist_df = pd.read_csv(join(save_path, 'pca_regions.csv'))
     rec_ind = [i for i in rec.index.values if rec.loc[i, 'pid'] not in pca_df['pid'].values]
-artifact_neurons = get_artifact_neurons()
 for i in rec_ind:
 
     # Get session details
@@ -80,8 +79,7 @@ for i in rec_ind:
     clusters_pass = np.where(qc_metrics['label'] == 1)[0]
 
     # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
+    clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
     if clusters_pass.shape[0] == 0:
             continue
 
@@ -18,7 +18,7 @@ from brainbox.io.one import SpikeSortingLoader
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons)
+                                 is_artifact)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 one = ONE()
@@ -44,7 +44,6 @@ BIN_CENTERS = np.arange(-T_BEFORE, T_AFTER, BIN_SIZE) + (BIN_SIZE / 2)
 rec = query_ephys_sessions(one=one)
 
 pca_df = pd.DataFrame()
-artifact_neurons = get_artifact_neurons()
 for i in rec.index.values:
 
     # Get session details
@@ -88,8 +87,7 @@ for i in rec.index.values:
     spikes.times = spikes.times[spikes.times > start_passive]
 
     # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
+    clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
     if clusters_pass.shape[0] == 0:
             continue
 
@@ -13,7 +13,7 @@ from scipy.stats import pearsonr
 import seaborn as sns
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, get_neuron_qc, figure_style,
+                                 is_artifact, get_neuron_qc, figure_style,
                                  calculate_peths)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
@@ -33,7 +33,6 @@ fig_path = join(fig_path, 'Ephys', 'PCA')
 # Query sessions
 rec = query_ephys_sessions(one=one, acronym=['MOs'])
 
-artifact_neurons = get_artifact_neurons()
 corr_df = pd.DataFrame()
 for i in rec.index.values:
 
@@ -67,8 +66,7 @@ for i in rec.index.values:
     clusters_pass = np.where(qc_metrics['label'] == 1)[0]
 
     # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
+    clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
     if clusters_pass.shape[0] == 0:
             continue
 
@@ -7,11 +7,11 @@ By: Guido Meijer
 import numpy as np
 from os.path import join
 import pandas as pd
-from scipy.stats import pearsonr
 from brainbox.io.one import SpikeSortingLoader
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
                                  get_artifact_neurons, get_neuron_qc,
-                                 calculate_peths, combine_regions, load_subjects)
+                                 calculate_peths, combine_regions, load_subjects,
+                                 pairwise_correlation_time_bins)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 one = ONE()
@@ -23,6 +23,7 @@ T_AFTER = 3
 BIN_SIZE = 0.2
 SMOOTHING = 0
 SUBTRACT_MEAN = False
+CHUNK_SIZE = 500  # number of neurons of region 1 to correlate at once
 OVERWRITE = True
 
 # Query sessions
@@ -103,18 +104,11 @@ for i, eid in enumerate(np.unique(rec['eid'])):
     these_regions = list(region_spikes.keys())
     for r1, region_1 in enumerate(these_regions[:-1]):
         for r2, region_2 in enumerate(these_regions[r1+1:]):
-            corr_mean = np.empty(tscale.shape)
-            for tt in range(tscale.shape[0]):  # Loop over time bins
-                pairwise_corr = []
-                for n1 in range(region_spikes[region_1].shape[1]):  # Neurons in region 1
-                    for n2 in range(region_spikes[region_2].shape[1]):  # Neurons in region 2
-                        r, _ = pearsonr(region_spikes[region_1][:, n1, tt],
-                                        region_spikes[region_2][:, n2, tt])
-                        pairwise_corr.append(r)
-                corr_mean[tt] = np.nanmean(pairwise_corr)
-
-                # Baseline subtract
-                corr_time_bl = corr_mean - np.mean(corr_mean[tscale < 0])
+            corr_mean = pairwise_correlation_time_bins(region_spikes[region_1], region_spikes[region_2],
+                                                       chunk_size=CHUNK_SIZE)
+
+            # Baseline subtract
+            corr_time_bl = corr_mean - np.mean(corr_mean[tscale < 0])
 
             # Add to dataframe
             corr_df = pd.concat((corr_df, pd.DataFrame(data={
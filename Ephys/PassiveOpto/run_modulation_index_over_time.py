@@ -9,9 +9,7 @@ import numpy as np
 from os.path import join
 import pandas as pd
 from brainbox.io.one import SpikeSortingLoader
-from serotonin_functions import paths, load_passive_opto_times
-from brainbox.population.decode import get_spike_counts_in_bins
-from sklearn.metrics import roc_auc_score
+from serotonin_functions import paths, load_passive_opto_times, modulation_index_over_time
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -20,6 +18,7 @@ one = ONE()
 # Settings
 OVERWRITE = True
 BASELINE = [0.5, 0]
+AVG_BASELINE = False  # average over the windows in BASELINE instead of the last window before stim
 PRE_TIME = 1
 POST_TIME = 5
 BIN_SIZE = 0.1
@@ -71,52 +70,16 @@ for i, pid in enumerate(np.unique(light_neurons['pid'])):
     if spike_times.shape[0] == 0:
         continue
 
-    """
-    # Get spike counts for baseline windows
-    baseline_wins = win_centers[(win_centers >= -BASELINE[0]) & (win_centers < BASELINE[1])]
-    baseline_counts = np.empty((these_neurons.shape[0], opto_train_times.shape[0], baseline_wins.shape[0]))
-    for itb, win_c in enumerate(baseline_wins):
-        # Get spike counts for this
-        times = np.column_stack(((opto_train_times + (win_c - (BIN_SIZE/2)),
-                                  (opto_train_times + (win_c + (BIN_SIZE/2))))))
-        baseline_counts[:,:,itb], _ = get_spike_counts_in_bins(spike_times, spike_clusters, times)
-
-    # Get median spike count over all baseline windows
-    baseline_mean = np.mean(baseline_counts, axis=2)
-    """
-    
-    # Get spike count for last window before stim onset (baseline)
-    win_c = win_centers[np.where(win_centers < 0)[0][-1]]
-    times = np.column_stack(((opto_train_times + (win_c - (BIN_SIZE/2)),
-                              (opto_train_times + (win_c + (BIN_SIZE/2))))))
-    baseline_counts, _ = get_spike_counts_in_bins(spike_times, spike_clusters, times)
- 
-    # Loop over time bins
-    roc_auc = np.empty((baseline_counts.shape[0], win_centers.shape[0]))
-    for itb, win_c in enumerate(win_centers):
-
-        # Get spike counts for this
-        times = np.column_stack(((opto_train_times + (win_c - (BIN_SIZE/2)),
-                                  (opto_train_times + (win_c + (BIN_SIZE/2))))))
-        spike_counts, cluster_ids = get_spike_counts_in_bins(spike_times, spike_clusters, times)
-
-        # Loop over neurons
-        for iin in range(spike_counts.shape[0]):
-
-            # Calculate area under the ROC curve
-            roc_auc[iin, itb] = roc_auc_score(np.concatenate((np.zeros(baseline_counts.shape[1]),
-                                                              np.ones(spike_counts.shape[1]))),
-                                              np.concatenate((baseline_counts[iin, :], spike_counts[iin, :])))
-                
-    # Rescale area under to curve to [-1, 1] range
-    mod_idx = 2 * (roc_auc - 0.5)
+    # Get modulation index of all neurons in all time windows
+    mod_idx, _ = modulation_index_over_time(spike_times, spike_clusters, opto_train_times, win_centers,
+                                            BIN_SIZE, baseline=BASELINE if AVG_BASELINE else None,
+                                            cluster_ids=these_neurons['neuron_id'].values)
 
     # Add to dataframe
-    for iin, neuron_id in enumerate(these_neurons['neuron_id']):
-        mod_idx_df = pd.concat((mod_idx_df, pd.DataFrame(index=[mod_idx_df.shape[0]+1], data={
-            'pid': pid, 'subject': subject, 'date': date, 'neuron_id': neuron_id,
-            'mod_idx': [mod_idx[iin, :]], 'time': [win_centers],
-            'region': these_neurons.loc[these_neurons['neuron_id'] == neuron_id, 'region'].values[0]})))
+    mod_idx_df = pd.concat((mod_idx_df, pd.DataFrame(data={
+        'pid': pid, 'subject': subject, 'date': date, 'neuron_id': these_neurons['neuron_id'].values,
+        'mod_idx': list(mod_idx), 'time': [win_centers] * mod_idx.shape[0],
+        'region': these_neurons['region'].values})), ignore_index=True)
 
     # Save output
     mod_idx_df.to_pickle(join(save_path, 'mod_over_time.pickle'))
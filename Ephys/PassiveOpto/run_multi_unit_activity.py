@@ -12,7 +12,6 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib.ticker import FormatStrFormatter
 import seaborn as sns
-from brainbox.metrics.single_units import spike_sorting_metrics
 from serotonin_functions import figure_style
 import brainbox.io.one as bbone
 import scipy as sp
@@ -20,7 +19,8 @@ from brainbox.singlecell import calculate_peths
 from brainbox.population.decode import get_spike_counts_in_bins
 from brainbox.plot import peri_event_time_histogram
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
-from serotonin_functions import paths, remap, query_ephys_sessions, load_passive_opto_times, get_artifact_neurons
+from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
+                                 get_artifact_neurons, neuron_qc_pass, get_spike_sorting_collection)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas, BrainRegions
 lda = LinearDiscriminantAnalysis()
@@ -68,15 +68,14 @@ for i, eid in enumerate(eids):
     # Load in spikes
     spikes, clusters, channels = bbone.load_spike_sorting_with_channel(
         eid, aligned=True, dataset_types=['spikes.amps', 'spikes.depths'], one=one, brain_atlas=ba)
+    pids, probe_names = one.eid2pid(eid)
 
     for p, probe in enumerate(spikes.keys()):
 
         # Filter neurons that pass QC
-        print('Calculating neuron QC metrics..')
-        qc_metrics, _ = spike_sorting_metrics(spikes[probe].times, spikes[probe].clusters,
-                                              spikes[probe].amps, spikes[probe].depths,
-                                              cluster_ids=np.arange(clusters[probe].channels.size))
-        clusters_pass = np.where(qc_metrics['label'] == 1)[0]
+        clusters_pass = neuron_qc_pass(
+            pids[list(probe_names).index(probe)], one=one,
+            collection=get_spike_sorting_collection(eid, probe, one))
 
         # Select spikes of passive period
         start_passive = opto_train_times[0] - 360
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Sep 28 11:03:49 2022
+By: Guido Meijer
+
+Stores the facemap motion SVD of all sessions aligned to the camera clock (load_face_features)
+and fits an AR-HMM to the face motion of every session on a process pool. The states are saved
+in FaceStates and used by get_modulation_index_state_face.py and get_state_changes_face.py.
+"""
+
+import numpy as np
+from os.path import join, isfile
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from serotonin_functions import (load_passive_opto_times, paths, load_face_features,
+                                 fit_face_arhmm)
+from one.api import ONE
+
+# Settings
+K = 2    # number of discrete states
+D = 25   # dimension of the observations
+DOWNSAMPLE = 1  # number of camera frames averaged into one sample
+FM_DIR = '/media/guido/Data2/Facemap/'  # dir with facemap data
+N_CORES = None  # number of worker processes, None uses all cores
+OVERWRITE = False
+
+# Get path
+_, save_path = paths()
+state_dir = join(save_path, 'FaceStates')
+
+
+if __name__ == '__main__':
+    one = ONE()
+
+    # Get all processed facemap files
+    fm_files = glob(join(FM_DIR, '*_proc.npy'))
+
+    futures = dict()
+    with ProcessPoolExecutor(max_workers=N_CORES) as executor:
+        for i, path in enumerate(fm_files):
+
+            # Get session data
+            subject = path[-40:-31]
+            date = path[-30:-20]
+            try:
+                eid = one.search(subject=subject, date_range=date)[0]
+            except:
+                continue
+            if not OVERWRITE and isfile(join(state_dir, f'{eid}.npz')):
+                continue
+
+            print(f'Starting {subject}, {date}')
+
+            # Store the face features of this session
+            try:
+                features = load_face_features(eid, fm_file=path, n_components=D,
+                                              downsample=DOWNSAMPLE, one=one)
+            except Exception as err:
+                print(f'Could not load face features: {err}')
+                continue
+
+            # Load opto times
+            try:
+                opto_times, _ = load_passive_opto_times(eid, one=one)
+            except:
+                continue
+            if len(opto_times) == 0:
+                continue
+
+            # Select part of recording starting just before opto onset
+            fm_times = features['times'][features['times'] > opto_times[0] - 10]
+            if fm_times.shape[0] == 0:
+                continue
+            if np.sum(fm_times[-1] > opto_times) != opto_times.shape[0]:
+                print('Mismatch!')
+                continue
+
+            # Fit the AR-HMM of this session in a worker process
+            future = executor.submit(fit_face_arhmm, eid, opto_times[0] - 10, K, D,
+                                     join(state_dir, f'{eid}.npz'), downsample=DOWNSAMPLE,
+                                     subject=subject, date=date, eid=eid, opto_times=opto_times)
+            futures[future] = f'{subject} {date}'
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                print(f'AR-HMM fit of {futures[future]} failed: {err}')
@@ -3,31 +3,39 @@
 """
 Created on Wed Jan 18 11:20:14 2023
 By: Guido Meijer
+
+Fits a Poisson HMM per insertion and high-level region to the activity around task trial onsets
+and passive laser stimulation. Every (pid, region) fit runs as a separate task on a process pool
+and is saved in HMM/Fits/Task, the summaries and the (optional) figures are made from the saved
+fits.
 """
 
-import ssm
 import numpy as np
+from os import cpu_count
 from os.path import join
+from glob import glob
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.colors import ListedColormap
 from brainbox.io.one import SpikeSortingLoader
 from matplotlib.patches import Rectangle
 from matplotlib.ticker import FormatStrFormatter
 from brainbox.plot import peri_event_time_histogram
-from brainbox.singlecell import calculate_peths
 from sklearn.model_selection import KFold
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, get_neuron_qc, calculate_peths,
-                                 high_level_regions, figure_style, N_STATES, load_trials)
+                                 is_artifact, get_neuron_qc, calculate_peths,
+                                 high_level_regions, figure_style, N_STATES, load_trials,
+                                 fit_poisson_hmm, load_hmm_fits, finished_futures)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
-ba = AllenAtlas()
-one = ONE()
 
 # Settings
-OVERWRITE = True
+OVERWRITE = True  # refit insertions of which the fits are already saved
+PLOT = True  # plot the session of every fit
+N_CORES = None  # number of worker processes, None uses all cores
+MAX_PENDING = 2 * (N_CORES or cpu_count())  # fits queued on the pool at a time
 NEURON_QC = True
 PRE_TIME = 1
 POST_TIME = 4
@@ -42,182 +50,187 @@ PETH_SMOOTH = 0.05
 
 # Get paths
 fig_path, save_path = paths()
-
-# Query sessions
-rec = query_ephys_sessions(n_trials=400, one=one)
-
-# Get light artifact units
-artifact_neurons = get_artifact_neurons()
-
-# Initialize k-fold cross validation
-kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
-
-if OVERWRITE:
-    state_trans_df = pd.DataFrame()
-    p_state_df = pd.DataFrame()
-else:
-    state_trans_df = pd.read_csv(join(save_path, 'HMM', 'all_state_trans.csv'))
-    rec = rec[~rec['pid'].isin(state_trans_df['pid'])]
-
-for i in rec.index.values:
-
-    # Get session details
-    pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
-    subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
-
-    print(f'\nStarting {subject}, {date} ({i+1} of {rec.shape[0]})')
-
-    # Load in laser pulse times
-    opto_times, _ = load_passive_opto_times(eid, one=one)
-    if len(opto_times) == 0:
-        print('Could not load light pulses')
-        continue
-
-    # Load in trials
-    trials = load_trials(eid, laser_stimulation=True, one=one)
-
-    # Get times of trial onsets and passive laser stims
-    onset_times = np.concatenate((trials.loc[trials['laser_stimulation'] == 0, 'goCue_times'], opto_times))
-    onset_types = np.concatenate((np.zeros(np.sum(trials['laser_stimulation'] == 0)),
-                                  np.ones(opto_times.shape[0])))  # 0 = task, 1 = passive stim
-
-    # Load in spikes
-    sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = sl.load_spike_sorting()
-    clusters = sl.merge_clusters(spikes, clusters, channels)
-
-    # Filter neurons that pass QC
-    qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
-    clusters_pass = np.where(qc_metrics['label'] == 1)[0]
-
-    # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
-    if clusters_pass.shape[0] == 0:
-            continue
-
-    # Select QC pass neurons
-    spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
-    spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
-    clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
-
-    # Get regions from Beryl atlas
-    clusters['region'] = remap(clusters['acronym'], combine=True)
-    clusters['high_level_region'] = high_level_regions(clusters['acronym'])
-    clusters_regions = clusters['high_level_region'][clusters_pass]
-
-    # Loop over regions
-    for r, region in enumerate(np.unique(clusters['high_level_region'])):
-        if region == 'root':
-            continue
-
-        # Select spikes and clusters in this brain region
-        clusters_in_region = clusters_pass[clusters_regions == region]
-        if len(clusters_in_region) < MIN_NEURONS:
-            continue
-
-        # Initialize HMM
-        simple_hmm = ssm.HMM(N_STATES[region], clusters_in_region.shape[0], observations='poisson')
-
-        # Get binned spikes centered at stimulation onset
-        peth, binned_spikes = calculate_peths(spikes.times, spikes.clusters, clusters_in_region, onset_times,
-                                              pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE,
-                                              smoothing=0, return_fr=False)
-        binned_spikes = binned_spikes.astype(int)
-        time_ax = peth['tscale']
-
-        # Create list of (time_bins x neurons) per stimulation trial
-        trial_data = []
-        for i in range(binned_spikes.shape[0]):
-            trial_data.append(np.transpose(binned_spikes[i, :, :]))
-
-        # Loop over different number of states
-        this_df = pd.DataFrame()
-        state_trans = []
-        posterior = np.empty((len(trial_data), binned_spikes.shape[2], N_STATES[region]))
-        if CROSS_VAL:
-            # Cross validate
-            for k, (train_index, test_index) in enumerate(kf.split(trial_data)):
-
-                # Fit HMM on training data
-                lls = simple_hmm.fit(list(np.array(trial_data)[train_index]), method='em',
-                                     transitions='sticky')
-
-                for t in test_index:
-
-                    # Get posterior probability and most likely states for this trial
-                    posterior[t, :, :] = simple_hmm.filter(trial_data[t])
-                    zhat = simple_hmm.most_likely_states(trial_data[t])
-
-                    # Add to dataframe
-                    this_df = pd.concat((this_df, pd.DataFrame(data={
-                        'state': zhat, 'region': region, 'time': time_ax, 'trial': t})))
-
-        else:
-            # Fit HMM on all data
-            lls = simple_hmm.fit(trial_data, method='em', transitions='sticky')
-
-            for t in range(len(trial_data)):
-
-                # Get posterior probability and most likely states for this trial
-                posterior[t, :, :] = simple_hmm.filter(trial_data[t])
-                zhat = simple_hmm.most_likely_states(trial_data[t])
-
-                # Add to dataframe
-                this_df = pd.concat((this_df, pd.DataFrame(data={
-                    'state': zhat, 'region': region, 'time': time_ax, 'trial': t,
-                    'trialtype': onset_types[t]})))
-
-                # Get state transitions times
-                state_trans.append(onset_times[t] + time_ax[np.concatenate((np.diff(zhat) > 0, [False]))])
-        state_trans = np.concatenate(state_trans)
-
-        # Get P(state)
-        p_state = pd.DataFrame()
-        mean_state_inc = np.empty(N_STATES[region])
-        opto_state_df = this_df[this_df['trialtype'] == 1].copy()
-        for ii in range(N_STATES[region]):
-            opto_state_df[f'state_{ii}'] = (opto_state_df['state'] == ii).astype(int)
-
-            p_state[f'state_{ii}'] = opto_state_df[['time', f'state_{ii}']].groupby('time').mean()
-            p_state[f'state_{ii}_bl'] = (p_state[f'state_{ii}']
-                                         - p_state.loc[p_state.index < 0, f'state_{ii}'].mean())
-            mean_state_inc[ii] = p_state.loc[(p_state.index > 0) & (p_state.index < 1),
-                                             f'state_{ii}_bl'].mean()
+fit_dir = join(save_path, 'HMM', 'Fits', 'Task')
+
+
+def fit_hmms(rec, one, ba):
+    """
+    Submit the HMM fit of every insertion and region to a process pool
+    """
+
+    # Initialize k-fold cross validation
+    kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
+
+    def report_fits(max_pending):
+        for future, task in finished_futures(futures, max_pending):
+            try:
+                future.result()
+            except Exception as err:
+                print(f'HMM fit of {task} failed: {err}')
+
+    futures = dict()
+    with ProcessPoolExecutor(max_workers=N_CORES) as executor:
+        for i in rec.index.values:
+
+            # Get session details
+            pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
+            subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
+            if not OVERWRITE and len(glob(join(fit_dir, f'{pid}_*.npz'))) > 0:
+                continue
+
+            print(f'\nStarting {subject}, {date} ({i+1} of {rec.shape[0]})')
+
+            # Load in laser pulse times
+            opto_times, _ = load_passive_opto_times(eid, one=one)
+            if len(opto_times) == 0:
+                print('Could not load light pulses')
+                continue
+
+            # Load in trials
+            trials = load_trials(eid, laser_stimulation=True, one=one)
+
+            # Get times of trial onsets and passive laser stims
+            onset_times = np.concatenate((trials.loc[trials['laser_stimulation'] == 0, 'goCue_times'], opto_times))
+            onset_types = np.concatenate((np.zeros(np.sum(trials['laser_stimulation'] == 0)),
+                                          np.ones(opto_times.shape[0])))  # 0 = task, 1 = passive stim
+
+            # Load in spikes
+            sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = sl.load_spike_sorting()
+            clusters = sl.merge_clusters(spikes, clusters, channels)
+
+            # Filter neurons that pass QC
+            qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
+            clusters_pass = np.where(qc_metrics['label'] == 1)[0]
+
+            # Exclude artifact neurons
+            clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
+            if clusters_pass.shape[0] == 0:
+                continue
+
+            # Select QC pass neurons
+            spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
+            spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
+            clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
+
+            # Get regions from Beryl atlas
+            clusters['region'] = remap(clusters['acronym'], combine=True)
+            clusters['high_level_region'] = high_level_regions(clusters['acronym'])
+            clusters_regions = clusters['high_level_region'][clusters_pass]
+
+            # Loop over regions
+            for r, region in enumerate(np.unique(clusters['high_level_region'])):
+                if region == 'root':
+                    continue
+
+                # Select spikes and clusters in this brain region
+                clusters_in_region = clusters_pass[clusters_regions == region]
+                if len(clusters_in_region) < MIN_NEURONS:
+                    continue
+
+                # Get binned spikes centered at stimulation onset
+                peth, binned_spikes = calculate_peths(
+                    spikes.times, spikes.clusters, clusters_in_region, onset_times,
+                    pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE, smoothing=0,
+                    return_fr=False)
+
+                # Fit the HMM of this region in a worker process
+                future = executor.submit(
+                    fit_poisson_hmm, binned_spikes.astype(int), N_STATES[region],
+                    join(fit_dir, f'{pid}_{region}.npz'),
+                    folds=list(kf.split(binned_spikes)) if CROSS_VAL else None,
+                    subject=subject, date=date, pid=pid, region=region, time_ax=peth['tscale'],
+                    event_times=onset_times, event_types=onset_types,
+                    cluster_ids=clusters_in_region)
+                futures[future] = f'{subject} {date} {region}'
+
+                # Wait for running fits so that the queue holds the data of at most MAX_PENDING
+                # fits while the next insertions are loaded
+                report_fits(MAX_PENDING)
+
+        report_fits(0)
+
+
+def get_state_summary(fit):
+    """
+    Get the P(state) over time after passive stimulation and the times of the state transitions
+    of one saved fit
+    """
+    time_ax, states = fit['time_ax'], fit['states']
+    n_states = fit['posterior'].shape[2]
+
+    # Get P(state) of the passive stimulation trials
+    p_state = pd.DataFrame(index=pd.Index(time_ax, name='time'))
+    mean_state_inc = np.empty(n_states)
+    opto_states = states[fit['event_types'] == 1]
+    for ii in range(n_states):
+        p_state[f'state_{ii}'] = np.mean(opto_states == ii, axis=0)
+        p_state[f'state_{ii}_bl'] = (p_state[f'state_{ii}']
+                                     - p_state.loc[p_state.index < 0, f'state_{ii}'].mean())
+        mean_state_inc[ii] = p_state.loc[(p_state.index > 0) & (p_state.index < 1),
+                                         f'state_{ii}_bl'].mean()
+
+    # Get state transitions times
+    trans = np.concatenate((np.diff(states, axis=1) > 0,
+                            np.zeros((states.shape[0], 1), dtype=bool)), axis=1)
+    state_trans = (fit['event_times'][:, None] + time_ax[None, :])[trans]
+    return p_state, mean_state_inc, state_trans
+
+
+def summarize_fits(pids):
+    """
+    Get the state transition rates and the P(state) of the states with the biggest increase and
+    decrease after stimulation onset from the saved fits
+    """
+    state_trans_df, p_state_df = pd.DataFrame(), pd.DataFrame()
+    for fit in load_hmm_fits(fit_dir, pids=pids):
+        p_state, mean_state_inc, state_trans = get_state_summary(fit)
 
         # Add states with biggest increase and biggest decrease to dataframe
         this_p_state = p_state[[f'state_{np.argmax(mean_state_inc)}_bl', f'state_{np.argmin(mean_state_inc)}_bl']].rename(
                     columns={f'state_{np.argmax(mean_state_inc)}_bl': 'state_incr',
                              f'state_{np.argmin(mean_state_inc)}_bl': 'state_decr'})
-        this_p_state['subject'] = subject
-        this_p_state['pid'] = pid
-        this_p_state['region'] = region
+        this_p_state['subject'] = fit['subject']
+        this_p_state['pid'] = fit['pid']
+        this_p_state['region'] = fit['region']
         p_state_df = pd.concat((p_state_df, this_p_state))
 
         # Add state change PSTH to dataframe
-        peth, _ = calculate_peths(state_trans, np.ones(state_trans.shape[0]), [1], onset_times,
+        peth, _ = calculate_peths(state_trans, np.ones(state_trans.shape[0]), [1], fit['event_times'],
                                   pre_time=PRE_TIME, post_time=POST_TIME, bin_size=PETH_BIN,
                                   smoothing=PETH_SMOOTH)
         state_trans_df = pd.concat((state_trans_df, pd.DataFrame(data={
             'time': peth['tscale'], 'trans_rate': peth['means'][0],
             'trans_rate_bl': peth['means'][0] - np.mean(peth['means'][0][peth['tscale'] < 0]),
-            'region': region, 'subject': subject, 'pid': pid})))
+            'region': fit['region'], 'subject': fit['subject'], 'pid': fit['pid']})))
+
+    # Save output
+    #state_trans_df.to_csv(join(save_path, 'HMM', 'all_state_trans.csv'))
+    #p_state_df.to_csv(join(save_path, 'HMM', 'p_state.csv'))
+    return state_trans_df, p_state_df
 
-        # Plot example trial
-        cmap = sns.color_palette(CMAP, N_STATES[region])
-        colors, dpi = figure_style()
+
+def plot_fits(pids):
+    """
+    Plot the session of every saved fit
+    """
+    colors, dpi = figure_style()
+    for fit in load_hmm_fits(fit_dir, pids=pids):
+        region, subject, date = fit['region'], fit['subject'], fit['date']
+        n_states = fit['posterior'].shape[2]
+        onset_times = fit['event_times']
+        p_state, _, state_trans = get_state_summary(fit)
+        cmap = sns.color_palette(CMAP, n_states)
 
         # Plot session
-        pivot_df = this_df.pivot_table(index='trial', columns='time', values='state').sort_values(
-            'trial', ascending=False)
         f, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(5.25, 1.75), dpi=dpi)
-        ax1.imshow(pivot_df, aspect='auto', cmap=ListedColormap(cmap), vmin=0, vmax=N_STATES[region]-1,
-                  extent=(-PRE_TIME, POST_TIME, 1, len(onset_times)))
+        ax1.imshow(fit['states'][::-1], aspect='auto', cmap=ListedColormap(cmap), vmin=0,
+                   vmax=n_states-1, extent=(-PRE_TIME, POST_TIME, 1, len(onset_times)))
         ax1.plot([0, 0], [1, len(onset_times)], ls='--', color='k', lw=0.75)
         ax1.set(ylabel='Trials', xlabel='Time (s)', xticks=[-1, 0, 1, 2, 3, 4],
                title=f'{region}')
 
-        for ii in range(N_STATES[region]):
+        for ii in range(n_states):
             ax2.plot(p_state.index.values, p_state[f'state_{ii}_bl'].values, color=cmap[ii])
         ax2.set(xlabel='Time (s)', ylabel='P(state)', xticks=[-1, 0, 1, 2, 3, 4])
 
@@ -243,11 +256,15 @@ for i in rec.index.values:
                     dpi=600)
         plt.close(f)
 
-    # Save output
-    #state_trans_df.to_csv(join(save_path, 'HMM', 'all_state_trans.csv'))
-    #p_state_df.to_csv(join(save_path, 'HMM', 'p_state.csv'))
-
-
 
+if __name__ == '__main__':
+    ba = AllenAtlas()
+    one = ONE()
 
+    # Query sessions
+    rec = query_ephys_sessions(n_trials=400, one=one)
 
+    fit_hmms(rec, one, ba)
+    state_trans_df, p_state_df = summarize_fits(rec['pid'].values)
+    if PLOT:
+        plot_fits(rec['pid'].values)
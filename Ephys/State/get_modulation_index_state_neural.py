@@ -15,7 +15,8 @@ from brainbox.io.one import SpikeSortingLoader
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from serotonin_functions import (load_passive_opto_times, get_neuron_qc, remap, paths,
-                                 query_ephys_sessions)
+                                 query_ephys_sessions, smoothed_rate_chunks, incremental_pca,
+                                 fit_arhmm_stochastic, decode_arhmm_chunks)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -30,6 +31,8 @@ MIN_TRIALS = 10
 PRE_TIME = [0.5, 0]  # for modulation index
 POST_TIME = [0, 0.5]
 OVERWRITE = False
+CHUNKED = False  # incremental PCA and stochastic EM AR-HMM in time chunks (bounded memory, filtered states)
+CHUNK_SIZE = 60  # duration of the time chunks (s)
 
 # Get path
 _, save_path = paths()
@@ -70,22 +73,34 @@ for i in rec.index.values:
     spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
     spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
 
-    # Get smoothed firing rates
-    peth, _ = calculate_peths(spikes.times, spikes.clusters, np.unique(spikes.clusters),
-                              [opto_times[0]-1], pre_time=0, post_time=(opto_times[-1] - opto_times[0])+1,
-                              bin_size=BIN_SIZE, smoothing=SMOOTHING)
-    tscale = peth['tscale'] + (opto_times[0]-1)
-
-    # Do PCA
-    pca = PCA(n_components=D)
-    ss = StandardScaler(with_mean=True, with_std=True)
-    pop_vector_norm = ss.fit_transform(peth['means'].T)
-    pca_proj = pca.fit_transform(pop_vector_norm)
-
-    # Make an hmm and sample from it
-    arhmm = ssm.HMM(K, D, observations="ar")
-    arhmm.fit(pca_proj)
-    zhat = arhmm.most_likely_states(pca_proj)
+    if CHUNKED:
+        # Get smoothed firing rates and do PCA in time chunks
+        rates = incremental_pca(lambda: smoothed_rate_chunks(
+            spikes.times, spikes.clusters, np.unique(spikes.clusters), opto_times[0]-1,
+            opto_times[-1], BIN_SIZE, SMOOTHING, chunk_size=CHUNK_SIZE), D)
+        tscale, pca_proj = rates['times'], rates['projection']
+
+        # Fit the AR-HMM on random subsequences and filter the states chunk by chunk
+        arhmm_params, _ = fit_arhmm_stochastic(pca_proj, K)
+        zhat, _ = decode_arhmm_chunks(pca_proj, arhmm_params)
+
+    else:
+        # Get smoothed firing rates
+        peth, _ = calculate_peths(spikes.times, spikes.clusters, np.unique(spikes.clusters),
+                                  [opto_times[0]-1], pre_time=0, post_time=(opto_times[-1] - opto_times[0])+1,
+                                  bin_size=BIN_SIZE, smoothing=SMOOTHING)
+        tscale = peth['tscale'] + (opto_times[0]-1)
+
+        # Do PCA
+        pca = PCA(n_components=D)
+        ss = StandardScaler(with_mean=True, with_std=True)
+        pop_vector_norm = ss.fit_transform(peth['means'].T)
+        pca_proj = pca.fit_transform(pop_vector_norm)
+
+        # Make an hmm and sample from it
+        arhmm = ssm.HMM(K, D, observations="ar")
+        arhmm.fit(pca_proj)
+        zhat = arhmm.most_likely_states(pca_proj)
 
     # Make sure state 0 is inactive and state 1 active
     if np.mean(pca_proj[zhat == 0, 0]) > np.mean(pca_proj[zhat == 1, 0]):
@@ -8,42 +8,34 @@ By: Guido Meijer
 import numpy as np
 import seaborn as sns
 from os.path import join
-import ssm
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from brainbox.task.closed_loop import roc_single_event
 from matplotlib.ticker import FormatStrFormatter
-from glob import glob
 import pandas as pd
 import math
 from brainbox.plot import peri_event_time_histogram
 from brainbox.io.one import SpikeSortingLoader
 from brainbox.singlecell import calculate_peths
-from serotonin_functions import (figure_style, load_passive_opto_times, get_neuron_qc, remap, paths,
-                                 query_ephys_sessions, load_subjects)
+from serotonin_functions import (figure_style, get_neuron_qc, remap, paths,
+                                 query_ephys_sessions, load_subjects, load_hmm_fits)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
 one = ONE()
 
-K = 2    # number of discrete states
-D = 25   # dimension of the observations
 T_BEFORE = 1
 T_AFTER = 4
 BIN_SIZE = 0.15
 SMOOTHING = 0
 PRE_TIME = [0.5, 0]  # for modulation index
 POST_TIME = [0, 0.5]
-FM_DIR = '/media/guido/Data2/Facemap/'  # dir with facemap data
 OVERWRITE = False
 PLOT = True
 
 # Get path
 fig_path, save_path = paths()
 
-# Get all processed facemap files
-fm_files = glob(join(FM_DIR, '*_proc.npy'))
-
 # Query sessions
 rec = query_ephys_sessions(one=one)
 
@@ -55,14 +47,14 @@ if OVERWRITE:
 else:
     state_change_df = pd.read_csv(join(save_path, 'state_change_face.csv'))
 
-for i, path in enumerate(fm_files):
+# Loop over the face states fitted by fit_ARHMM_face.py
+for fit in load_hmm_fits(join(save_path, 'FaceStates')):
 
     # Get session data
-    subject = path[-40:-31]
-    date = path[-30:-20]
+    subject, date, eid = fit['subject'], fit['date'], fit['eid']
+    fm_times, zhat, opto_times = fit['times'], fit['states'], fit['opto_times']
     try:
         sert_cre = subjects.loc[subjects['subject'] == subject, 'sert-cre'].values[0]
-        eid = one.search(subject=subject, date_range=date)[0]
     except:
         continue
 
@@ -72,40 +64,6 @@ for i, path in enumerate(fm_files):
 
     print(f'Starting {subject}, {date}')
 
-    # Load in timestamp data
-    try:
-        times = one.load_dataset(eid, '_ibl_leftCamera.times.npy')
-    except:
-        continue
-
-    # Load in facemap data
-    fm_dict = np.load(path, allow_pickle=True).item()
-
-    # Facemap data is the last part of the video
-    fm_times = times[times.shape[0] - fm_dict['motSVD'][1].shape[0]:]
-
-    # Load opto times
-    try:
-        opto_times, _ = load_passive_opto_times(eid, one=one)
-    except:
-        continue
-
-    # Select part of recording starting just before opto onset
-    motSVD = fm_dict['motSVD'][1][fm_times > opto_times[0] - 10, :D]
-    fm_times = fm_times[fm_times > opto_times[0] - 10]
-
-    if fm_times.shape[0] == 0:
-        continue
-
-    if np.sum(fm_times[-1] > opto_times) != opto_times.shape[0]:
-        print('Mismatch!')
-        continue
-
-    # Make an hmm and sample from it
-    arhmm = ssm.HMM(K, D, observations="ar")
-    arhmm.fit(motSVD[:, :D])
-    zhat = arhmm.most_likely_states(motSVD[:, :D])
-
     # Get state change times
     state_changes = fm_times[np.concatenate((np.zeros(1), np.diff(zhat))) != 0]
 
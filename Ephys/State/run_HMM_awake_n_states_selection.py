@@ -3,25 +3,33 @@
 """
 Created on Wed Jan 18 11:20:14 2023
 By: Guido Meijer
+
+Cross-validated selection of the number of states of the awake HMMs. For every insertion and
+region the grid of number of states x folds x random restarts is run on a process pool, larger
+numbers of states are warm-started from the smaller ones. The held-out log-likelihood is saved
+in HMM/hmm_log_likelihood.csv and the number of states per region (N_STATES in
+serotonin_functions) is regenerated from it.
 """
 
-import ssm
+import json
 import numpy as np
+from os import cpu_count
 from os.path import join
 import pandas as pd
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from brainbox.io.one import SpikeSortingLoader
 from sklearn.model_selection import KFold
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_passive_opto_times,
-                                 get_artifact_neurons, get_neuron_qc, calculate_peths,
-                                 high_level_regions)
+                                 is_artifact, get_neuron_qc, calculate_peths,
+                                 high_level_regions, load_subjects, cross_validate_poisson_hmm,
+                                 finished_futures)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
-ba = AllenAtlas()
-one = ONE()
 
 # Settings
 OVERWRITE = True
+N_CORES = None  # number of worker processes, None uses all cores
+MAX_PENDING = 2 * (N_CORES or cpu_count())  # folds queued on the pool at a time
 NEURON_QC = True
 N_STATES = np.arange(2, 21)
 PRE_TIME = 1
@@ -30,114 +38,180 @@ BIN_SIZE = 0.01
 MIN_NEURONS = 5
 K_FOLDS = 10
 CV_SHUFFLE = True
+N_RESTARTS = 2  # random restarts per fold, the restart with the best training fit is used
+N_EM_ITERS = 100  # maximum number of EM iterations per model
+EM_TOLERANCE = 1e-4  # stop EM when the log-likelihood per time bin improves less than this
+ELBOW_FRACTION = 0.8  # fraction of the total improvement in held-out log-likelihood to reach
 
 # Get paths
 fig_path, save_path = paths()
 fig_path = join(fig_path, 'Ephys', 'SingleNeurons', 'LightModNeurons')
 save_path = join(save_path, 'HMM')
 
-# Query sessions
-rec = query_ephys_sessions(anesthesia='no&both', one=one)
-
-# Get light artifact units
-artifact_neurons = get_artifact_neurons()
-
-# Initialize k-fold cross validation
-kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
-
-if OVERWRITE:
-    log_likelihood_df = pd.DataFrame()
-else:
-    log_likelihood_df = pd.read_csv(join(save_path, 'hmm_log_likelihood.csv'))
-    rec = rec[~rec['pid'].isin(log_likelihood_df['pid'])]
-
-for i in rec.index.values:
-
-    # Get session details
-    pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
-    subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
-
-    print(f'\nStarting {subject}, {date} ({i+1} of {len(rec)})')
-
-    # Load in laser pulse times
-    opto_train_times, _ = load_passive_opto_times(eid, one=one)
-    if len(opto_train_times) == 0:
-        print('Could not load light pulses')
-        continue
-
-    # Load in spikes
-    sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = sl.load_spike_sorting()
-    clusters = sl.merge_clusters(spikes, clusters, channels)
-
-    # Filter neurons that pass QC
-    qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
-    clusters_pass = np.where(qc_metrics['label'] == 1)[0]
-
-    # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
-    if clusters_pass.shape[0] == 0:
-            continue
-
-    # Select QC pass neurons
-    spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
-    spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
-    clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
-
-    # Get regions from Beryl atlas
-    clusters['region'] = remap(clusters['acronym'], combine=True)
-    clusters['high_level_region'] = high_level_regions(clusters['acronym'])
-    clusters_regions = clusters['high_level_region'][clusters_pass]
 
-    # Loop over regions
-    for r, region in enumerate(np.unique(clusters['high_level_region'])):
-
-        if region == 'root':
-            continue
-
-        # Select spikes and clusters in this brain region
-        clusters_in_region = clusters_pass[clusters_regions == region]
-        if len(clusters_in_region) < MIN_NEURONS:
-            continue
-
-        # Get binned spikes centered at stimulation onset
-        peth, binned_spikes = calculate_peths(spikes.times, spikes.clusters, clusters_in_region, opto_train_times,
-                                              pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE,
-                                              smoothing=0, return_fr=False)
-        binned_spikes = binned_spikes.astype(int)
-        time_ax = peth['tscale']
-
-        # Create list of (time_bins x neurons) per stimulation trial
-        trial_data = []
-        for i in range(binned_spikes.shape[0]):
-            trial_data.append(np.transpose(binned_spikes[i, :, :]))
-
-        # Loop over different number of states
-        log_likelihood = np.empty(N_STATES.shape[0])
-
-        for j, s in enumerate(N_STATES):
-            print(f'Starting state {s} of {N_STATES[-1]}')
-
-            # Cross validate
-            train_index, test_index = next(kf.split(trial_data))
-
-            # Fit HMM on training data
-            simple_hmm = ssm.HMM(s, clusters_in_region.shape[0], observations='poisson')
-            lls = simple_hmm.fit(list(np.array(trial_data)[train_index]), method='em',
-                                 transitions='sticky')
-
-            # Get log-likelihood on test data
-            log_likelihood[j] = simple_hmm.log_likelihood(list(np.array(trial_data)[test_index]))
-
-        # Add to dataframe
-        log_likelihood_df = pd.concat((log_likelihood_df, pd.DataFrame(data={
-            'log_likelihood': log_likelihood, 'n_states': N_STATES, 'region': region,
-            'subject': subject, 'pid': pid})))
+def run_cross_validation(rec, one, ba):
+    """
+    Submit every fold and restart of every insertion and region to a process pool, returns a
+    dataframe with the training and held-out log-likelihood per number of states
+    """
+
+    # Initialize k-fold cross validation
+    kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
+
+    def collect_folds(max_pending):
+        for future, (pid, subject, region, k, restart) in finished_futures(futures, max_pending):
+            try:
+                train_ll, test_ll = future.result()
+            except Exception as err:
+                print(f'Cross-validation of {subject} {region} (fold {k}) failed: {err}')
+                continue
+            fold_ll.append(pd.DataFrame(data={
+                'train_log_likelihood': train_ll, 'log_likelihood': test_ll,
+                'n_states': N_STATES, 'fold': k, 'restart': restart, 'region': region,
+                'subject': subject, 'pid': pid}))
+
+    futures, fold_ll = dict(), []
+    with ProcessPoolExecutor(max_workers=N_CORES) as executor:
+        for i in rec.index.values:
+
+            # Get session details
+            pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
+            subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
+
+            print(f'\nStarting {subject}, {date} ({i+1} of {len(rec)})')
+
+            # Load in laser pulse times
+            opto_train_times, _ = load_passive_opto_times(eid, one=one)
+            if len(opto_train_times) == 0:
+                print('Could not load light pulses')
+                continue
+
+            # Load in spikes
+            sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = sl.load_spike_sorting()
+            clusters = sl.merge_clusters(spikes, clusters, channels)
+
+            # Filter neurons that pass QC
+            qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
+            clusters_pass = np.where(qc_metrics['label'] == 1)[0]
+
+            # Exclude artifact neurons
+            clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
+            if clusters_pass.shape[0] == 0:
+                continue
+
+            # Select QC pass neurons
+            spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
+            spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
+            clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
+
+            # Get regions from Beryl atlas
+            clusters['region'] = remap(clusters['acronym'], combine=True)
+            clusters['high_level_region'] = high_level_regions(clusters['acronym'])
+            clusters_regions = clusters['high_level_region'][clusters_pass]
+
+            # Loop over regions
+            for r, region in enumerate(np.unique(clusters['high_level_region'])):
+
+                if region == 'root':
+                    continue
+
+                # Select spikes and clusters in this brain region
+                clusters_in_region = clusters_pass[clusters_regions == region]
+                if len(clusters_in_region) < MIN_NEURONS:
+                    continue
+
+                # Get binned spikes centered at stimulation onset
+                peth, binned_spikes = calculate_peths(
+                    spikes.times, spikes.clusters, clusters_in_region, opto_train_times,
+                    pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE, smoothing=0,
+                    return_fr=False)
+                binned_spikes = binned_spikes.astype(int)
+
+                # Submit every fold and restart
+                for k, (train_index, test_index) in enumerate(kf.split(binned_spikes)):
+                    for restart in range(N_RESTARTS):
+                        future = executor.submit(
+                            cross_validate_poisson_hmm, binned_spikes, N_STATES, train_index,
+                            test_index, seed=k * N_RESTARTS + restart, num_iters=N_EM_ITERS,
+                            tolerance=EM_TOLERANCE)
+                        futures[future] = (pid, subject, region, k, restart)
+
+                        # Wait for running folds so that the queue holds at most MAX_PENDING
+                        # copies of the binned spikes
+                        collect_folds(MAX_PENDING)
+
+        collect_folds(0)
+    if len(fold_ll) == 0:
+        return pd.DataFrame()
+    return pd.concat(fold_ll, ignore_index=True)
+
+
+def summarize_folds(fold_ll_df):
+    """
+    Held-out log-likelihood per insertion, region and number of states: per fold the restart
+    with the best training log-likelihood is selected and the folds are averaged
+    """
+    best_restart = (fold_ll_df.groupby(['pid', 'region', 'n_states', 'fold'])
+                    ['train_log_likelihood'].idxmax())
+    log_likelihood_df = (fold_ll_df.loc[best_restart]
+                         .groupby(['pid', 'region', 'n_states'], sort=False)
+                         .agg(log_likelihood=('log_likelihood', 'mean'),
+                              subject=('subject', 'first'))
+                         .reset_index())
+    log_likelihood_df = log_likelihood_df.sort_values(['pid', 'region', 'n_states'],
+                                                      ignore_index=True)
+    return log_likelihood_df[['log_likelihood', 'n_states', 'region', 'subject', 'pid']]
+
+
+def select_n_states(log_likelihood_df):
+    """
+    Number of states per region: the smallest number of states of which the normalized
+    held-out log-likelihood (averaged within sert-cre mice first) reaches ELBOW_FRACTION of the
+    total improvement over the smallest number of states
+    """
+    ll_df = log_likelihood_df.sort_values(['pid', 'region', 'n_states'])
+    ll_df['xcorr'] = -2 * ll_df['log_likelihood']
+    ll_df['ll_norm'] = ll_df['xcorr'] / ll_df.groupby(['pid', 'region'])['xcorr'].transform(
+        lambda x: x.iloc[0])
+
+    # Average within mice first and select only sert-cre mice
+    subjects = load_subjects()
+    sert_cre = subjects.loc[subjects['sert-cre'] == 1, 'subject']
+    ll_df = ll_df[ll_df['subject'].isin(sert_cre)]
+    ll_mean = (ll_df.groupby(['subject', 'region', 'n_states'])['ll_norm'].mean()
+               .groupby(['region', 'n_states']).mean())
+
+    n_states = dict()
+    for region in ll_mean.index.unique('region'):
+        improvement = 1 - ll_mean[region]
+        n_states[region] = int(improvement.index[
+            np.argmax(improvement.values >= ELBOW_FRACTION * improvement.max())])
+    return n_states
+
+
+if __name__ == '__main__':
+    ba = AllenAtlas()
+    one = ONE()
+
+    # Query sessions
+    rec = query_ephys_sessions(anesthesia='no&both', one=one)
+
+    if OVERWRITE:
+        fold_ll_df = pd.DataFrame()
+    else:
+        fold_ll_df = pd.read_csv(join(save_path, 'hmm_log_likelihood_folds.csv'))
+        rec = rec[~rec['pid'].isin(fold_ll_df['pid'])]
+
+    fold_ll_df = pd.concat((fold_ll_df, run_cross_validation(rec, one, ba)), ignore_index=True)
+    fold_ll_df.to_csv(join(save_path, 'hmm_log_likelihood_folds.csv'), index=False)
 
     # Save result
+    log_likelihood_df = summarize_folds(fold_ll_df)
     log_likelihood_df.to_csv(join(save_path, 'hmm_log_likelihood.csv'))
 
-
-
-
+    # Regenerate the number of states per region
+    n_states = select_n_states(log_likelihood_df)
+    with open(join(save_path, 'n_states.json'), 'w') as json_file:
+        json.dump(n_states, json_file)
+    print(f'\nN_STATES = {n_states}')
@@ -15,13 +15,12 @@ from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from os import mkdir
 import seaborn as sns
 from brainbox.io.one import SpikeSortingLoader
-from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.task.closed_loop import (responsive_units, roc_single_event,
                                        roc_between_two_events, generate_pseudo_blocks)
 from brainbox.plot import peri_event_time_histogram
 from brainbox.population.decode import get_spike_counts_in_bins
 from serotonin_functions import (paths, remap, query_ephys_sessions, load_trials, figure_style,
-                                 get_artifact_neurons)
+                                 get_artifact_neurons, neuron_qc_pass)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -71,10 +70,7 @@ for i in rec.index.values:
 
     # Filter neurons that pass QC and artifact neurons
     if NEURON_QC:
-        print('Calculating neuron QC metrics..')
-        qc_metrics, _ = spike_sorting_metrics(spikes.times, spikes.clusters, spikes.amps, spikes.depths,
-                                              cluster_ids=np.arange(clusters.channels.size))
-        clusters_pass = np.where(qc_metrics['label'] > 0.5)[0]
+        clusters_pass = neuron_qc_pass(pid, one=one, min_label=0.5)
     else:
         clusters_pass = np.unique(spikes.clusters)
     clusters_pass = clusters_pass[~np.isin(clusters_pass, artifact_neurons.loc[
@@ -3,25 +3,30 @@
 """
 Created on Thu Oct 27 14:52:05 2022
 By: Guido Meijer
+
+Fits a two state Poisson HMM (down and up state) per insertion and high-level region to the
+activity around the laser stimulation under anesthesia. Every (pid, region) fit runs as a
+separate task on a process pool and is saved in HMM/Fits/Anesthesia, P(down state) and the
+(optional) figures are made from the saved fits.
 """
 
 import numpy as np
+from os import cpu_count
 from os.path import join
-import ssm
+from glob import glob
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.colors import ListedColormap
-from brainbox.plot import peri_event_time_histogram
 from brainbox.io.one import SpikeSortingLoader
 from sklearn.model_selection import KFold
 from serotonin_functions import (load_passive_opto_times, get_neuron_qc, paths, query_ephys_sessions,
-                                 figure_style, load_subjects, remap, high_level_regions,
-                                 get_artifact_neurons, calculate_peths)
+                                 figure_style, remap, high_level_regions,
+                                 is_artifact, calculate_peths, fit_poisson_hmm, load_hmm_fits,
+                                 finished_futures)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
-ba = AllenAtlas()
-one = ONE()
 
 # Settings
 N_STATES = 2
@@ -30,181 +35,160 @@ MIN_NEURONS = 5
 CROSS_VAL = False
 K_FOLDS = 10
 CV_SHUFFLE = True
-OVERWRITE = True
+OVERWRITE = True  # refit insertions of which the fits are already saved
+N_CORES = None  # number of worker processes, None uses all cores
+MAX_PENDING = 2 * (N_CORES or cpu_count())  # fits queued on the pool at a time
 PRE_TIME = 1
 POST_TIME = 4
 PLOT = True
-MIN_NEURONS = 5
+EXAMPLE_TRIAL = 13
 
 # Get path
 fig_path, save_path = paths()
+fit_dir = join(save_path, 'HMM', 'Fits', 'Anesthesia')
+
+
+def fit_hmms(rec, one, ba):
+    """
+    Submit the HMM fit of every insertion and region to a process pool
+    """
+
+    # Initialize k-fold cross validation
+    kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
+
+    def report_fits(max_pending):
+        for future, task in finished_futures(futures, max_pending):
+            try:
+                future.result()
+            except Exception as err:
+                print(f'HMM fit of {task} failed: {err}')
+
+    futures = dict()
+    with ProcessPoolExecutor(max_workers=N_CORES) as executor:
+        for i in rec.index.values:
+
+            # Get session details
+            pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
+            subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
+            if not OVERWRITE and len(glob(join(fit_dir, f'{pid}_*.npz'))) > 0:
+                continue
+            print(f'\nStarting {subject}, {date}, {probe} ({i+1} of {len(rec)})')
+
+            # Load opto times
+            if rec.loc[i, 'anesthesia'] == 'both':
+                opto_times, _ = load_passive_opto_times(eid, anesthesia=True, one=one)
+            else:
+                opto_times, _ = load_passive_opto_times(eid, one=one)
+
+            # Load in spikes
+            sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = sl.load_spike_sorting()
+            clusters = sl.merge_clusters(spikes, clusters, channels)
+
+            # Filter neurons that pass QC
+            qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
+            clusters_pass = np.where(qc_metrics['label'] == 1)[0]
+
+            # Exclude artifact neurons
+            clusters_pass = clusters_pass[~is_artifact(pid, clusters_pass)]
+            if clusters_pass.shape[0] == 0:
+                continue
+
+            # Select QC pass neurons
+            spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
+            spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
+            clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
+
+            # Get regions from Beryl atlas
+            clusters['region'] = remap(clusters['acronym'], combine=True)
+            clusters['high_level_region'] = high_level_regions(clusters['acronym'])
+            clusters_regions = clusters['high_level_region'][clusters_pass]
+
+            # Loop over regions
+            for r, region in enumerate(np.unique(clusters['high_level_region'])):
+                if region == 'root':
+                    continue
+
+                # Select spikes and clusters in this brain region
+                clusters_in_region = clusters_pass[clusters_regions == region]
+                if len(clusters_in_region) < MIN_NEURONS:
+                    continue
+
+                # Get binned spikes centered at stimulation onset
+                peth, binned_spikes = calculate_peths(
+                    spikes.times, spikes.clusters, clusters_in_region, opto_times,
+                    pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE, smoothing=0,
+                    return_fr=False)
+
+                # Keep the spikes of the example trial for the raster plot
+                trial_spikes = (np.isin(spikes.clusters, clusters_in_region)
+                                & (spikes.times >= opto_times[EXAMPLE_TRIAL] - PRE_TIME)
+                                & (spikes.times <= opto_times[EXAMPLE_TRIAL] + POST_TIME))
+
+                # Fit the HMM of this region in a worker process
+                future = executor.submit(
+                    fit_poisson_hmm, binned_spikes.astype(int), N_STATES,
+                    join(fit_dir, f'{pid}_{region}.npz'),
+                    folds=list(kf.split(binned_spikes)) if CROSS_VAL else None,
+                    subject=subject, date=date, pid=pid, region=region, time_ax=peth['tscale'],
+                    event_times=opto_times, cluster_ids=clusters_in_region,
+                    example_spike_times=spikes.times[trial_spikes] - opto_times[EXAMPLE_TRIAL],
+                    example_spike_neurons=np.searchsorted(clusters_in_region,
+                                                          spikes.clusters[trial_spikes]))
+                futures[future] = f'{subject} {date} {region}'
+
+                # Wait for running fits so that the queue holds the data of at most MAX_PENDING
+                # fits while the next insertions are loaded
+                report_fits(MAX_PENDING)
+
+        report_fits(0)
+
+
+def get_updown_states(fit):
+    """
+    Get the states of one saved fit relabeled per trial so that 0 is the down state and 1 is the
+    up state
+    """
+    up_first = fit['state_rates'][:, 0] > fit['state_rates'][:, 1]
+    return np.where(up_first[:, None], 1 - fit['states'], fit['states'])
+
+
+def summarize_fits(pids):
+    """
+    Get P(down state) over time from the saved fits
+    """
+    up_down_state_df = pd.DataFrame()
+    for fit in load_hmm_fits(fit_dir, pids=pids):
+        states = get_updown_states(fit)
+        up_down_state_df = pd.concat((up_down_state_df, pd.DataFrame(data={
+            'p_down': 1 - np.mean(states, axis=0), 'time': fit['time_ax'],
+            'subject': fit['subject'], 'pid': fit['pid'], 'region': fit['region']})))
 
-# Query sessions
-rec_both = query_ephys_sessions(anesthesia='both', one=one)
-rec_both['anesthesia'] = 'both'
-rec_anes = query_ephys_sessions(anesthesia='yes', one=one)
-rec_anes['anesthesia'] = 'yes'
-rec = pd.concat((rec_both, rec_anes)).reset_index(drop=True)
-subjects = load_subjects()
-
-# Get artifact neurons
-artifact_neurons = get_artifact_neurons()
+    # Save result
+    up_down_state_df.to_csv(join(save_path, 'updown_states_anesthesia.csv'))
 
-# Initialize k-fold cross validation
-kf = KFold(n_splits=K_FOLDS, shuffle=CV_SHUFFLE, random_state=42)
 
-if OVERWRITE:
-    up_down_state_df = pd.DataFrame()
-else:
-    up_down_state_df = pd.read_csv(join(save_path, 'updown_state_anesthesia.csv'))
-
-for i in rec.index.values:
-
-    # Get session details
-    pid, eid, probe = rec.loc[i, 'pid'], rec.loc[i, 'eid'], rec.loc[i, 'probe']
-    subject, date = rec.loc[i, 'subject'], rec.loc[i, 'date']
-    sert_cre = subjects.loc[subjects['subject'] == subject, 'sert-cre'].values[0]
-    print(f'\nStarting {subject}, {date}, {probe} ({i+1} of {len(rec)})')
-
-    if not OVERWRITE:
-        if pid in up_down_state_df['pid'].values:
-            continue
-
-    # Load opto times
-    if rec.loc[i, 'anesthesia'] == 'both':
-        opto_times, _ = load_passive_opto_times(eid, anesthesia=True, one=one)
-    else:
-        opto_times, _ = load_passive_opto_times(eid, one=one)
-
-    # Load in spikes
-    sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = sl.load_spike_sorting()
-    clusters = sl.merge_clusters(spikes, clusters, channels)
-
-    # Filter neurons that pass QC
-    qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
-    clusters_pass = np.where(qc_metrics['label'] == 1)[0]
-
-    # Exclude artifact neurons
-    clusters_pass = np.array([i for i in clusters_pass if i not in artifact_neurons.loc[
-        artifact_neurons['pid'] == pid, 'neuron_id'].values])
-    if clusters_pass.shape[0] == 0:
-            continue
-
-    # Select QC pass neurons
-    spikes.times = spikes.times[np.isin(spikes.clusters, clusters_pass)]
-    spikes.clusters = spikes.clusters[np.isin(spikes.clusters, clusters_pass)]
-    clusters_pass = clusters_pass[np.isin(clusters_pass, np.unique(spikes.clusters))]
-
-    # Get regions from Beryl atlas
-    clusters['region'] = remap(clusters['acronym'], combine=True)
-    clusters['high_level_region'] = high_level_regions(clusters['acronym'])
-    clusters_regions = clusters['high_level_region'][clusters_pass]
-
-    # Loop over regions
-    for r, region in enumerate(np.unique(clusters['high_level_region'])):
-        if region == 'root':
-            continue
-
-        # Select spikes and clusters in this brain region
-        clusters_in_region = clusters_pass[clusters_regions == region]
-        if len(clusters_in_region) < MIN_NEURONS:
-            continue
-
-        # Get binned spikes centered at stimulation onset
-        peth, binned_spikes = calculate_peths(spikes.times, spikes.clusters, clusters_in_region, opto_times,
-                                              pre_time=PRE_TIME, post_time=POST_TIME, bin_size=BIN_SIZE,
-                                              smoothing=0, return_fr=False)
-        binned_spikes = binned_spikes.astype(int)
-        time_ax = peth['tscale']
-
-        # Create list of (time_bins x neurons) per stimulation trial
-        trial_data = []
-        for i in range(binned_spikes.shape[0]):
-            trial_data.append(np.transpose(binned_spikes[i, :, :]))
-
-        # Initialize HMM
-        simple_hmm = ssm.HMM(N_STATES, clusters_in_region.shape[0], observations='poisson')
-
-        this_df = pd.DataFrame()
-        if CROSS_VAL:
-            # Cross validate
-            for k, (train_index, test_index) in enumerate(kf.split(trial_data)):
-
-                # Fit HMM on training data
-                lls = simple_hmm.fit(list(np.array(trial_data)[train_index]), method='em',
-                                     transitions='sticky')
-
-                for t in test_index:
-
-                    # Get posterior probability and most likely states for this trial
-                    posterior = simple_hmm.filter(trial_data[t])
-                    zhat = simple_hmm.most_likely_states(trial_data[t])
-
-                    # Make sure 0 is down state and 1 is up state
-                    if np.mean(binned_spikes[t, :, zhat==0]) > np.mean(binned_spikes[t, :, zhat==1]):
-
-                        # State 0 is up state
-                        zhat = np.where((zhat==0)|(zhat==1), zhat^1, zhat)
-                        p_down = posterior[:, 1]
-                    else:
-                        p_down = posterior[:, 0]
-
-                # Add to dataframe
-                this_df = pd.concat((this_df, pd.DataFrame(data={
-                    'state': zhat, 'p_down': p_down, 'region': region, 'time': time_ax,
-                    'trial': t})))
-
-        else:
-
-            # Fit HMM on all data
-            lls = simple_hmm.fit(trial_data, method='em', transitions='sticky')
-
-            for t in range(len(trial_data)):
-
-                # Get posterior probability and most likely states for this trial
-                posterior = simple_hmm.filter(trial_data[t])
-                zhat = simple_hmm.most_likely_states(trial_data[t])
-
-                # Make sure 0 is down state and 1 is up state
-                if np.mean(binned_spikes[t, :, zhat==0]) > np.mean(binned_spikes[t, :, zhat==1]):
-
-                    # State 0 is up state
-                    zhat = np.where((zhat==0)|(zhat==1), zhat^1, zhat)
-                    p_down = posterior[:, 1]
-                else:
-                    p_down = posterior[:, 0]
-
-                # Add to dataframe
-                this_df = pd.concat((this_df, pd.DataFrame(data={
-                    'state': zhat, 'p_down': p_down, 'region': region, 'time': time_ax,
-                    'trial': t})))
-
-        # Add to dataframe
-        p_down = this_df[['time', 'state']].groupby('time').mean().reset_index()
-        p_down['state'] = 1-p_down['state']
-        up_down_state_df = pd.concat((up_down_state_df, pd.DataFrame(data={
-            'p_down': p_down['state'], 'time': p_down['time'], 'subject': subject,
-            'pid': pid, 'region': region})))
+def plot_fits(pids):
+    """
+    Plot the example trial and the session of every saved fit
+    """
+    colors, dpi = figure_style()
+    cmap = ListedColormap([colors['suppressed'], colors['enhanced']])
+    for fit in load_hmm_fits(fit_dir, pids=pids):
+        region, subject, date = fit['region'], fit['subject'], fit['date']
+        n_neurons, n_trials = fit['cluster_ids'].shape[0], fit['event_times'].shape[0]
+        states = get_updown_states(fit)
 
         # Plot example trial
-        trial = 13
-        colors, dpi = figure_style()
-        cmap = ListedColormap([colors['suppressed'], colors['enhanced']])
         f, ax = plt.subplots(1, 1, figsize=(1.75, 1.75), dpi=dpi)
-        ax.imshow(this_df.loc[this_df['trial'] == trial, 'state'].values[None, :],
+        ax.imshow(states[EXAMPLE_TRIAL][None, :],
                   aspect='auto', cmap=cmap, vmin=0, vmax=1, alpha=0.5,
-                  extent=(-PRE_TIME, POST_TIME, -1, len(clusters_in_region)+1))
-        tickedges = np.arange(0, len(clusters_in_region)+1)
-        for i, n in enumerate(clusters_in_region):
-            idx = np.bitwise_and(spikes.times[spikes.clusters == n] >= opto_times[trial] - PRE_TIME,
-                                 spikes.times[spikes.clusters == n] <= opto_times[trial] + POST_TIME)
-            neuron_spks = spikes.times[spikes.clusters == n][idx]
-            ax.vlines(neuron_spks - opto_times[trial], tickedges[i + 1], tickedges[i], color='black',
-                      lw=0.5)
-        ax.set(xlabel='Time (s)', ylabel='Neurons', yticks=[0, len(clusters_in_region)],
-               yticklabels=[1, len(clusters_in_region)], xticks=[-1, 0, 1, 2, 3, 4],
-               ylim=[-1, len(clusters_in_region)+1], title=f'{region}')
+                  extent=(-PRE_TIME, POST_TIME, -1, n_neurons+1))
+        ax.vlines(fit['example_spike_times'], fit['example_spike_neurons'] + 1,
+                  fit['example_spike_neurons'], color='black', lw=0.5)
+        ax.set(xlabel='Time (s)', ylabel='Neurons', yticks=[0, n_neurons],
+               yticklabels=[1, n_neurons], xticks=[-1, 0, 1, 2, 3, 4],
+               ylim=[-1, n_neurons+1], title=f'{region}')
         sns.despine(trim=True)
         plt.tight_layout()
         plt.savefig(join(fig_path, 'Ephys', 'UpDownStates', 'Anesthesia',
@@ -213,12 +197,10 @@ for i in rec.index.values:
         plt.close(f)
 
         # Plot session
-        pivot_df = this_df.pivot_table(index='trial', columns='time', values='state').sort_values(
-            'trial', ascending=False)
         f, ax = plt.subplots(1, 1, figsize=(1.75, 1.75), dpi=dpi)
-        ax.imshow(pivot_df, aspect='auto', cmap=cmap, vmin=0, vmax=1,
-                  extent=(-PRE_TIME, POST_TIME, 1, len(opto_times)))
-        ax.plot([0, 0], [1, len(opto_times)], ls='--', color='k', lw=0.75)
+        ax.imshow(states[::-1], aspect='auto', cmap=cmap, vmin=0, vmax=1,
+                  extent=(-PRE_TIME, POST_TIME, 1, n_trials))
+        ax.plot([0, 0], [1, n_trials], ls='--', color='k', lw=0.75)
         ax.set(ylabel='Trials', xlabel='Time (s)', yticks=[1, 25, 50], xticks=[-1, 0, 1, 2, 3, 4],
                title=f'{region}')
         sns.despine(trim=True)
@@ -228,8 +210,19 @@ for i in rec.index.values:
                     dpi=600)
         plt.close(f)
 
-    # Save result
-    up_down_state_df.to_csv(join(save_path, 'updown_states_anesthesia.csv'))
 
+if __name__ == '__main__':
+    ba = AllenAtlas()
+    one = ONE()
 
+    # Query sessions
+    rec_both = query_ephys_sessions(anesthesia='both', one=one)
+    rec_both['anesthesia'] = 'both'
+    rec_anes = query_ephys_sessions(anesthesia='yes', one=one)
+    rec_anes['anesthesia'] = 'yes'
+    rec = pd.concat((rec_both, rec_anes)).reset_index(drop=True)
 
+    fit_hmms(rec, one, ba)
+    summarize_fits(rec['pid'].values)
+    if PLOT:
+        plot_fits(rec['pid'].values)
@@ -17,7 +17,9 @@ from brainbox.io.one import SpikeSortingLoader
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from serotonin_functions import (load_passive_opto_times, get_neuron_qc, paths, query_ephys_sessions,
-                                 figure_style, load_subjects, remap, high_level_regions)
+                                 figure_style, load_subjects, remap, high_level_regions,
+                                 smoothed_rate_chunks, incremental_pca, fit_arhmm_stochastic,
+                                 decode_arhmm_chunks)
 from one.api import ONE
 from ibllib.atlas import AllenAtlas
 ba = AllenAtlas()
@@ -34,6 +36,8 @@ T_BEFORE = 1  # for PSTH
 T_AFTER = 4
 PLOT = True
 MIN_NEURONS = 10
+CHUNKED = False  # incremental PCA and stochastic EM HMM in time chunks (bounded memory, always PCA, filtered states)
+CHUNK_SIZE = 60  # duration of the time chunks (s)
 
 # Get path
 fig_path, save_path = paths()
@@ -86,39 +90,55 @@ for i in rec.index.values:
         if (np.unique(region_clusters).shape[0] < MIN_NEURONS) | (region == 'root'):
             continue
 
-        # Get smoothed firing rates
-        peth, _ = calculate_peths(region_spikes, region_clusters, np.unique(region_clusters),
-                                  [opto_times[0]-300], pre_time=0, post_time=(opto_times[-1] - opto_times[0])+301,
-                                  bin_size=BIN_SIZE, smoothing=SMOOTHING)
-        tscale = peth['tscale'] + (opto_times[0]-300)
-        pop_act = peth['means'].T
-
-        # Do PCA
-        if do_PCA:
-            pca = PCA(n_components=D)
-            ss = StandardScaler(with_mean=True, with_std=True)
-            pop_vector_norm = ss.fit_transform(pop_act)
-            pca_proj = pca.fit_transform(pop_vector_norm)
-
-            # Make an hmm and sample from it
-            arhmm = ssm.HMM(K, pca_proj.shape[1], observations="gaussian")
-            arhmm.fit(pca_proj)
-            zhat = arhmm.most_likely_states(pca_proj)
+        if CHUNKED:
+            # Get smoothed firing rates and do PCA in time chunks
+            rates = incremental_pca(lambda: smoothed_rate_chunks(
+                region_spikes, region_clusters, np.unique(region_clusters), opto_times[0]-300,
+                opto_times[-1]+1, BIN_SIZE, SMOOTHING, chunk_size=CHUNK_SIZE), D)
+            tscale = rates['times']
+
+            # Fit the HMM on random subsequences and filter the states chunk by chunk
+            hmm_params, _ = fit_arhmm_stochastic(rates['projection'], K, autoregressive=False)
+            zhat, _ = decode_arhmm_chunks(rates['projection'], hmm_params)
+
+            # Make sure state 0 is inactive and state 1 active
+            if np.mean(rates['mean_rate'][zhat == 0]) > np.mean(rates['mean_rate'][zhat == 1]):
+                zhat = np.where((zhat==0)|(zhat==1), zhat^1, zhat)
 
         else:
-            # Make an hmm and sample from it
-            arhmm = ssm.HMM(K, pop_act.shape[1], observations="gaussian")
-            arhmm.fit(pop_act)
-            zhat = arhmm.most_likely_states(pop_act)
-
-            # Make an hmm and sample from it
-            arhmm = ssm.HMM(K, pop_act.shape[1], observations="gaussian")
-            arhmm.fit(pop_act)
-            zhat = arhmm.most_likely_states(pop_act)
-
-        # Make sure state 0 is inactive and state 1 active
-        if np.mean(np.mean(pop_act[zhat == 0, :], 1)) > np.mean(np.mean(pop_act[zhat == 1, :], 1)):
-            zhat = np.where((zhat==0)|(zhat==1), zhat^1, zhat)
+            # Get smoothed firing rates
+            peth, _ = calculate_peths(region_spikes, region_clusters, np.unique(region_clusters),
+                                      [opto_times[0]-300], pre_time=0, post_time=(opto_times[-1] - opto_times[0])+301,
+                                      bin_size=BIN_SIZE, smoothing=SMOOTHING)
+            tscale = peth['tscale'] + (opto_times[0]-300)
+            pop_act = peth['means'].T
+
+            # Do PCA
+            if do_PCA:
+                pca = PCA(n_components=D)
+                ss = StandardScaler(with_mean=True, with_std=True)
+                pop_vector_norm = ss.fit_transform(pop_act)
+                pca_proj = pca.fit_transform(pop_vector_norm)
+
+                # Make an hmm and sample from it
+                arhmm = ssm.HMM(K, pca_proj.shape[1], observations="gaussian")
+                arhmm.fit(pca_proj)
+                zhat = arhmm.most_likely_states(pca_proj)
+
+            else:
+                # Make an hmm and sample from it
+                arhmm = ssm.HMM(K, pop_act.shape[1], observations="gaussian")
+                arhmm.fit(pop_act)
+                zhat = arhmm.most_likely_states(pop_act)
+
+                # Make an hmm and sample from it
+                arhmm = ssm.HMM(K, pop_act.shape[1], observations="gaussian")
+                arhmm.fit(pop_act)
+                zhat = arhmm.most_likely_states(pop_act)
+
+            # Make sure state 0 is inactive and state 1 active
+            if np.mean(np.mean(pop_act[zhat == 0, :], 1)) > np.mean(np.mean(pop_act[zhat == 1, :], 1)):
+                zhat = np.where((zhat==0)|(zhat==1), zhat^1, zhat)
 
         # Get state change times
         to_down = tscale[np.concatenate((np.zeros(1), np.diff(zhat))) == -1]
@@ -9,7 +9,9 @@ from one.api import ONE
 import pandas as pd
 from os.path import join, isfile
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.interpolate import interp1d
+from scipy.signal import savgol_filter
 
 
 def get_dlc_XYs(one, eid, view='left', likelihood_thresh=0.9):
@@ -74,12 +76,14 @@ def smooth_interpolate_signal_sg(signal, window=31, order=3, interp_kind='cubic'
     return signal
 
 
-def non_uniform_savgol(x, y, window, polynom):
+def non_uniform_savgol(x, y, window, polynom, chunk_size=10000):
     """Applies a Savitzky-Golay filter to y with non-uniform spacing as defined in x.
     This is based on
     https://dsp.stackexchange.com/questions/1676/savitzky-golay-smoothing-filter-for-not-equally-spaced-data
     The borders are interpolated like scipy.signal.savgol_filter would do
     https://dsp.stackexchange.com/a/64313
+    Windows in which the samples are uniformly spaced are taken from scipy.signal.savgol_filter,
+    the polynomials of all other windows are fit at once with batched least squares.
     Parameters
     ----------
     x : array_like
@@ -90,6 +94,8 @@ def non_uniform_savgol(x, y, window, polynom):
         Window length of datapoints. Must be odd and smaller than x
     polynom : int
         The order of polynom used. Must be smaller than the window size
+    chunk_size : int
+        Number of non-uniform windows that are fit at once, limits memory use
     Returns
     -------
     np.array
@@ -114,70 +120,43 @@ def non_uniform_savgol(x, y, window, polynom):
     if polynom >= window:
         raise ValueError('"polynom" must be less than "window"')
 
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
     half_window = window // 2
-    polynom += 1
-
-    # Initialize variables
-    A = np.empty((window, polynom))  # Matrix
-    tA = np.empty((polynom, window))  # Transposed matrix
-    t = np.empty(window)  # Local x variables
-    y_smoothed = np.full(len(y), np.nan)
-
-    # Start smoothing
-    for i in range(half_window, len(x) - half_window, 1):
-        # Center a window of x values on x[i]
-        for j in range(0, window, 1):
-            t[j] = x[i + j - half_window] - x[i]
-
-        # Create the initial matrix A and its transposed form tA
-        for j in range(0, window, 1):
-            r = 1.0
-            for k in range(0, polynom, 1):
-                A[j, k] = r
-                tA[k, j] = r
-                r *= t[j]
-
-        # Multiply the two matrices
-        tAA = np.matmul(tA, A)
-
-        # Invert the product of the matrices
-        tAA = np.linalg.inv(tAA)
-
-        # Calculate the pseudoinverse of the design matrix
-        coeffs = np.matmul(tAA, tA)
-
-        # Calculate c0 which is also the y value for y[i]
-        y_smoothed[i] = 0
-        for j in range(0, window, 1):
-            y_smoothed[i] += coeffs[0, j] * y[i + j - half_window]
-
-        # If at the end or beginning, store all coefficients for the polynom
-        if i == half_window:
-            first_coeffs = np.zeros(polynom)
-            for j in range(0, window, 1):
-                for k in range(polynom):
-                    first_coeffs[k] += coeffs[k, j] * y[j]
-        elif i == len(x) - half_window - 1:
-            last_coeffs = np.zeros(polynom)
-            for j in range(0, window, 1):
-                for k in range(polynom):
-                    last_coeffs[k] += coeffs[k, j] * y[len(y) - window + j]
-
-    # Interpolate the result at the left border
-    for i in range(0, half_window, 1):
-        y_smoothed[i] = 0
-        x_i = 1
-        for j in range(0, polynom, 1):
-            y_smoothed[i] += first_coeffs[j] * x_i
-            x_i *= x[i] - x[half_window]
-
-    # Interpolate the result at the right border
-    for i in range(len(x) - half_window, len(x), 1):
-        y_smoothed[i] = 0
-        x_i = 1
-        for j in range(0, polynom, 1):
-            y_smoothed[i] += last_coeffs[j] * x_i
-            x_i *= x[i] - x[-half_window - 1]
+    if half_window == 0:
+        return y.copy()
+
+    # Windows (n - window + 1, window) centered on x[half_window:-half_window]
+    x_win = sliding_window_view(x, window)
+    y_win = sliding_window_view(y, window)
+
+    def fit_polynomials(inds):
+        # Least squares polynomial fit of the windows inds, with x relative to the window center
+        # and scaled to [-1, 1] for numerical stability. The normal equations are built from the
+        # power sums of the local x values (tA @ A is a Hankel matrix of them).
+        t = x_win[inds] - x_win[inds, half_window][:, None]
+        scale = np.max(np.abs(t), axis=1, keepdims=True)
+        t_pow = np.ones((inds.size, 2 * polynom + 1, window))  # powers of local x per window
+        for k in range(1, 2 * polynom + 1):
+            t_pow[:, k] = t_pow[:, k - 1] * (t / scale)
+        power_sums = np.sum(t_pow, axis=2)
+        tAA = power_sums[:, np.add.outer(np.arange(polynom + 1), np.arange(polynom + 1))]
+        tAy = np.einsum('nkj,nj->nk', t_pow[:, :polynom + 1], y_win[inds])
+        return np.linalg.solve(tAA, tAy[:, :, None])[:, :, 0], scale[:, 0]
+
+    # Windows with uniform spacing are identical to the regular Savitzky-Golay filter
+    y_smoothed = savgol_filter(y, window, polynom, mode='interp')
+    dx = sliding_window_view(np.diff(x), window - 1)
+    non_uniform = np.where(~np.isclose(np.min(dx, axis=1), np.max(dx, axis=1)))[0]
+    for start in range(0, non_uniform.size, chunk_size):
+        inds = non_uniform[start:start + chunk_size]
+        y_smoothed[inds + half_window] = fit_polynomials(inds)[0][:, 0]
+
+    # Interpolate the borders with the polynomials of the first and last window
+    coeffs, scale = fit_polynomials(np.array([0, x_win.shape[0] - 1]))
+    t = (x[:half_window] - x[half_window]) / scale[0]
+    y_smoothed[:half_window] = t[:, None] ** np.arange(polynom + 1) @ coeffs[0]
+    t = (x[-half_window:] - x[-half_window - 1]) / scale[1]
+    y_smoothed[-half_window:] = t[:, None] ** np.arange(polynom + 1) @ coeffs[1]
 
     return y_smoothed
 
@@ -12,23 +12,28 @@ import matplotlib.pyplot as plt
 from sklearn.utils import shuffle
 import pandas as pd
 import tkinter as tk
-from scipy.stats import binned_statistic
-from scipy.signal import gaussian, convolve
+from scipy.stats import zscore, rankdata, t as t_dist
+from scipy.signal import gaussian, find_peaks
+from scipy.ndimage import convolve1d
 import pathlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import patsy
 import statsmodels.api as sm
 from brainbox import singlecell
-from brainbox.core import TimeSeries
-from brainbox.processing import sync
 from sklearn.model_selection import KFold
-from os.path import join, realpath, dirname, isfile
+from os import makedirs
+from os.path import join, realpath, dirname, basename, isfile, getmtime
 from glob import glob
 from datetime import datetime
 import json
+import hashlib
+import sqlite3
+import time
 from brainbox.io.spikeglx import spikeglx
 from brainbox.metrics.single_units import spike_sorting_metrics
 from brainbox.io.one import SpikeSortingLoader
 from iblutil.numerical import ismember
+from iblutil.util import Bunch
 from ibllib.io.extractors.ephys_fpga import get_sync_and_chn_map
 from ibllib.io.extractors.camera import CameraTimestampsFPGA
 from ibllib.atlas import BrainRegions
@@ -49,6 +54,37 @@ DATE_OPTO_RAMP = '2022-02-14'
 N_STATES = {'Frontal': 10, 'Sensory': 8, 'Hippocampus': 9, 'Striatum': 6, 'Thalamus': 7,
             'Midbrain': 8, 'Amygdala': 8}
 
+# Number of (trial, cluster, bin) elements that calculate_peths bins and smooths at a time
+PETH_BLOCK_ELEMENTS = 2 ** 22
+
+# Version of the local spike cache format, bump this to rebuild all cached insertions
+SPIKE_CACHE_VERSION = 1
+
+# Version of the local face feature store format, bump this to rebuild all stored sessions
+FACE_FEATURE_VERSION = 1
+
+# Version of the local trials store format, bump this to load all sessions from ONE again
+TRIALS_STORE_VERSION = 2
+
+# Artifact neuron index, loaded on first use by load_artifact_index
+_ARTIFACT_INDEX = None
+
+# Version of the region lookup table, bump this after changing how regions are mapped
+REGION_TABLE_VERSION = 1
+
+# Region lookup tables, loaded on first use by load_region_table and combine_regions
+_REGION_TABLE = None
+_COMBINED_REGION_LOOKUP = dict()
+
+# Version of the format of the extracted laser pulse times, bump this to extract all sessions again
+OPTO_TIMES_VERSION = 1
+
+# Hours after which the local session catalog is refreshed from Alyx
+SESSION_CATALOG_TTL = 24
+
+# Insertions of the project that pass session QC, the local session catalog is a snapshot of these
+EPHYS_INSERTION_QUERY = 'session__project__name__icontains,serotonin_inference,session__qc__lt,50'
+
 
 def load_subjects(anesthesia='all', behavior=None):
     assert anesthesia in ['no', 'yes', 'both', 'all', 'no&both']
@@ -191,120 +227,343 @@ def figure_style():
     return colors, dpi
 
 
+def _artifact_neurons_file():
+    return join(pathlib.Path(__file__).parent.resolve(), 'artifact_neurons.csv')
+
+
+def load_artifact_index():
+    """
+    Load the artifact neurons once per process, the index is reloaded when artifact_neurons.csv
+    is edited.
+
+    Returns
+    -------
+    artifact_index : Bunch
+        table : DataFrame with the contents of artifact_neurons.csv
+        pid : dict mapping each pid to a sorted int32 array of its artifact neuron ids
+        pids, sessions : Index of the pids and MultiIndex of the (subject, date, probe)
+                         combinations that have artifact neurons
+        pid_keys, session_keys : sorted int64 arrays of packed (pid, neuron_id) and
+                                 (session, neuron_id) keys
+    """
+    global _ARTIFACT_INDEX
+    file_path = _artifact_neurons_file()
+    mtime = getmtime(file_path)
+    if (_ARTIFACT_INDEX is not None) and (_ARTIFACT_INDEX['mtime'] == mtime):
+        return _ARTIFACT_INDEX
+
+    table = pd.read_csv(file_path)
+    table['date'] = table['date'].astype(str)
+    neuron_ids = table['neuron_id'].values.astype(np.int64)
+    pid_codes, pids = pd.factorize(table['pid'])
+    session_codes, sessions = pd.MultiIndex.from_frame(
+        table[['subject', 'date', 'probe']]).factorize()
+    _ARTIFACT_INDEX = Bunch(
+        mtime=mtime, table=table, pids=pd.Index(pids), sessions=sessions,
+        pid={pid: np.sort(neuron_ids[pid_codes == p]).astype(np.int32)
+             for p, pid in enumerate(pids)},
+        pid_keys=np.sort((pid_codes.astype(np.int64) << 32) | neuron_ids),
+        session_keys=np.sort((session_codes.astype(np.int64) << 32) | neuron_ids))
+    return _ARTIFACT_INDEX
+
+
 def get_artifact_neurons():
-    artifact_neurons = pd.read_csv(join(pathlib.Path(__file__).parent.resolve(), 'artifact_neurons.csv'))
-    return artifact_neurons
+    return load_artifact_index()['table'].copy()
 
 
-def remove_artifact_neurons(df):
-    artifact_neurons = pd.read_csv(join(pathlib.Path(__file__).parent.resolve(), 'artifact_neurons.csv'))
-    for i, column in enumerate(df.columns):
-        if df[column].dtype == bool:
-            df[column] = df[column].astype('boolean')
+def _in_sorted(keys, sorted_keys):
+    if sorted_keys.size == 0:
+        return np.zeros(keys.shape, dtype=bool)
+    idx = np.searchsorted(sorted_keys, keys).clip(max=sorted_keys.size - 1)
+    return sorted_keys[idx] == keys
+
+
+def is_artifact(pid, cluster_ids):
+    """
+    Vectorized check of which clusters of an insertion are artifact neurons
+
+    :param pid: probe insertion id
+    :param cluster_ids: array of cluster ids
+    :return: boolean array of the same shape as cluster_ids
+    """
+    artifact_ids = load_artifact_index()['pid'].get(pid, np.array([], dtype=np.int32))
+    return _in_sorted(np.asarray(cluster_ids), artifact_ids)
+
+
+def artifact_neuron_mask(df):
+    """
+    Boolean mask of the rows of a neuron dataframe that are artifact neurons. Rows are matched
+    on pid and neuron_id, or on subject, date, probe and neuron_id if there is no pid column.
+    """
+    artifact_index = load_artifact_index()
     if 'pid' in df.columns:
-        df = pd.merge(df, artifact_neurons, indicator=True, how='outer',
-                      on=['pid', 'neuron_id', 'subject', 'probe', 'date']).query('_merge=="left_only"').drop('_merge', axis=1)
+        codes = artifact_index['pids'].get_indexer(df['pid'])
+        sorted_keys = artifact_index['pid_keys']
     else:
-        df = pd.merge(df, artifact_neurons, indicator=True, how='outer',
-                      on=['subject', 'probe', 'date', 'neuron_id']).query('_merge=="left_only"').drop('_merge', axis=1)
-    return df
+        codes = artifact_index['sessions'].get_indexer(pd.MultiIndex.from_arrays(
+            [df['subject'], df['date'].astype(str), df['probe']]))
+        sorted_keys = artifact_index['session_keys']
+    keys = (codes.astype(np.int64) << 32) | df['neuron_id'].values.astype(np.int64)
+    return (codes >= 0) & _in_sorted(keys, sorted_keys)
 
 
-def query_opto_sessions(subject, include_ephys=False, one=None):
-    one = one or ONE()
+def remove_artifact_neurons(df):
+    return df[~artifact_neuron_mask(df)].reset_index(drop=True)
+
+
+def _session_catalog(refresh=False, offline=False):
+    """
+    Open the local snapshot of the session catalog (SQLite), the snapshots table keeps track of
+    when each part of the catalog was last fetched from Alyx
+    """
+    if refresh and offline:
+        raise ValueError('refresh and offline can not both be True')
+    _, save_path = paths()
+    con = sqlite3.connect(join(save_path, 'session_catalog.db'))
+    con.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, created REAL)')
+    return con
+
+
+def _snapshot_needs_update(con, name, refresh, offline):
+    created = con.execute('SELECT created FROM snapshots WHERE name = ?', (name,)).fetchone()
+    if offline:
+        if created is None:
+            raise FileNotFoundError(f'No local snapshot of {name}, run once with offline=False')
+        return False
+    return (refresh or (created is None)
+            or (time.time() - created[0] > SESSION_CATALOG_TTL * 3600))
+
+
+def _update_snapshot(con, name, fetch, one, acronym=None):
+    """
+    Fetch a part of the catalog from Alyx and store it, if Alyx can not be reached an
+    existing (outdated) snapshot is used. The insertions of an acronym replace only the stored
+    insertions of that acronym.
+    """
+    try:
+        tables = fetch(one or ONE())
+    except Exception as err:
+        if con.execute('SELECT 1 FROM snapshots WHERE name = ?', (name,)).fetchone() is None:
+            raise
+        print(f'Could not refresh {name} from Alyx, using local snapshot ({err})')
+        return
+    with con:
+        for table, (df, index_columns) in tables.items():
+            if table == 'insertion_acronyms':
+                con.execute('CREATE TABLE IF NOT EXISTS insertion_acronyms (acronym TEXT, pid TEXT)')
+                con.execute('DELETE FROM insertion_acronyms WHERE acronym = ?', (acronym,))
+                df.to_sql(table, con, if_exists='append', index=False)
+            else:
+                df.to_sql(table, con, if_exists='replace', index=False)
+            for column in index_columns:
+                con.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})')
+        con.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?)', (name, time.time()))
+
+
+def _fetch_ephys_insertions(one, con):
+    """
+    Fetch the ephys insertions and whether they are aligned and their session meets the
+    behavior criterion. The sessions that are already in the catalog keep their stored number
+    of trials, only new sessions are read from Alyx one by one.
+    """
+    ins = one.alyx.rest('insertions', 'list', django=EPHYS_INSERTION_QUERY)
+    aligned = {i['id'] for i in one.alyx.rest(
+        'insertions', 'list',
+        django=EPHYS_INSERTION_QUERY + ',json__extended_qc__alignment_count__gt,0')}
+    behavior = {i['session'] for i in one.alyx.rest(
+        'insertions', 'list',
+        django=EPHYS_INSERTION_QUERY + ',session__extended_qc__behavior,1')}
+    insertions = pd.DataFrame(data={
+        'rank': np.arange(len(ins)), 'pid': [i['id'] for i in ins],
+        'eid': [i['session'] for i in ins], 'probe': [i['name'] for i in ins],
+        'subject': [i['session_info']['subject'] for i in ins],
+        'date': [i['session_info']['start_time'][:10] for i in ins],
+        'aligned': [i['id'] in aligned for i in ins]})
+    stored = dict()
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                   "AND name = 'ephys_sessions'").fetchone() is not None:
+        stored = {sess[0]: sess for sess in con.execute(
+            'SELECT eid, task_protocol, n_trials, qc FROM ephys_sessions '
+            'WHERE n_trials IS NOT NULL')}
+    for eid in np.unique(insertions['eid']):
+        if eid not in stored:
+            sess = one.alyx.rest('sessions', 'read', id=eid)
+            stored[eid] = (eid, sess.get('task_protocol'), sess.get('n_trials'),
+                           str(sess.get('qc')))
+    sessions = pd.DataFrame(data=[stored[eid] for eid in np.unique(insertions['eid'])],
+                            columns=['eid', 'task_protocol', 'n_trials', 'qc'])
+    sessions['behavior'] = sessions['eid'].isin(behavior).astype(int)
+    return {'insertions': (insertions, ['pid', 'eid', 'subject']),
+            'ephys_sessions': (sessions, ['eid'])}
+
+
+def _fetch_opto_sessions(one):
+    sessions = one.alyx.rest('sessions', 'list', task_protocol='_iblrig_tasks_opto_')
+    sessions = pd.DataFrame(data={
+        'rank': np.arange(len(sessions)), 'eid': [sess['url'][-36:] for sess in sessions],
+        'subject': [sess['subject'] for sess in sessions],
+        'task_protocol': [sess.get('task_protocol') or '' for sess in sessions],
+        'date': [sess['start_time'][:10] for sess in sessions]})
+    return {'opto_sessions': (sessions, ['subject'])}
+
+
+def query_opto_sessions(subject, include_ephys=False, one=None, refresh=False, offline=False):
+    """
+    Get the eids of the optogenetics behavior sessions of a subject from the local session
+    catalog, which is refreshed from Alyx when it is older than SESSION_CATALOG_TTL hours.
+
+    :param refresh: fetch the catalog from Alyx regardless of its age
+    :param offline: only use the local catalog, never connect to Alyx
+    """
+    con = _session_catalog(refresh=refresh, offline=offline)
+    if _snapshot_needs_update(con, 'opto_sessions', refresh, offline):
+        _update_snapshot(con, 'opto_sessions', _fetch_opto_sessions, one)
     if include_ephys:
-        sessions = one.alyx.rest('sessions', 'list', subject=subject,
-                                 task_protocol='_iblrig_tasks_opto_')
+        protocol = '_iblrig_tasks_opto_'
     else:
-        sessions = one.alyx.rest('sessions', 'list', subject=subject,
-                                 task_protocol='_iblrig_tasks_opto_biasedChoiceWorld')
-    return [sess['url'][-36:] for sess in sessions]
+        protocol = '_iblrig_tasks_opto_biasedChoiceWorld'
+    eids = con.execute('SELECT eid FROM opto_sessions WHERE subject = ? '
+                       'AND instr(lower(task_protocol), lower(?)) > 0 ORDER BY rank',
+                       (subject, protocol)).fetchall()
+    con.close()
+    return [eid[0] for eid in eids]
 
 
 def query_ephys_sessions(aligned=True, behavior_crit=False, n_trials=0, anesthesia='no',
-                         acronym=None, one=None):
-    assert anesthesia in ['no', 'both', 'yes', 'all', 'no&both']
-    if one is None:
-        one = ONE()
+                         acronym=None, one=None, refresh=False, offline=False):
+    """
+    Get the insertions of the ephys sessions from the local session catalog, which is refreshed
+    from Alyx when it is older than SESSION_CATALOG_TTL hours. Insertions in a brain region
+    (acronym) are fetched once per acronym and then also kept in the catalog.
 
-    # Construct django query string
-    DJANGO_STR = ('session__project__name__icontains,serotonin_inference,'
-                 'session__qc__lt,50')
+    :param refresh: fetch the catalog from Alyx regardless of its age
+    :param offline: only use the local catalog, never connect to Alyx
+    """
+    assert anesthesia in ['no', 'both', 'yes', 'all', 'no&both']
+    con = _session_catalog(refresh=refresh, offline=offline)
+    if _snapshot_needs_update(con, 'insertions', refresh, offline):
+        _update_snapshot(con, 'insertions', lambda one: _fetch_ephys_insertions(one, con), one)
+
+    # Construct query
+    query = ('SELECT i.pid, i.eid, i.probe, i.subject, i.date FROM insertions i '
+             'JOIN ephys_sessions s ON i.eid = s.eid WHERE 1')
+    params = []
     if aligned:
-        # Query all ephys-histology aligned sessions
-        DJANGO_STR += ',json__extended_qc__alignment_count__gt,0'
-
+        # Only ephys-histology aligned insertions
+        query += ' AND i.aligned'
     if behavior_crit:
-        # Query sessions with an alignment and that meet behavior criterion
-        DJANGO_STR += ',session__extended_qc__behavior,1'
-
-    # Query sessions with at least this many trials
+        # Only sessions that meet the behavior criterion
+        query += ' AND s.behavior = 1'
     if n_trials > 0:
-        DJANGO_STR += f',session__n_trials__gte,{n_trials}'
-
-    # Query sessions
-    if acronym is None:
-        ins = one.alyx.rest('insertions', 'list', django=DJANGO_STR)
-    elif type(acronym) is str:
-        ins = one.alyx.rest('insertions', 'list', django=DJANGO_STR, atlas_acronym=acronym)
-    else:
-        ins = []
-        for i, ac in enumerate(acronym):
-            ins = ins + one.alyx.rest('insertions', 'list', django=DJANGO_STR, atlas_acronym=ac)
+        # Only sessions with at least this many trials
+        query += ' AND s.n_trials >= ?'
+        params.append(n_trials)
+    if acronym is not None:
+        acronyms = [acronym] if type(acronym) is str else list(acronym)
+        for ac in acronyms:
+            if _snapshot_needs_update(con, f'acronym:{ac}', refresh, offline):
+                _update_snapshot(con, f'acronym:{ac}', lambda one: {'insertion_acronyms': (
+                    pd.DataFrame(data={'acronym': ac, 'pid': [i['id'] for i in one.alyx.rest(
+                        'insertions', 'list', django=EPHYS_INSERTION_QUERY, atlas_acronym=ac)]},
+                        dtype=str), ['acronym'])}, one, acronym=ac)
+        query += (' AND i.pid IN (SELECT pid FROM insertion_acronyms WHERE acronym IN '
+                  f'({",".join("?" * len(acronyms))}))')
+        params += acronyms
+    rec = pd.read_sql_query(query + ' ORDER BY i.rank', con, params=params)
+    con.close()
 
     # Only include subjects from subjects.csv
     incl_subjects = load_subjects(anesthesia=anesthesia)
-    ins = [i for i in ins if i['session_info']['subject'] in incl_subjects['subject'].values]
-
-    # Get list of eids and probes
-    rec = pd.DataFrame()
-    rec['pid'] = np.array([i['id'] for i in ins])
-    rec['eid'] = np.array([i['session'] for i in ins])
-    rec['probe'] = np.array([i['name'] for i in ins])
-    rec['subject'] = np.array([i['session_info']['subject'] for i in ins])
-    rec['date'] = np.array([i['session_info']['start_time'][:10] for i in ins])
+    rec = rec[np.isin(rec['subject'], incl_subjects['subject'].values)]
     rec = rec.drop_duplicates('pid', ignore_index=True)
     return rec
 
 
-def load_trials(eid, laser_stimulation=False, invert_choice=False, invert_stimside=False,
-                patch_old_opto=False, one=None):
-    one = one or ONE()
+def _trials_store_path(eid):
+    _, save_path = paths()
+    return join(save_path, 'TrialsStore', f'eid={eid}', f'trials_v{TRIALS_STORE_VERSION}.pqt')
+
+
+def _derive_trial_columns(trials, laser_stimulation=None, laser_probability=None):
+    """
+    Add the derived columns to a trials dataframe: signed contrast, laser columns (if laser data
+    is given), correct, right choice, stimulus side and reaction times
+    """
+    contrast_left = trials['contrastLeft'].values
+    contrast_right = trials['contrastRight'].values
+    signed_contrast = np.where(np.isnan(contrast_right), -contrast_left, contrast_right)
+    trials['signed_contrast'] = signed_contrast
+    if laser_stimulation is not None:
+        trials['laser_stimulation'] = laser_stimulation
+        if laser_probability is not None:
+            trials['laser_probability'] = laser_probability
+            trials['probe_trial'] = (
+                ((laser_stimulation == 0) & (laser_probability == 0.75))
+                | ((laser_stimulation == 1) & (laser_probability == 0.25))).astype(int)
+        else:
+            zero_contrast = signed_contrast == 0
+            trials['laser_probability'] = np.select([zero_contrast & (laser_stimulation == 0),
+                                                     zero_contrast & (laser_stimulation == 1)],
+                                                    [0.25, 0.75], default=laser_stimulation)
+
+    feedback_type = trials['feedbackType'].values
+    trials['correct'] = np.where(feedback_type == -1, 0, feedback_type)
+    right_choice = -trials['choice'].values
+    trials['right_choice'] = np.where(right_choice == -1, 0, right_choice)
+    zero_contrast = signed_contrast == 0
+    trials['stim_side'] = np.select([zero_contrast & np.isnan(contrast_right),
+                                     zero_contrast & np.isnan(contrast_left), signed_contrast > 0],
+                                    [-1, 1, 1], default=-1)
+    trials['reaction_times'] = trials['firstMovement_times'].values - trials['goCue_times'].values
+    return trials
 
+
+def _fetch_trials(eid, one):
+    """
+    Load the trials of a session from ONE, derive the trial columns and save them in the trials
+    store. Returns None if the session has no trials.
+    """
     data = one.load_object(eid, 'trials')
-    data = {your_key: data[your_key] for your_key in [
+    trials = pd.DataFrame(data={your_key: data[your_key] for your_key in [
         'stimOn_times', 'feedback_times', 'goCue_times', 'probabilityLeft', 'contrastLeft',
-        'contrastRight', 'feedbackType', 'choice', 'firstMovement_times']}
-    trials = pd.DataFrame(data=data)
+        'contrastRight', 'feedbackType', 'choice', 'firstMovement_times']})
     if trials.shape[0] == 0:
         return
-    trials['signed_contrast'] = trials['contrastRight']
-    trials.loc[trials['signed_contrast'].isnull(), 'signed_contrast'] = -trials['contrastLeft']
-    if laser_stimulation:
-        trials['laser_stimulation'] = one.load_dataset(eid, dataset='_ibl_trials.laserStimulation.npy')
-        try:
-            trials['laser_probability'] = one.load_dataset(eid, dataset='_ibl_trials.laserProbability.npy')
-            trials['probe_trial'] = ((trials['laser_stimulation'] == 0) & (trials['laser_probability'] == 0.75)
-                                     | (trials['laser_stimulation'] == 1) & (trials['laser_probability'] == 0.25)).astype(int)
-        except:
-            trials['laser_probability'] = trials['laser_stimulation'].copy()
-            trials.loc[(trials['signed_contrast'] == 0)
-                       & (trials['laser_stimulation'] == 0), 'laser_probability'] = 0.25
-            trials.loc[(trials['signed_contrast'] == 0)
-                       & (trials['laser_stimulation'] == 1), 'laser_probability'] = 0.75
-
-    trials['correct'] = trials['feedbackType']
-    trials.loc[trials['correct'] == -1, 'correct'] = 0
-    trials['right_choice'] = -trials['choice']
-    trials.loc[trials['right_choice'] == -1, 'right_choice'] = 0
-    trials['stim_side'] = (trials['signed_contrast'] > 0).astype(int)
-    trials.loc[trials['stim_side'] == 0, 'stim_side'] = -1
-    trials.loc[(trials['signed_contrast'] == 0) & (trials['contrastLeft'].isnull()),
-               'stim_side'] = 1
-    trials.loc[(trials['signed_contrast'] == 0) & (trials['contrastRight'].isnull()),
-               'stim_side'] = -1
-    if 'firstMovement_times' in trials.columns.values:
-        trials['reaction_times'] = trials['firstMovement_times'] - trials['goCue_times']
+    try:
+        laser_stimulation = one.load_dataset(eid, dataset='_ibl_trials.laserStimulation.npy')
+    except Exception:
+        laser_stimulation = None
+    try:
+        laser_probability = one.load_dataset(eid, dataset='_ibl_trials.laserProbability.npy')
+    except Exception:
+        laser_probability = None
+    trials = _derive_trial_columns(trials, laser_stimulation, laser_probability)
+    details = one.get_details(eid)
+    trials['session_subject'] = details['subject']
+    trials['session_date'] = details['start_time'][:10]
+    makedirs(dirname(_trials_store_path(eid)), exist_ok=True)
+    trials.to_parquet(_trials_store_path(eid))
+    return trials
+
+
+def _load_stored_trials(eid, one, force_rerun=False):
+    if isfile(_trials_store_path(eid)) and not force_rerun:
+        return pd.read_parquet(_trials_store_path(eid))
+    return _fetch_trials(eid, one)
+
+
+def _select_trials(trials, eid, laser_stimulation=False, invert_choice=False,
+                   invert_stimside=False, patch_old_opto=False):
+    """
+    Turn a trials dataframe from the trials store into the output of load_trials
+    """
+    ses_date = datetime.strptime(trials['session_date'].values[0], '%Y-%m-%d')
+    trials = trials.drop(columns=['session_subject', 'session_date'])
+    if laser_stimulation and ('laser_stimulation' not in trials.columns):
+        raise KeyError(f'Session {eid} has no laser stimulation dataset')
+    elif not laser_stimulation:
+        trials = trials.drop(columns=['laser_stimulation', 'laser_probability', 'probe_trial'],
+                             errors='ignore')
     if invert_choice:
         trials['choice'] = -trials['choice']
     if invert_stimside:
@@ -312,7 +571,6 @@ def load_trials(eid, laser_stimulation=False, invert_choice=False, invert_stimsi
         trials['signed_contrast'] = -trials['signed_contrast']
 
     # Patch datasets that contained a bug in the laser driver code
-    ses_date = datetime.strptime(one.get_details(eid)['start_time'][:10], '%Y-%m-%d')
     if ((ses_date < datetime.strptime(DATE_GOOD_OPTO, '%Y-%m-%d'))
             and patch_old_opto and laser_stimulation):
 
@@ -325,114 +583,284 @@ def load_trials(eid, laser_stimulation=False, invert_choice=False, invert_stimsi
     return trials
 
 
+def load_trials(eid, laser_stimulation=False, invert_choice=False, invert_stimside=False,
+                patch_old_opto=False, one=None, force_rerun=False):
+    """
+    Load the trials of a session, the trials are read from the local trials store and loaded from
+    ONE (and added to the store) the first time a session is requested or when force_rerun is True
+    """
+    one = one or ONE()
+    trials = _load_stored_trials(eid, one, force_rerun=force_rerun)
+    if trials is None:
+        return
+    return _select_trials(trials, eid, laser_stimulation=laser_stimulation,
+                          invert_choice=invert_choice, invert_stimside=invert_stimside,
+                          patch_old_opto=patch_old_opto)
+
+
+def load_trials_bulk(eids, laser_stimulation=False, invert_choice=False, invert_stimside=False,
+                     patch_old_opto=False, one=None, force_rerun=False, n_threads=None):
+    """
+    Load the trials of many sessions at once. Sessions that are not in the trials store yet are
+    loaded from ONE in parallel threads (this is I/O bound) and added to the store.
+
+    Parameters
+    ----------
+    eids : list
+        List of eids
+    n_threads : int
+        Number of threads, None uses the default of ThreadPoolExecutor
+    Other parameters are passed to load_trials
+
+    Returns
+    -------
+    trials : dict
+        Trials dataframe per eid in the order of eids, sessions without (loadable) trials are left
+        out
+    """
+    one = one or ONE()
+
+    def load_session(eid):
+        try:
+            return load_trials(eid, laser_stimulation=laser_stimulation,
+                               invert_choice=invert_choice, invert_stimside=invert_stimside,
+                               patch_old_opto=patch_old_opto, one=one, force_rerun=force_rerun)
+        except Exception as err:
+            print(f'Could not load trials for {eid} ({err})')
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        all_trials = list(executor.map(load_session, eids))
+    return {eid: trials for eid, trials in zip(eids, all_trials) if trials is not None}
+
+
+def _region_table_file():
+    _, save_path = paths()
+    return join(save_path, f'region_table_v{REGION_TABLE_VERSION}.pqt')
+
+
+def _build_region_table(br):
+    """
+    For every mapping of the atlas used as source, map all the acronyms that are in that mapping
+    to the acronyms of all mappings. The full name and the high level region are added as well.
+    """
+    acronyms, first_rows = np.unique(br.acronym, return_index=True)
+    ids = br.acronym2id(acronyms)
+    region_table = []
+    for source in br.mappings.keys():
+        found, inds = ismember(ids, br.id[br.mappings[source]])
+        source_df = pd.DataFrame(data={'source': source, 'acronym': acronyms[found],
+                                       'id': ids[found], 'name': br.name[first_rows[found]]})
+        for dest, mapping in br.mappings.items():
+            source_df[dest] = br.acronym[mapping[inds]]
+        region_table.append(source_df)
+    region_table = pd.concat(region_table, ignore_index=True)
+
+    # High level regions take Allen acronyms as input
+    first_level_regions = combine_regions(region_table['Beryl'].values, abbreviate=True)
+    for column, merge_cortex in zip(['high_level', 'high_level_merge_cortex'], [False, True]):
+        regions = np.array(['root'] * region_table.shape[0], dtype=object)
+        if merge_cortex:
+            regions[region_table['Cosmos'] == 'Isocortex'] = 'Cortex'
+            regions[first_level_regions == 'Pir'] = 'Cortex'
+        else:
+            regions[np.in1d(first_level_regions, ['mPFC', 'OFC', 'M2'])] = 'Frontal'
+            regions[np.in1d(first_level_regions, ['Pir', 'BC', 'VISa/am'])] = 'Sensory'
+        regions[region_table['Cosmos'] == 'MB'] = 'Midbrain'
+        regions[region_table['Cosmos'] == 'HPF'] = 'Hippocampus'
+        regions[region_table['Cosmos'] == 'TH'] = 'Thalamus'
+        regions[np.in1d(first_level_regions, ['Amyg'])] = 'Amygdala'
+        regions[np.in1d(region_table['acronym'], ['CP', 'ACB', 'FS'])] = 'Striatum'
+        regions[region_table['source'] != 'Allen'] = 'root'
+        region_table[column] = regions
+    return region_table
+
+
+def load_region_table(brainregions=None):
+    """
+    Load the lookup table that maps the acronyms (or atlas ids) of every mapping of the atlas to
+    the other mappings, the full region name and the high level regions. The table is built once
+    from the atlas, saved to disk and kept in memory.
+
+    Returns
+    -------
+    region_table : Bunch
+        For every source mapping a Bunch with 'acronym' and 'id' (Index of the input acronyms and
+        atlas ids) and per output column an array of which the last element is the value for
+        inputs that are not in the atlas
+    """
+    global _REGION_TABLE
+    if _REGION_TABLE is not None:
+        return _REGION_TABLE
+    if isfile(_region_table_file()):
+        region_df = pd.read_parquet(_region_table_file())
+    else:
+        region_df = _build_region_table(brainregions or BrainRegions())
+        region_df.to_parquet(_region_table_file())
+    _REGION_TABLE = Bunch()
+    for source, source_df in region_df.groupby('source', sort=False):
+        _REGION_TABLE[source] = Bunch(acronym=pd.Index(source_df['acronym']),
+                                      id=pd.Index(source_df['id']))
+        for column in source_df.columns.drop(['source', 'acronym', 'id']):
+            _REGION_TABLE[source][column] = np.append(source_df[column].values.astype(object),
+                                                      'root')
+    return _REGION_TABLE
+
+
+def _region_table_rows(acronyms, source='Allen', brainregions=None):
+    """
+    Rows in the region table of the source mapping, acronyms can also be atlas ids. Returns -1
+    for acronyms that are not in the source mapping.
+    """
+    source_table = load_region_table(brainregions)[source]
+    acronyms = np.atleast_1d(np.asarray(acronyms))
+    if np.issubdtype(acronyms.dtype, np.number):
+        return source_table, source_table['id'].get_indexer(acronyms)
+    return source_table, source_table['acronym'].get_indexer(acronyms)
+
+
 def remap(acronyms, source='Allen', dest='Beryl', combine=False, split_thalamus=False,
           abbreviate=True, brainregions=None):
-    br = brainregions or BrainRegions()
-    _, inds = ismember(br.acronym2id(acronyms), br.id[br.mappings[source]])
-    remapped_acronyms = br.get(br.id[br.mappings[dest][inds]])['acronym']
+    """
+    Remap acronyms (or atlas ids) of the source mapping to the acronyms of the dest mapping,
+    acronyms that are not in the source mapping become 'root'
+    """
+    source_table, rows = _region_table_rows(acronyms, source, brainregions)
+    remapped_acronyms = np.take(source_table[dest], rows)
     if combine:
         return combine_regions(remapped_acronyms, split_thalamus=split_thalamus, abbreviate=abbreviate)
     else:
         return remapped_acronyms
 
 
+# Beryl regions that are combined into one region: (regions, abbreviation, full name)
+COMBINED_REGIONS = [
+    (['ILA', 'PL', 'ACAd', 'ACAv'], 'mPFC', 'Medial prefrontal cortex'),
+    (['MOs'], 'M2', 'Secondary motor cortex'),
+    (['ORBl', 'ORBm'], 'OFC', 'Orbitofrontal cortex'),
+    (['SCm', 'SCs', 'SCig', 'SCsg', 'SCdg'], 'SC', 'Superior colliculus'),
+    (['RSPv', 'RSPd'], 'RSP', 'Retrosplenial cortex'),
+    (['MRN'], 'MRN', 'Midbrain reticular nucleus'),
+    (['ZI'], 'ZI', 'Zona incerta'),
+    (['PAG'], 'PAG', 'Periaqueductal gray'),
+    (['SSp-bfd'], 'BC', 'Barrel cortex'),
+    #(['LGv', 'LGd'], 'LG', 'Lateral geniculate'),
+    (['PIR'], 'Pir', 'Piriform'),
+    #(['SNr', 'SNc', 'SNl'], 'SN', 'Substantia nigra'),
+    (['VISa', 'VISam', 'VISp', 'VISpm'], 'VIS', 'Visual cortex'),
+    (['MEA', 'CEA', 'BLA', 'COAa'], 'Amyg', 'Amygdala'),
+    (['AON', 'TTd', 'DP'], 'OLF', 'Olfactory areas'),
+    (['CP', 'STR', 'STRd', 'STRv'], 'Str', 'Tail of the striatum'),
+    (['CA1', 'CA3', 'DG'], 'Hipp', 'Hippocampus')]
+
+# Thalamic nuclei, combined into 'Thal' (Thalamus) unless the thalamus is split
+THALAMUS_REGIONS = ['PO', 'LP', 'LD', 'RT', 'VAL']
+
+
+def _combined_region_lookup(split_thalamus, abbreviate):
+    if (split_thalamus, abbreviate) not in _COMBINED_REGION_LOOKUP:
+        acronyms, regions = [], []
+        for region_acronyms, abbreviation, full_name in COMBINED_REGIONS:
+            acronyms += region_acronyms
+            regions += [abbreviation if abbreviate else full_name] * len(region_acronyms)
+        acronyms += THALAMUS_REGIONS
+        if split_thalamus:
+            regions += [i if abbreviate else f'Thalamus ({i})' for i in THALAMUS_REGIONS]
+        else:
+            regions += ['Thal' if abbreviate else 'Thalamus'] * len(THALAMUS_REGIONS)
+        _COMBINED_REGION_LOOKUP[(split_thalamus, abbreviate)] = (
+            pd.Index(acronyms), np.array(regions + ['root'], dtype=object))
+    return _COMBINED_REGION_LOOKUP[(split_thalamus, abbreviate)]
+
+
 def combine_regions(acronyms, split_thalamus=False, abbreviate=False):
     """
     Combines regions into groups, input Beryl atlas acronyms: use remap function first
     """
-    regions = np.array(['root'] * len(acronyms), dtype=object)
-    if abbreviate:
-        regions[np.in1d(acronyms, ['ILA', 'PL', 'ACAd', 'ACAv'])] = 'mPFC'
-        regions[np.in1d(acronyms, ['MOs'])] = 'M2'
-        regions[np.in1d(acronyms, ['ORBl', 'ORBm'])] = 'OFC'
-        if split_thalamus:
-            regions[np.in1d(acronyms, ['PO'])] = 'PO'
-            regions[np.in1d(acronyms, ['LP'])] = 'LP'
-            regions[np.in1d(acronyms, ['LD'])] = 'LD'
-            regions[np.in1d(acronyms, ['RT'])] = 'RT'
-            regions[np.in1d(acronyms, ['VAL'])] = 'VAL'
-        else:
-            regions[np.in1d(acronyms, ['PO', 'LP', 'LD', 'RT', 'VAL'])] = 'Thal'
-        regions[np.in1d(acronyms, ['SCm', 'SCs', 'SCig', 'SCsg', 'SCdg'])] = 'SC'
-        regions[np.in1d(acronyms, ['RSPv', 'RSPd'])] = 'RSP'
-        regions[np.in1d(acronyms, ['MRN'])] = 'MRN'
-        regions[np.in1d(acronyms, ['ZI'])] = 'ZI'
-        regions[np.in1d(acronyms, ['PAG'])] = 'PAG'
-        regions[np.in1d(acronyms, ['SSp-bfd'])] = 'BC'
-        #regions[np.in1d(acronyms, ['LGv', 'LGd'])] = 'LG'
-        regions[np.in1d(acronyms, ['PIR'])] = 'Pir'
-        #regions[np.in1d(acronyms, ['SNr', 'SNc', 'SNl'])] = 'SN'
-        regions[np.in1d(acronyms, ['VISa', 'VISam', 'VISp', 'VISpm'])] = 'VIS'
-        regions[np.in1d(acronyms, ['MEA', 'CEA', 'BLA', 'COAa'])] = 'Amyg'
-        regions[np.in1d(acronyms, ['AON', 'TTd', 'DP'])] = 'OLF'
-        regions[np.in1d(acronyms, ['CP', 'STR', 'STRd', 'STRv'])] = 'Str'
-        regions[np.in1d(acronyms, ['CA1', 'CA3', 'DG'])] = 'Hipp'
-    else:
-        regions[np.in1d(acronyms, ['ILA', 'PL', 'ACAd', 'ACAv'])] = 'Medial prefrontal cortex'
-        regions[np.in1d(acronyms, ['MOs'])] = 'Secondary motor cortex'
-        regions[np.in1d(acronyms, ['ORBl', 'ORBm'])] = 'Orbitofrontal cortex'
-        if split_thalamus:
-            regions[np.in1d(acronyms, ['PO'])] = 'Thalamus (PO)'
-            regions[np.in1d(acronyms, ['LP'])] = 'Thalamus (LP)'
-            regions[np.in1d(acronyms, ['LD'])] = 'Thalamus (LD)'
-            regions[np.in1d(acronyms, ['RT'])] = 'Thalamus (RT)'
-            regions[np.in1d(acronyms, ['VAL'])] = 'Thalamus (VAL)'
-        else:
-            regions[np.in1d(acronyms, ['PO', 'LP', 'LD', 'RT', 'VAL'])] = 'Thalamus'
-        regions[np.in1d(acronyms, ['SCm', 'SCs', 'SCig', 'SCsg', 'SCdg'])] = 'Superior colliculus'
-        regions[np.in1d(acronyms, ['RSPv', 'RSPd'])] = 'Retrosplenial cortex'
-        regions[np.in1d(acronyms, ['MRN'])] = 'Midbrain reticular nucleus'
-        regions[np.in1d(acronyms, ['AON', 'TTd', 'DP'])] = 'Olfactory areas'
-        regions[np.in1d(acronyms, ['ZI'])] = 'Zona incerta'
-        regions[np.in1d(acronyms, ['PAG'])] = 'Periaqueductal gray'
-        regions[np.in1d(acronyms, ['SSp-bfd'])] = 'Barrel cortex'
-        #regions[np.in1d(acronyms, ['LGv', 'LGd'])] = 'Lateral geniculate'
-        regions[np.in1d(acronyms, ['PIR'])] = 'Piriform'
-        #regions[np.in1d(acronyms, ['SNr', 'SNc', 'SNl'])] = 'Substantia nigra'
-        regions[np.in1d(acronyms, ['VISa', 'VISam', 'VISp', 'VISpm'])] = 'Visual cortex'
-        regions[np.in1d(acronyms, ['MEA', 'CEA', 'BLA', 'COAa'])] = 'Amygdala'
-        regions[np.in1d(acronyms, ['CP', 'STR', 'STRd', 'STRv'])] = 'Tail of the striatum'
-        regions[np.in1d(acronyms, ['CA1', 'CA3', 'DG'])] = 'Hippocampus'
-    return regions
+    combined_acronyms, regions = _combined_region_lookup(split_thalamus, abbreviate)
+    return np.take(regions, combined_acronyms.get_indexer(np.asarray(acronyms)))
 
 
 def high_level_regions(acronyms, merge_cortex=False):
     """
     Input Allen atlas acronyms
     """
-    first_level_regions = combine_regions(remap(acronyms), abbreviate=True)
-    cosmos_regions = remap(acronyms, dest='Cosmos')
-    regions = np.array(['root'] * len(first_level_regions), dtype=object)
-    if merge_cortex:
-        regions[cosmos_regions == 'Isocortex'] = 'Cortex'
-        regions[first_level_regions == 'Pir'] = 'Cortex'
-    else:
-        regions[np.in1d(first_level_regions, ['mPFC', 'OFC', 'M2'])] = 'Frontal'
-        regions[np.in1d(first_level_regions, ['Pir', 'BC', 'VISa/am'])] = 'Sensory'
-    regions[cosmos_regions == 'MB'] = 'Midbrain'
-    regions[cosmos_regions == 'HPF'] = 'Hippocampus'
-    regions[cosmos_regions == 'TH'] = 'Thalamus'
-    regions[np.in1d(first_level_regions, ['Amyg'])] = 'Amygdala'
-    regions[np.in1d(acronyms, ['CP', 'ACB', 'FS'])] = 'Striatum'
-    return regions
+    source_table, rows = _region_table_rows(acronyms)
+    return np.take(source_table['high_level_merge_cortex' if merge_cortex else 'high_level'], rows)
 
 
 def get_full_region_name(acronyms):
-    brainregions = BrainRegions()
-    full_region_names = []
-    for i, acronym in enumerate(acronyms):
-        try:
-            regname = brainregions.name[np.argwhere(brainregions.acronym == acronym).flatten()][0]
-            full_region_names.append(regname)
-        except IndexError:
-            full_region_names.append(acronym)
+    source_table, rows = _region_table_rows(acronyms)
+    full_region_names = np.where(rows >= 0, np.take(source_table['name'], rows),
+                                 np.atleast_1d(np.asarray(acronyms, dtype=object))).tolist()
     if len(full_region_names) == 1:
         return full_region_names[0]
     else:
         return full_region_names
 
 
-def load_passive_opto_times(eid, one=None, force_rerun=False, anesthesia=False):
+def _stream_opto_edges(sr, first_sample, last_sample, amp_channel=None, chunk_size=500,
+                       block_size=0.001):
+    """
+    Stream the analog sync channels of the NIDQ in chunks and detect the rising and falling edges
+    of the laser trace (analog channel 1). Every chunk is read only once for all channels and the
+    last sample of a chunk is carried over, so that edges at chunk borders are not lost.
+
+    Parameters
+    ----------
+    sr : spikeglx.Reader
+        Reader of the NIDQ file
+    first_sample, last_sample : int
+        Sample range to process
+    amp_channel : int
+        Analog channel of the laser amplitude, if given its maximum per block is returned
+    chunk_size : float
+        Size of the chunks in seconds
+    block_size : float
+        Size of the blocks (in seconds) over which the maximum amplitude is taken
+
+    Returns
+    on_samples, off_samples : 1D arrays
+        Sample index of the last sample before each rising and falling edge
+    amp_blocks : 1D array
+        Maximum amplitude per block starting at first_sample, None if amp_channel is None
+    """
+    chunk_samples = int(chunk_size * sr.fs)
+    block_samples = max(int(block_size * sr.fs), 1)
+    chunk_samples -= chunk_samples % block_samples  # chunk borders on block borders
+    on_samples, off_samples, amp_blocks = [], [], []
+    last_value = None
+    for start in range(first_sample, last_sample, chunk_samples):
+        end = min(start + chunk_samples, last_sample)
+        channels = [1] if amp_channel is None else [1, amp_channel]
+        chunk = sr.read_sync_analog(slice(start, end))[:, channels]
+
+        # Detect edges, including the one between the previous and this chunk
+        trace = chunk[:, 0] if last_value is None else np.concatenate(([last_value], chunk[:, 0]))
+        first_index = start if last_value is None else start - 1
+        trace_diff = np.diff(trace)
+        on_samples.append(np.where(trace_diff > 1)[0] + first_index)
+        off_samples.append(np.where(trace_diff < -1)[0] + first_index)
+        last_value = chunk[-1, 0]
+
+        if amp_channel is not None:
+            amp_blocks.append(np.maximum.reduceat(chunk[:, 1], np.arange(0, end - start,
+                                                                         block_samples)))
+
+    amp_blocks = np.concatenate(amp_blocks) if amp_channel is not None else None
+    return np.concatenate(on_samples), np.concatenate(off_samples), amp_blocks
+
+
+def _pulses_in_trains(on_times, train_times, train_duration=1):
+    """
+    Indices into on_times of the first and (one past) the last pulse in the window
+    [train time, train time + train_duration] of every train
+    """
+    return (np.searchsorted(on_times, train_times, side='left'),
+            np.searchsorted(on_times, train_times + train_duration, side='right'))
+
+
+def load_passive_opto_times(eid, one=None, force_rerun=False, anesthesia=False,
+                            return_off_times=False):
     """
     Load in the time stamps of the optogenetic stimulation at the end of the recording, after the
     taks and the spontaneous activity. Or when it's a long stimulation session with different
@@ -443,6 +871,8 @@ def load_passive_opto_times(eid, one=None, force_rerun=False, anesthesia=False):
         Timestamps of the start of each pulse train
     opto_pulse_times : 1D array
         Timestamps of all individual pulses
+    opto_off_times : 1D array
+        Timestamps of the end of each individual pulse, only if return_off_times is True
     """
 
     if one is None:
@@ -461,186 +891,477 @@ def load_passive_opto_times(eid, one=None, force_rerun=False, anesthesia=False):
     # Load in pulses from disk if already extracted
     _, save_path = paths()
     save_path = join(save_path, 'OptoTimes')
-    if isfile(join(save_path, f'{subject}_{date}_pulse_trains.npy')) & ~force_rerun & ~anesthesia:
-        opto_train_times = np.load(join(save_path, f'{subject}_{date}_pulse_trains.npy'))
-        opto_on_times = np.load(join(save_path, f'{subject}_{date}_ind_pulses.npy'))
-        return opto_train_times, opto_on_times
-    elif isfile(join(save_path, f'{subject}_{date}_pulse_trains_anesthesia.npy')) & ~force_rerun & anesthesia:
-        opto_train_times = np.load(join(save_path, f'{subject}_{date}_pulse_trains_anesthesia.npy'))
-        opto_on_times = np.load(join(save_path, f'{subject}_{date}_ind_pulses_anesthesia.npy'))
-        return opto_train_times, opto_on_times
+    cache_file = join(save_path, f'{subject}_{date}_opto_times'
+                                 + ('_anesthesia' if anesthesia else '') + '.npz')
+    if isfile(cache_file) and not force_rerun:
+        opto_times = np.load(cache_file)
+        if opto_times['version'] == OPTO_TIMES_VERSION:
+            if return_off_times:
+                return opto_times['train_times'], opto_times['on_times'], opto_times['off_times']
+            return opto_times['train_times'], opto_times['on_times']
+    no_pulses = ([], [], []) if return_off_times else ([], [])
+
+    # Load in laser pulses
+    try:
+        one.load_datasets(eid, datasets=[
+            '_spikeglx_ephysData_g0_t0.nidq.cbin', '_spikeglx_ephysData_g0_t0.nidq.meta',
+            '_spikeglx_ephysData_g0_t0.nidq.ch'], download_only=True)
+    except:
+        one.load_datasets(eid, datasets=[
+            '_spikeglx_ephysData_g1_t0.nidq.cbin', '_spikeglx_ephysData_g1_t0.nidq.meta',
+            '_spikeglx_ephysData_g1_t0.nidq.ch'], download_only=True)
+    session_path = one.eid2path(eid)
+    nidq_file = glob(str(session_path.joinpath('raw_ephys_data/_spikeglx_ephysData_g*_t0.nidq.cbin')))[-1]
+    sr = spikeglx.Reader(nidq_file)
+    if anesthesia_ses and not anesthesia:
+        offset = int(300 * sr.fs)
+        end = int(1020 * sr.fs)
     else:
-        # Load in laser pulses
-        try:
-            one.load_datasets(eid, datasets=[
-                '_spikeglx_ephysData_g0_t0.nidq.cbin', '_spikeglx_ephysData_g0_t0.nidq.meta',
-                '_spikeglx_ephysData_g0_t0.nidq.ch'], download_only=True)
-        except:
-            one.load_datasets(eid, datasets=[
-                '_spikeglx_ephysData_g1_t0.nidq.cbin', '_spikeglx_ephysData_g1_t0.nidq.meta',
-                '_spikeglx_ephysData_g1_t0.nidq.ch'], download_only=True)
-        session_path = one.eid2path(eid)
-        nidq_file = glob(str(session_path.joinpath('raw_ephys_data/_spikeglx_ephysData_g*_t0.nidq.cbin')))[-1]
-        sr = spikeglx.Reader(nidq_file)
-        if anesthesia_ses & ~anesthesia:
-            offset = int(300 * sr.fs)
-            end = int(1020 * sr.fs)
-            opto_trace = sr.read_sync_analog(slice(offset, end))[:, 1]
-            opto_times = np.arange(offset, end) / sr.fs
-        else:
-            offset = int((sr.shape[0] / sr.fs - 720) * sr.fs)
-            opto_trace = sr.read_sync_analog(slice(offset, sr.shape[0]))[:, 1]
-            opto_times = np.arange(offset, sr.shape[0]) / sr.fs
-
-        if np.sum(np.diff(opto_trace) > 1) == 0:
-            print(f'No pulses found for {eid}')
-            return [], []
-
-        # Get start times of pulse trains
-        opto_on_times = opto_times[np.concatenate((np.diff(opto_trace), [0])) > 1]
-
-        # Get the times of the onset of each pulse train
+        offset = int((sr.shape[0] / sr.fs - 720) * sr.fs)
+        end = sr.shape[0]
+    on_samples, off_samples, _ = _stream_opto_edges(sr, offset, end)
+    if on_samples.shape[0] == 0:
+        print(f'No pulses found for {eid}')
+        return no_pulses
+    opto_on_times, opto_off_times = on_samples / sr.fs, off_samples / sr.fs
+
+    # Get the times of the onset of each pulse train
+    opto_train_times = opto_on_times[np.concatenate(([True], np.diff(opto_on_times) > 1))]
+
+    # Get the stimulation frequencies from the pulses in the first second of each train
+    first_pulse, last_pulse = _pulses_in_trains(opto_on_times, opto_train_times)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        opto_freqs = ((last_pulse - first_pulse - 1)
+                      / (opto_on_times[last_pulse - 1] - opto_on_times[first_pulse]))
+    opto_freqs = opto_freqs - opto_freqs % 5  # round to 5
+    opto_freqs[opto_freqs == 0] = 1
+
+    # If there are different stimulation frequencies than 25 Hz it's a long stim session
+    if np.any(np.isin([1, 5, 10], opto_freqs)):
+        print('Long opto stim session detected, extracting 25 Hz pulse trains..')
+
+        # Stream the whole trace and only extract the 25Hz trains
+        block_size = 0.001
+        on_samples, off_samples, amp_blocks = _stream_opto_edges(sr, 0, sr.shape[0], amp_channel=3,
+                                                                 block_size=block_size)
+        opto_on_times, opto_off_times = on_samples / sr.fs, off_samples / sr.fs
         opto_train_times = opto_on_times[np.concatenate(([True], np.diff(opto_on_times) > 1))]
 
-        # Get the stimulation frequencies
-        opto_freqs = np.empty(opto_train_times.shape)
-        for i, t_time in enumerate(opto_train_times):
-            opto_freqs[i] = 1/np.mean(np.diff(opto_on_times[(opto_on_times >= t_time)
-                                                            & (opto_on_times <= t_time + 1)]))
+        # Get the stimulation frequencies (pulses in the first second) and amplitudes
+        first_pulse, last_pulse = _pulses_in_trains(opto_on_times, opto_train_times)
+        opto_freqs = (last_pulse - first_pulse).astype(float)
         opto_freqs = opto_freqs - opto_freqs % 5  # round to 5
         opto_freqs[opto_freqs == 0] = 1
+        block_samples = max(int(block_size * sr.fs), 1)
+        first_block = np.clip(np.floor(opto_train_times * sr.fs / block_samples).astype(int),
+                              0, amp_blocks.shape[0] - 1)
+        last_block = np.clip(np.floor((opto_train_times + 1) * sr.fs / block_samples).astype(int) + 1,
+                             first_block + 1, amp_blocks.shape[0])
+        opto_amps = np.maximum.reduceat(np.append(amp_blocks, 0),
+                                        np.column_stack((first_block, last_block)).ravel())[::2]
+        opto_amps = np.round(opto_amps * 2) / 2  # round to 0.5 or 1
+
+        # Keep the pulse trains of 25 Hz full power
+        keep_trains = (opto_freqs == 25) & (opto_amps == 1)
+        opto_train_times = opto_train_times[keep_trains]
+        first_pulse, last_pulse = first_pulse[keep_trains], last_pulse[keep_trains]
+        n_pulses = last_pulse - first_pulse
+        pulse_inds = (np.repeat(first_pulse - np.concatenate(([0], np.cumsum(n_pulses)[:-1])), n_pulses)
+                      + np.arange(np.sum(n_pulses)))
+        opto_on_times = opto_on_times[pulse_inds]
 
-        # If there are different stimulation frequencies than 25 Hz it's a long stim session
-        if np.any(np.isin([1, 5, 10], opto_freqs)):
-            print('Long opto stim session detected, extracting 25 Hz pulse trains..')
-
-            # Load in the trace in chunks and only extract the 25Hz trains
-            opto_train_times = []
-            opto_on_times = []
-            chunk_edges = np.arange(0, sr.shape[0], 500 * sr.fs).astype(int)
-            for j in range(len(chunk_edges[:-1])):
-
-                # Load in chunk of trace
-                trace_chunk = sr.read_sync_analog(slice(chunk_edges[j], chunk_edges[j+1]))[:, 1]
-                analog_chunk = sr.read_sync_analog(slice(chunk_edges[j], chunk_edges[j+1]))[:, 3]
-                times_chunk = np.arange(chunk_edges[j], chunk_edges[j+1]) / sr.fs
-
-                # Get start times of pulse trains
-                these_on_times = times_chunk[np.concatenate((np.diff(trace_chunk), [0])) > 1]
-
-                # Get the times of the onset of each pulse train
-                these_train_times = these_on_times[np.concatenate(([True], np.diff(these_on_times) > 1))]
-
-                # Get the stimulation frequencies and amplitudes
-                these_freqs = np.empty(these_train_times.shape)
-                these_amps = np.empty(these_train_times.shape)
-                for ii, t_time in enumerate(these_train_times):
-                    these_freqs[ii] = these_on_times[(these_on_times >= t_time) & (these_on_times <= t_time + 1)].shape[0]
-                    this_amp = np.max(analog_chunk[(times_chunk >= t_time) & (times_chunk <= t_time + 1)])
-                    these_amps[ii] = np.round(this_amp * 2) / 2  # round to 0.5 or 1
-                these_freqs = these_freqs - these_freqs % 5  # round to 5
-                these_freqs[these_freqs == 0] = 1
-
-                # Add the pulse trains of 25 Hz full power to the array
-                opto_train_times.append(these_train_times[(these_freqs == 25) & (these_amps == 1)])
-                for kk, this_train_time in enumerate(these_train_times[(these_freqs == 25) & (these_amps == 1)]):
-                    opto_on_times.append(these_on_times[(these_on_times >= this_train_time)
-                                                        & (these_on_times <= this_train_time + 1)])
-
-            # Convert to arrays
-            opto_train_times = np.concatenate(opto_train_times)
-            opto_on_times = np.concatenate(opto_on_times)
-
-            # Save extracted pulses to disk
-            if anesthesia:
-                np.save(join(save_path, f'{subject}_{date}_pulse_trains_anesthesia.npy'), opto_train_times)
-                np.save(join(save_path, f'{subject}_{date}_ind_pulses_anesthesia.npy'), opto_on_times)
-            else:
-                np.save(join(save_path, f'{subject}_{date}_pulse_trains.npy'), opto_train_times)
-                np.save(join(save_path, f'{subject}_{date}_ind_pulses.npy'), opto_on_times)
-
-            return opto_train_times, opto_on_times
-
+    else:
         # Find the opto pulses after the spontaneous activity (after a long break, here 100s)
         if np.sum(np.diff(opto_train_times) > 100) > 0:
-            first_pulse = np.where(np.diff(opto_train_times) > 100)[0][0]+1
-        elif opto_train_times[0] - opto_times[0] > 50:
-            first_pulse = 0
+            first_train = np.where(np.diff(opto_train_times) > 100)[0][0]+1
+        elif opto_train_times[0] - offset / sr.fs > 50:
+            first_train = 0
         else:
             print('Could not find passive laser pulses')
-            return [], []
-        opto_train_times = opto_train_times[first_pulse:]
-        opto_on_times = opto_on_times[first_pulse:]
-
-        # Save extracted pulses to disk
-        if anesthesia:
-            np.save(join(save_path, f'{subject}_{date}_pulse_trains_anesthesia.npy'), opto_train_times)
-            np.save(join(save_path, f'{subject}_{date}_ind_pulses_anesthesia.npy'), opto_on_times)
-        else:
-            np.save(join(save_path, f'{subject}_{date}_pulse_trains.npy'), opto_train_times)
-            np.save(join(save_path, f'{subject}_{date}_ind_pulses.npy'), opto_on_times)
+            return no_pulses
+        opto_train_times = opto_train_times[first_train:]
+        opto_on_times = opto_on_times[opto_on_times >= opto_train_times[0]]
 
-        return opto_train_times, opto_on_times
+    # Get the end of every pulse (first falling edge after the rising edge)
+    off_inds = np.searchsorted(opto_off_times, opto_on_times, side='right')
+    opto_off_times = np.append(opto_off_times, np.nan)[off_inds]
 
+    # Save extracted pulses to disk
+    makedirs(save_path, exist_ok=True)
+    np.savez(cache_file, version=OPTO_TIMES_VERSION, train_times=opto_train_times,
+             on_times=opto_on_times, off_times=opto_off_times)
 
-def get_neuron_qc(pid, one=None, ba=None, force_rerun=False):
+    if return_off_times:
+        return opto_train_times, opto_on_times, opto_off_times
+    return opto_train_times, opto_on_times
+
+
+def _neuron_qc_store_path():
+    _, save_path = paths()
+    return join(save_path, 'NeuronQC', 'neuron_qc_metrics.pqt')
+
+
+def load_neuron_qc_store():
+    """
+    Load the table with the neuron QC metrics of all computed insertions, one row per
+    (pid, collection, cluster_id) with the hash of the spike sorting the metrics were computed
+    on. The collection is empty for the default collection of SpikeSortingLoader.
+    """
+    if not isfile(_neuron_qc_store_path()):
+        return pd.DataFrame(columns=['pid', 'collection', 'cluster_id', 'sorting_hash', 'label'])
+    qc_store = pd.read_parquet(_neuron_qc_store_path())
+    if 'collection' not in qc_store.columns:
+        qc_store['collection'] = ''
+    return qc_store
+
+
+def get_spike_sorting_collection(eid, probe, one):
+    """
+    Get the spike sorting collection of a probe that brainbox.io.one.load_spike_sorting and
+    load_spike_sorting_with_channel load by default (pykilosort if it exists)
+    """
+    collections = one.list_collections(eid)
+    for collection in [f'alf/{probe}/pykilosort', f'alf/{probe}']:
+        if collection in collections:
+            return collection
+    return next(filter(lambda c: c.startswith(f'alf/{probe}'), collections), None)
+
+
+def _neuron_qc_single_pid(args):
+    """
+    Compute the QC metrics of one insertion, returns None if the spike sorting could not be
+    loaded or has the same hash as the stored metrics. Runs in a worker process of
+    compute_neuron_qc.
+    """
+    pid, collection, stored_hash, one = args
     one = one or ONE()
-    ba = ba or AllenAtlas()
+    try:
+        if collection == '':
+            sl = SpikeSortingLoader(pid=pid, one=one)
+            spikes, clusters, _ = sl.load_spike_sorting()
+        else:
+            eid, _ = one.pid2eid(pid)
+            spikes = one.load_object(eid, 'spikes', collection=collection,
+                                     attribute=['times', 'clusters', 'amps', 'depths'])
+            clusters = one.load_object(eid, 'clusters', collection=collection,
+                                       attribute=['channels'])
+    except Exception as err:
+        print(f'Could not load spike sorting of {pid}: {err}')
+        return None
+    sorting_hash = hashlib.md5(spikes.times.tobytes() + spikes.clusters.tobytes()).hexdigest()
+    if sorting_hash == stored_hash:
+        return None
+    print(f'Calculating neuron QC metrics of {pid}')
+    qc_metrics, _ = spike_sorting_metrics(spikes.times, spikes.clusters,
+                                          spikes.amps, spikes.depths,
+                                          cluster_ids=np.arange(clusters.channels.size))
+    qc_metrics = qc_metrics.reset_index(drop=True)
+    qc_metrics['cluster_id'] = np.arange(qc_metrics.shape[0])
+    qc_metrics['pid'] = pid
+    qc_metrics['collection'] = collection
+    qc_metrics['sorting_hash'] = sorting_hash
+    return qc_metrics
 
-    # Check if QC is already computed
-    eid, probe = one.pid2eid(pid)
-    session_path = one.eid2path(eid)
-    if isfile(join(session_path, 'alf', probe, 'neuron_qc_metrics.csv')) & ~force_rerun:
+
+def compute_neuron_qc(pids, one=None, n_workers=None, force_rerun=False, check_hash=False,
+                      collection=None):
+    """
+    Compute the neuron QC metrics of a list of insertions in parallel worker processes and add
+    them to the neuron QC store. Insertions that are already in the store are skipped unless
+    force_rerun is True, or check_hash is True and their spike sorting has changed.
+
+    Parameters
+    ----------
+    pids : list
+        Insertions to compute the metrics for
+    one : ONE
+        Only used when n_workers is 1, worker processes make their own connection
+    n_workers : int
+        Number of worker processes, None uses all cores and 1 runs in this process
+    force_rerun : bool
+        Recompute the metrics of all insertions
+    check_hash : bool
+        Load the spike sorting of stored insertions and recompute if its hash has changed
+    collection : str
+        Spike sorting collection the cluster ids refer to, must be the collection the spikes
+        of the analysis are loaded from. None uses the default collection of SpikeSortingLoader.
+
+    Returns
+    qc_store : DataFrame
+        The updated neuron QC store
+    """
+    collection = collection or ''
+    qc_store = load_neuron_qc_store()
+    stored_hashes = (qc_store[qc_store['collection'] == collection]
+                     .groupby('pid')['sorting_hash'].first())
+    pids = [pid for pid in np.unique(pids)
+            if force_rerun or check_hash or (pid not in stored_hashes.index)]
+    jobs = [(pid, collection, None if force_rerun else stored_hashes.get(pid),
+             one if n_workers == 1 else None) for pid in pids]
+    if len(jobs) == 0:
+        return qc_store
+
+    if n_workers == 1:
+        results = list(map(_neuron_qc_single_pid, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_neuron_qc_single_pid, jobs))
+    new_metrics = [qc_metrics for qc_metrics in results if qc_metrics is not None]
+    if len(new_metrics) == 0:
+        return qc_store
+
+    # Replace the metrics of the recomputed insertions in the store
+    new_metrics = pd.concat(new_metrics, ignore_index=True)
+    recomputed = qc_store['pid'].isin(new_metrics['pid']) & (qc_store['collection'] == collection)
+    qc_store = pd.concat((qc_store[~recomputed], new_metrics), ignore_index=True)
+    makedirs(dirname(_neuron_qc_store_path()), exist_ok=True)
+    qc_store.to_parquet(_neuron_qc_store_path(), index=False)
+    return qc_store
+
+
+def neuron_qc_pass(pid, one=None, qc_store=None, min_label=1, collection=None):
+    """
+    Return the cluster ids of an insertion that pass neuron QC (label >= min_label, the labels
+    are 0, 1/3, 2/3 or 1), the metrics are computed first if the insertion is not in the neuron
+    QC store yet. The collection is the spike sorting collection the cluster ids refer to, None
+    is the default collection of SpikeSortingLoader. Raises a KeyError if the metrics could not
+    be computed.
+    """
+    collection = collection or ''
+    qc_store = load_neuron_qc_store() if qc_store is None else qc_store
+    this_pid = (qc_store['pid'] == pid) & (qc_store['collection'] == collection)
+    if not np.any(this_pid):
+        qc_store = compute_neuron_qc([pid], one=one, n_workers=1, collection=collection)
+        this_pid = (qc_store['pid'] == pid) & (qc_store['collection'] == collection)
+    if not np.any(this_pid):
+        raise KeyError(f'No neuron QC metrics of {pid}, the spike sorting could not be loaded')
+    return np.sort(qc_store.loc[this_pid & (qc_store['label'] >= min_label), 'cluster_id'].values)
+
+
+def get_neuron_qc(pid, one=None, ba=None, force_rerun=False):
+    """
+    Get the neuron QC metrics of an insertion from the neuron QC store, one row per cluster id.
+    Raises a KeyError if the metrics could not be computed.
+    """
+    qc_store = load_neuron_qc_store()
+    this_pid = (qc_store['pid'] == pid) & (qc_store['collection'] == '')
+    if force_rerun or not np.any(this_pid):
+        qc_store = compute_neuron_qc([pid], one=one, n_workers=1, force_rerun=force_rerun)
+        this_pid = (qc_store['pid'] == pid) & (qc_store['collection'] == '')
+        if not np.any(this_pid):
+            raise KeyError(f'No neuron QC metrics of {pid}, the spike sorting could not be loaded')
+    else:
         print('Neuron QC metrics loaded from disk')
-        qc_metrics = pd.read_csv(join(session_path, 'alf', probe, 'neuron_qc_metrics.csv'))
-        return qc_metrics
+    qc_metrics = qc_store[this_pid].sort_values('cluster_id')
+    return qc_metrics.drop(columns=['pid', 'collection', 'sorting_hash']).reset_index(drop=True)
+
+
+def load_spike_cache(pid, one=None, ba=None, force_rerun=False):
+    """
+    Load the spike sorting of an insertion from the local spike cache. The first time an insertion
+    is requested the spikes are loaded with the SpikeSortingLoader, the clusters are merged with
+    the channel locations and remapped to Beryl, combined and high-level regions, and everything
+    is written to disk. Subsequent calls open the spike arrays as memory-mapped .npy files so that
+    no data is copied until it is indexed.
+
+    Parameters
+    ----------
+    pid : str
+        Probe insertion id
+    force_rerun : bool
+        Whether to rebuild the cache for this insertion from the ONE data
+
+    Returns
+    spikes : Bunch
+        Memory-mapped spike times (float64), clusters (int32), amps and depths, sorted in time
+    clusters : Bunch
+        Cluster table with one entry per cluster id, including the keys 'region' (Beryl),
+        'combined_region', 'high_level_region', 'qc_pass' (neuron QC label == 1) and 'artifact'
+    """
+
+    cache_path = join(paths()[1], 'SpikeCache', pid)
+    if isfile(join(cache_path, 'cache_info.json')) and not force_rerun:
+        with open(join(cache_path, 'cache_info.json')) as json_file:
+            cache_info = json.load(json_file)
+        if cache_info['version'] == SPIKE_CACHE_VERSION:
+            spikes = Bunch()
+            for key in ['times', 'clusters', 'amps', 'depths']:
+                spikes[key] = np.load(join(cache_path, f'spikes.{key}.npy'), mmap_mode='r')
+            clusters = pd.read_csv(join(cache_path, 'clusters.csv'))
+            clusters = Bunch({key: clusters[key].values for key in clusters.columns})
+
+            # Artifact neurons are flagged on load so that edits to artifact_neurons.csv apply
+            clusters['artifact'] = is_artifact(pid, clusters['cluster_id'])
+            return spikes, clusters
+        print('Spike cache is outdated, rebuilding..')
 
     # Load in spikes
+    one = one or ONE()
+    ba = ba or AllenAtlas()
     sl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
     spikes, clusters, channels = sl.load_spike_sorting()
     clusters = sl.merge_clusters(spikes, clusters, channels)
 
-    # Calculate QC metrics
-    print('Calculating neuron QC metrics')
-    qc_metrics, _ = spike_sorting_metrics(spikes.times, spikes.clusters,
-                                          spikes.amps, spikes.depths,
-                                          cluster_ids=np.arange(clusters.channels.size))
-    qc_metrics.to_csv(join(session_path, 'alf', probe, 'neuron_qc_metrics.csv'))
-    return qc_metrics
+    # Sort spikes in time and save them as flat arrays
+    print('Writing spikes to local cache')
+    makedirs(cache_path, exist_ok=True)
+    order = np.argsort(spikes.times, kind='stable')
+    np.save(join(cache_path, 'spikes.times.npy'), spikes.times[order].astype(np.float64))
+    np.save(join(cache_path, 'spikes.clusters.npy'), spikes.clusters[order].astype(np.int32))
+    np.save(join(cache_path, 'spikes.amps.npy'), spikes.amps[order])
+    np.save(join(cache_path, 'spikes.depths.npy'), spikes.depths[order])
+
+    # Build cluster table with remapped regions and QC
+    n_clusters = clusters['channels'].size
+    cluster_table = pd.DataFrame(data={
+        key: clusters[key] for key in clusters.keys()
+        if isinstance(clusters[key], np.ndarray) and clusters[key].shape == (n_clusters,)})
+    cluster_table['cluster_id'] = np.arange(n_clusters)
+    if 'acronym' in cluster_table.columns:
+        cluster_table['region'] = remap(cluster_table['acronym'].values, brainregions=ba.regions)
+        cluster_table['combined_region'] = combine_regions(cluster_table['region'].values,
+                                                           abbreviate=True)
+        cluster_table['high_level_region'] = high_level_regions(cluster_table['acronym'].values)
+    qc_metrics = get_neuron_qc(pid, one=one, ba=ba)
+    cluster_table['qc_pass'] = qc_metrics['label'].values == 1
+    cluster_table.to_csv(join(cache_path, 'clusters.csv'), index=False)
+
+    # Write cache info last so that an interrupted write is rebuilt the next time
+    with open(join(cache_path, 'cache_info.json'), 'w') as json_file:
+        json.dump({'version': SPIKE_CACHE_VERSION, 'pid': pid, 'collection': sl.collection,
+                   'n_spikes': int(order.size), 'n_clusters': int(n_clusters)}, json_file)
+
+    return load_spike_cache(pid, one=one, ba=ba)
+
+
+def _summarize_sessions(all_trials):
+    """
+    Summary statistics per session of a dataframe with the stored trials of many sessions, in one
+    groupby pass
+    """
+    signed_contrast, choice = all_trials['signed_contrast'].values, all_trials['choice'].values
+    counts = pd.DataFrame(data={
+        'eid': all_trials['eid'].values,
+        'n_left': signed_contrast == -1,
+        'n_left_correct': (signed_contrast == -1) & (choice == 1),
+        'n_right': signed_contrast == 1,
+        'n_right_correct': (signed_contrast == 1) & (choice == -1),
+        'n_zero': signed_contrast == 0,
+        'n_zero_left': (signed_contrast == 0) & (choice == 1),
+        'n_trials': 1}).groupby('eid', sort=False).sum()
+    details = all_trials.groupby('eid', sort=False)[['session_subject', 'session_date']].first()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary = pd.DataFrame(data={
+            'eid': counts.index.values,
+            'subject': details['session_subject'].values,
+            'date': details['session_date'].values,
+            'n_trials': counts['n_trials'].values,
+            'lapse_l': 1 - (counts['n_left_correct'].values / counts['n_left'].values),
+            'lapse_r': 1 - (counts['n_right_correct'].values / counts['n_right'].values),
+            'bias': np.abs(0.5 - (counts['n_zero_left'].values / counts['n_zero'].values))})
+    return summary
+
+
+def load_session_summary(eids, one=None, force_rerun=False, n_threads=None):
+    """
+    Load the summary table of sessions with the number of trials, the left and right lapse rate
+    (at 100% contrast) and the bias at 0% contrast. The table is saved next to the trials store,
+    only sessions that are not in it yet, or of which the stored trials were rewritten after
+    they were summarized, are loaded (in parallel threads) and summarized. With force_rerun the
+    trials of eids are loaded from ONE again, the other sessions in the table are kept.
+
+    Returns
+    -------
+    summary : DataFrame
+        One row per session in the order of eids with the columns eid, subject, date, n_trials,
+        lapse_l, lapse_r and bias, sessions without (loadable) trials are left out
+    """
+    summary_path = join(paths()[1], 'TrialsStore', f'session_summary_v{TRIALS_STORE_VERSION}.pqt')
+    columns = ['eid', 'subject', 'date', 'n_trials', 'lapse_l', 'lapse_r', 'bias']
+    if isfile(summary_path):
+        stored = pd.read_parquet(summary_path)
+        if 'trials_mtime' not in stored.columns:
+            stored['trials_mtime'] = np.nan
+    else:
+        stored = pd.DataFrame(columns=columns + ['trials_mtime'])
+
+    # Summaries are up to date if the stored trials have not been rewritten since
+    requested = stored[stored['eid'].isin(eids)]
+    trials_mtime = np.array([getmtime(_trials_store_path(eid))
+                             if isfile(_trials_store_path(eid)) else np.nan
+                             for eid in requested['eid']])
+    summaries = [] if force_rerun else [
+        requested[requested['trials_mtime'].values.astype(float) == trials_mtime]]
+    up_to_date = summaries[0]['eid'].values if len(summaries) > 0 else []
+    missing_eids = [eid for eid in pd.unique(np.asarray(eids)) if eid not in up_to_date]
+
+    if len(missing_eids) > 0:
+        one = one or ONE()
+
+        def load_session(eid):
+            try:
+                return _load_stored_trials(eid, one, force_rerun=force_rerun)
+            except Exception as err:
+                print(f'Could not load trials for {eid} ({err})')
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            all_trials = [trials.assign(eid=eid) for eid, trials in zip(
+                missing_eids, executor.map(load_session, missing_eids)) if trials is not None]
+        if len(all_trials) > 0:
+            new_summary = _summarize_sessions(pd.concat(all_trials))
+            new_summary['trials_mtime'] = [getmtime(_trials_store_path(eid))
+                                           for eid in new_summary['eid']]
+            summaries.append(new_summary)
+
+            # Replace the rows of the summarized sessions in the stored table
+            makedirs(dirname(summary_path), exist_ok=True)
+            pd.concat((stored[~stored['eid'].isin(new_summary['eid'])], new_summary),
+                      ignore_index=True).to_parquet(summary_path)
+
+    if len(summaries) == 0:
+        return pd.DataFrame(columns=columns)
+    summary = pd.concat(summaries, ignore_index=True).set_index('eid')
+    return summary.loc[[eid for eid in eids if eid in summary.index]].reset_index()[columns]
 
 
 def behavioral_criterion(eids, max_lapse=0.5, max_bias=0.5, min_trials=200, return_excluded=False,
-                         one=None):
-    if one is None:
-        one = ONE()
-    use_eids, excl_eids = [], []
-    for j, eid in enumerate(eids):
-        try:
-            trials = load_trials(eid, one=one)
-            lapse_l = 1 - (np.sum(trials.loc[trials['signed_contrast'] == -1, 'choice'] == 1)
-                           / trials.loc[trials['signed_contrast'] == -1, 'choice'].shape[0])
-            lapse_r = 1 - (np.sum(trials.loc[trials['signed_contrast'] == 1, 'choice'] == -1)
-                           / trials.loc[trials['signed_contrast'] == 1, 'choice'].shape[0])
-            bias = np.abs(0.5 - (np.sum(trials.loc[trials['signed_contrast'] == 0, 'choice'] == 1)
-                                 / np.shape(trials.loc[trials['signed_contrast'] == 0, 'choice'] == 1)[0]))
-            details = one.get_details(eid)
-            if ((lapse_l < max_lapse) & (lapse_r < max_lapse) & (trials.shape[0] > min_trials)
-                    & (bias < max_bias)):
-                use_eids.append(eid)
-            else:
-                print('%s %s excluded (n_trials: %d, lapse_l: %.2f, lapse_r: %.2f, bias: %.2f)'
-                      % (details['subject'], details['start_time'][:10], trials.shape[0], lapse_l, lapse_r, bias))
-                excl_eids.append(eid)
-        except Exception:
-            print('Could not load session %s' % eid)
+                         return_summary=False, one=None):
+    """
+    Select the sessions that pass the behavioral criterion based on the session summary table.
+
+    Parameters
+    ----------
+    eids : list
+        List of eids
+    return_excluded : bool
+        Whether to also return the list of excluded eids
+    return_summary : bool
+        Whether to also return the session summary with an 'included' column, this is the
+        exclusion report (sessions that could not be loaded are not in it)
+    """
+    summary = load_session_summary(eids, one=one)
+    summary['included'] = ((summary['lapse_l'] < max_lapse) & (summary['lapse_r'] < max_lapse)
+                           & (summary['n_trials'] > min_trials) & (summary['bias'] < max_bias))
+    for eid in np.setdiff1d(eids, summary['eid']):
+        print('Could not load session %s' % eid)
+    if np.sum(~summary['included']) > 0:
+        print(f'Excluded {np.sum(~summary["included"])} of {summary.shape[0]} sessions:')
+        print(summary.loc[~summary['included'], ['subject', 'date', 'n_trials', 'lapse_l',
+                                                 'lapse_r', 'bias']].to_string(
+                                                     index=False, float_format='%.2f'))
+    use_eids = list(summary.loc[summary['included'], 'eid'])
+    excl_eids = list(summary.loc[~summary['included'], 'eid'])
+    output = (use_eids,)
     if return_excluded:
-        return use_eids, excl_eids
-    else:
-        return use_eids
+        output += (excl_eids,)
+    if return_summary:
+        output += (summary,)
+    return output[0] if len(output) == 1 else output
 
 
 def load_exp_smoothing_trials(eids, stimulated=None, rt_cutoff=0.2, after_probe_trials=0, stim_trial_shift=0,
-                              pseudo=False, patch_old_opto=False, min_trials=100, one=None):
+                              pseudo=False, patch_old_opto=False, min_trials=100, one=None,
+                              ragged=False, return_n_trials=False):
     """
     Parameters
     ----------
@@ -658,6 +1379,14 @@ def load_exp_smoothing_trials(eids, stimulated=None, rt_cutoff=0.2, after_probe_
         Only used if stimulated = 'probe'. How many trials after a probe trial are still counted.
     pseudo : bool
         Whether to use pseudo stimulated blocks or shuffled probes as control
+    ragged : bool
+        If False, the trial arrays are padded with zeros to (n_sessions, max_n_trials). If True,
+        the trials of all sessions are concatenated into flat arrays and the offsets (n_sessions + 1)
+        of the sessions are returned as the last output, the trials of session k are
+        offsets[k]:offsets[k + 1]. The flat arrays can be wrapped in tensors with torch.from_numpy.
+    return_n_trials : bool
+        Only used if ragged = False. Whether to return the number of trials per session as the
+        last output, np.arange(max_n_trials) < n_trials[:, None] masks the padding.
     """
 
     if isinstance(stimulated, str):
@@ -666,15 +1395,12 @@ def load_exp_smoothing_trials(eids, stimulated=None, rt_cutoff=0.2, after_probe_
     if one is None:
         one=ONE()
     stimuli_arr, actions_arr, stim_sides_arr, prob_left_arr, stimulated_arr, session_uuids = [], [], [], [], [], []
+    all_trials = load_trials_bulk(eids, invert_stimside=True, laser_stimulation=stimulated is not None,
+                                  patch_old_opto=patch_old_opto, one=one)
     for j, eid in enumerate(eids):
         try:
             # Load in trials vectors
-            if stimulated is None:
-                trials = load_trials(eid, invert_stimside=True, laser_stimulation=False,
-                                     patch_old_opto=patch_old_opto, one=one)
-            else:
-                trials = load_trials(eid, invert_stimside=True, laser_stimulation=True,
-                                     patch_old_opto=patch_old_opto, one=one)
+            trials = all_trials[eid]
             if trials.shape[0] < min_trials:
                 continue
             if stimulated == 'all':
@@ -704,59 +1430,48 @@ def load_exp_smoothing_trials(eids, stimulated=None, rt_cutoff=0.2, after_probe_
         except:
             print(f'Could not load trials for {eid}')
 
-    if (len(session_uuids) == 0) and (stimulated is not None):
-        return [], [], [], [], [], []
-    elif len(session_uuids) == 0:
-        return [], [], [], [], []
+    n_outputs = 5 + (stimulated is not None) + (ragged or return_n_trials)
+    if len(session_uuids) == 0:
+        return ([],) * n_outputs
 
-    # Get maximum number of trials across sessions
-    max_len = np.array([len(stimuli_arr[k]) for k in range(len(stimuli_arr))]).max()
-
-    # Pad with 0 such that we obtain nd arrays of size nb_sessions x nb_trials
-    stimuli = np.array([np.concatenate((stimuli_arr[k], np.zeros(max_len-len(stimuli_arr[k]))))
-                        for k in range(len(stimuli_arr))])
-    actions = np.array([np.concatenate((actions_arr[k], np.zeros(max_len-len(actions_arr[k]))))
-                        for k in range(len(actions_arr))])
-    prob_left = np.array([np.concatenate((prob_left_arr[k], np.zeros(max_len-len(prob_left_arr[k]))))
-                        for k in range(len(prob_left_arr))])
-    stim_side = np.array([np.concatenate((stim_sides_arr[k],
-                                          np.zeros(max_len-len(stim_sides_arr[k]))))
-                          for k in range(len(stim_sides_arr))])
+    # Fill one flat float array per variable, the sessions follow each other
+    n_trials = np.array([len(session_actions) for session_actions in actions_arr])
+    offsets = np.concatenate(([0], np.cumsum(n_trials)))
+    variables = [actions_arr, stimuli_arr, stim_sides_arr, prob_left_arr]
     if stimulated is not None:
-        opto_stim = np.array([np.concatenate((stimulated_arr[k], np.zeros(max_len-len(stimulated_arr[k]))))
-                              for k in range(len(stimulated_arr))])
+        variables.append(stimulated_arr)
+    flat = np.empty((len(variables), offsets[-1]))
+    for v, variable in enumerate(variables):
+        np.concatenate(variable, out=flat[v], casting='unsafe')
     session_uuids = np.array(session_uuids)
+    if ragged:
+        return (*flat, session_uuids, offsets)
 
-    if session_uuids.shape[0] == 1:
-        stimuli = np.array([np.squeeze(stimuli)])
-        actions = np.array([np.squeeze(actions)])
-        prob_left = np.array([np.squeeze(prob_left)])
-        stim_side = np.array([np.squeeze(stim_side)])
-        if stimulated is not None:
-            opto_stim = np.array([np.squeeze(opto_stim)])
-
-    if stimulated is not None:
-        return actions, stimuli, stim_side, prob_left, opto_stim, session_uuids
-    else:
-        return actions, stimuli, stim_side, prob_left, session_uuids
+    # Pad with 0 such that we obtain nd arrays of size nb_sessions x nb_trials
+    padded = np.zeros((len(variables), n_trials.shape[0], n_trials.max()))
+    padded[:, np.arange(n_trials.max()) < n_trials[:, None]] = flat
+    if return_n_trials:
+        return (*padded, session_uuids, n_trials)
+    return (*padded, session_uuids)
 
 
-def load_lfp(eid, probe, time_start, time_end, relative_to='begin', destriped=False, one=None):
+def _lfp_path(eid, probe, destriped=False, one=None):
     one = one or ONE()
-    destriped_lfp_path = join(paths()[1], 'LFP')
-
-    # Download LFP data
     if destriped:
         ses_details = one.get_details(eid)
         subject = ses_details['subject']
         date = ses_details['start_time'][:10]
-        lfp_path = join(destriped_lfp_path, f'{subject}_{date}_{probe}_destriped_lfp.cbin')
-    else:
-        lfp_paths, _ = one.load_datasets(eid, download_only=True, datasets=[
-            '_spikeglx_ephysData_g*_t0.imec*.lf.cbin', '_spikeglx_ephysData_g*_t0.imec*.lf.meta',
-            '_spikeglx_ephysData_g*_t0.imec*.lf.ch'], collections=[f'raw_ephys_data/{probe}'] * 3)
-        lfp_path = lfp_paths[0]
-    sr = spikeglx.Reader(lfp_path)
+        return join(paths()[1], 'LFP', f'{subject}_{date}_{probe}_destriped_lfp.cbin')
+    lfp_paths, _ = one.load_datasets(eid, download_only=True, datasets=[
+        '_spikeglx_ephysData_g*_t0.imec*.lf.cbin', '_spikeglx_ephysData_g*_t0.imec*.lf.meta',
+        '_spikeglx_ephysData_g*_t0.imec*.lf.ch'], collections=[f'raw_ephys_data/{probe}'] * 3)
+    return lfp_paths[0]
+
+
+def load_lfp(eid, probe, time_start, time_end, relative_to='begin', destriped=False, one=None):
+
+    # Download LFP data
+    sr = spikeglx.Reader(_lfp_path(eid, probe, destriped=destriped, one=one))
 
     # Convert time to samples
     if relative_to == 'begin':
@@ -774,6 +1489,101 @@ def load_lfp(eid, probe, time_start, time_end, relative_to='begin', destriped=Fa
     return signal, time
 
 
+def _read_lfp_epochs(sr, first_samples, n_samples, channels=None):
+    """
+    Read epochs of the same length from a spikeglx reader. For compressed files every chunk that
+    overlaps with an epoch is decompressed once and copied into all epochs it overlaps with.
+
+    Parameters
+    ----------
+    sr : spikeglx.Reader
+    first_samples : 1D array
+        First sample of every epoch
+    n_samples : int
+        Number of samples per epoch
+    channels : 1D array
+        Channel indices to read, None reads all channels except the sync channel
+
+    Returns
+    -------
+    epochs : 3D array
+        float32 array (epochs x channels x samples) in volts, samples outside of the recording
+        are NaN
+    """
+    if channels is None:
+        channels = np.arange(sr.nc - sr.nsync)
+    channels = np.asarray(channels)
+    first_samples = np.asarray(first_samples, dtype=np.int64)
+    epochs = np.full((first_samples.size, channels.size, n_samples), np.nan, dtype=np.float32)
+    starts = np.clip(first_samples, 0, sr.ns)
+    ends = np.clip(first_samples + n_samples, 0, sr.ns)
+
+    # Reading blocks are the compression chunks, or the epochs themselves for uncompressed files
+    if sr.is_mtscomp:
+        block_bounds = np.asarray(sr._raw.chunk_bounds)
+        first_block = np.searchsorted(block_bounds, starts, side='right') - 1
+        last_block = np.searchsorted(block_bounds, ends - 1, side='right') - 1
+        blocks = np.unique(np.concatenate([np.arange(first_block[i], last_block[i] + 1)
+                                           for i in np.where(ends > starts)[0]] + [[]])).astype(int)
+        blocks = [(block_bounds[i], block_bounds[i + 1]) for i in blocks]
+    else:
+        blocks = [(starts[i], ends[i]) for i in np.where(ends > starts)[0]]
+
+    for block_start, block_end in blocks:
+        data = sr.read(nsel=slice(block_start, block_end), csel=channels, sync=False).T
+        for i in np.where((starts < block_end) & (ends > block_start))[0]:
+            read_start, read_end = max(starts[i], block_start), min(ends[i], block_end)
+            epochs[i, :, read_start - first_samples[i]:read_end - first_samples[i]] = data[
+                :, read_start - block_start:read_end - block_start]
+    return epochs
+
+
+def load_lfp_epochs(eid, probe, event_times, window, channels=None, destriped=False, cache=False,
+                    one=None):
+    """
+    Load the LFP in a window around events, only the parts of the recording that are needed are
+    read and decompressed.
+
+    Parameters
+    ----------
+    event_times : 1D array
+        Timestamps of the events
+    window : list
+        Start and end of the window relative to the events in seconds, e.g. [-1, 2]
+    channels : 1D array
+        Channel indices to load, None loads all channels
+    cache : bool
+        Whether to save the epochs as an uncompressed .npy file in the LFP folder, the next time
+        the same epochs are requested they are loaded from it memory-mapped
+
+    Returns
+    -------
+    epochs : 3D array
+        float32 array (events x channels x samples) in volts
+    time : 1D array
+        Time of the samples relative to the events
+    """
+    event_times = np.asarray(event_times, dtype=float)
+    cache_key = hashlib.md5(event_times.tobytes() + np.asarray(window, dtype=float).tobytes()
+                            + str(channels if channels is None else list(channels)).encode()
+                            + str(destriped).encode()).hexdigest()[:12]
+    cache_file = join(paths()[1], 'LFP', 'Epochs', f'{eid}_{probe}_{cache_key}')
+    if cache and isfile(cache_file + '_lfp.npy'):
+        return (np.load(cache_file + '_lfp.npy', mmap_mode='r'),
+                np.load(cache_file + '_time.npy'))
+
+    sr = spikeglx.Reader(_lfp_path(eid, probe, destriped=destriped, one=one))
+    n_samples = int(np.round((window[1] - window[0]) * sr.fs))
+    first_samples = np.round((event_times + window[0]) * sr.fs).astype(np.int64)
+    epochs = _read_lfp_epochs(sr, first_samples, n_samples, channels=channels)
+    time = np.arange(n_samples) / sr.fs + window[0]
+    if cache:
+        makedirs(dirname(cache_file), exist_ok=True)
+        np.save(cache_file + '_lfp.npy', epochs)
+        np.save(cache_file + '_time.npy', time)
+    return epochs, time
+
+
 def plot_scalar_on_slice(
         regions, values, coord=-1000, slice='coronal', mapping='Beryl', hemisphere='left',
         cmap='viridis', background='boundary', clevels=None, brain_atlas=None, colorbar=False, ax=None):
@@ -887,47 +1697,111 @@ def plot_scalar_on_slice(
             ba.plot_top(
                 volume='boundary', mapping=map, ax=ax, cmap=cmap_bound, vmin=0.01, vmax=0.8)
 
-    return fig, ax
+    return fig, ax
+
+
+def _window_output(values, offsets, padded=False):
+    """
+    Split the concatenated values of all windows into a list with an array per window, or into a
+    2D array padded with NaN
+    """
+    if not padded:
+        return np.split(values, offsets[1:-1])
+    n_bins = np.diff(offsets)
+    padded_values = np.full((n_bins.shape[0], n_bins.max(initial=0)), np.nan)
+    padded_values[np.arange(padded_values.shape[1]) < n_bins[:, None]] = values
+    return padded_values
+
+
+def resample_windows(timestamps, values, start_times, stop_times, binsize, padded=False):
+    """
+    Resample a continuous signal with previous-value interpolation on a grid with a spacing of
+    binsize from every start time up to its stop time, all windows are resampled at once.
+
+    Parameters
+    ----------
+    timestamps : 1D array
+        Sorted timestamps of the signal
+    values : 1D array
+        Signal
+    start_times, stop_times : 1D arrays
+        Start and stop time of each window
+    binsize : float
+        Spacing of the grid in seconds
+    padded : bool
+        Return a 2D array (windows x bins) padded with NaN instead of a list of arrays
+
+    Returns
+    -------
+    resampled : list or 2D array
+        Value of the signal at the last sample at or before every grid point, grid points before
+        the first sample are NaN
+    """
+    start_times, stop_times = np.asarray(start_times), np.asarray(stop_times)
+    n_bins = np.ceil((stop_times - start_times) / binsize).astype(int)
+    offsets = np.concatenate(([0], np.cumsum(n_bins)))
+    window = np.repeat(np.arange(n_bins.shape[0]), n_bins)
+    grid = start_times[window] + (np.arange(offsets[-1]) - offsets[window]) * binsize
+    sample = np.searchsorted(timestamps, grid, side='right') - 1
+    resampled = np.where(sample >= 0, np.asarray(values, dtype=float)[sample.clip(min=0)], np.nan)
+    return _window_output(resampled, offsets, padded=padded)
 
 
-def load_wheel_velocity(eid, starttimes, endtimes, binsize, one=None):
+def load_wheel_velocity(eid, starttimes, endtimes, binsize, one=None, padded=False):
+    """
+    Wheel velocity (change in position per bin) for every window from starttimes to endtimes,
+    the first bin of every window is 0
+    """
     one = one or ONE()
 
     # Load in wheel velocity
     wheel = one.load_object(eid, 'wheel')
-    whlpos, whlt = wheel.position, wheel.timestamps
-    wh_endlast = 0
-    wheel_velocity = []
-    for (start, end) in np.vstack((starttimes, endtimes)).T:
-        wh_startind = np.searchsorted(whlt[wh_endlast:], start) + wh_endlast
-        wh_endind = np.searchsorted(whlt[wh_endlast:], end, side='right') + wh_endlast
-        if wh_endind > len(whlpos):
-            raise IndexError('Wheel trace too short for requested start and end times')
-        wh_endlast = wh_endind
-        tr_whlpos = whlpos[wh_startind - 1:wh_endind + 1]
-        tr_whlt = whlt[wh_startind - 1:wh_endind + 1] - start
-        tr_whlt[0] = 0.  # Manual previous-value interpolation
-        whlseries = TimeSeries(tr_whlt, tr_whlpos, columns=['whlpos'])
-        whlsync = sync(binsize, timeseries=whlseries, interp='previous')
-        trialstartind = np.searchsorted(whlsync.times, 0)
-        trialendind = np.ceil((end - start) / binsize).astype(int)
-        trpos = whlsync.values[trialstartind:trialendind + trialstartind]
-        whlvel = trpos[1:] - trpos[:-1]
-        whlvel = np.insert(whlvel, 0, 0)
-        if np.abs((trialendind - len(whlvel))) > 0:
-            raise IndexError('Mismatch between expected length of wheel data and actual.')
-        wheel_velocity.append(whlvel)
-    return wheel_velocity
-
-
-def make_bins(signal, timestamps, start_times, stop_times, binsize):
-
-    # Loop over start times
-    binned_signal = []
-    for (start, end) in np.vstack((start_times, stop_times)).T:
-        binned_signal.append(binned_statistic(timestamps, signal, bins=int((end-start)*(1/binsize)),
-                                              range=(start, end), statistic=np.nanmean)[0])
-    return binned_signal
+    if np.max(endtimes) > wheel.timestamps[-1] + binsize:
+        raise IndexError('Wheel trace too short for requested start and end times')
+    position = resample_windows(wheel.timestamps, wheel.position, starttimes, endtimes, binsize,
+                                padded=True)
+    wheel_velocity = np.diff(position, axis=1, prepend=position[:, :1])
+    if padded:
+        return wheel_velocity
+    n_bins = np.ceil((np.asarray(endtimes) - np.asarray(starttimes)) / binsize).astype(int)
+    return [wheel_velocity[i, :n_bins[i]] for i in range(n_bins.shape[0])]
+
+
+def make_bins(signal, timestamps, start_times, stop_times, binsize, padded=False):
+    """
+    Mean of the signal (ignoring NaNs) in int((stop - start) / binsize) equally sized bins per
+    window, all windows are binned at once. Bins without samples are NaN.
+
+    Returns a list with the binned signal per window, or a 2D array padded with NaN if padded
+    is True
+    """
+    start_times, stop_times = np.asarray(start_times), np.asarray(stop_times)
+    signal = np.asarray(signal, dtype=float)
+    n_bins = (stop_times - start_times) * (1 / binsize)
+    n_bins = n_bins.astype(int)
+    offsets = np.concatenate(([0], np.cumsum(n_bins)))
+
+    # Sample index of the edges of all bins of all windows, the last edge of a window is inclusive
+    window = np.repeat(np.arange(n_bins.shape[0]), n_bins)
+    bin_in_window = np.arange(offsets[-1]) - offsets[window]
+    bin_width = (stop_times - start_times)[window] / n_bins[window]
+    left_edges = start_times[window] + bin_in_window * bin_width
+    right_edges = np.where(bin_in_window == n_bins[window] - 1, stop_times[window],
+                           start_times[window] + (bin_in_window + 1) * bin_width)
+    first_sample = np.searchsorted(timestamps, left_edges, side='left')
+    last_sample = np.where(bin_in_window == n_bins[window] - 1,
+                           np.searchsorted(timestamps, right_edges, side='right'),
+                           np.searchsorted(timestamps, right_edges, side='left'))
+
+    # Sum the samples and count the non-NaN samples per bin, bins can overlap
+    not_nan = ~np.isnan(signal)
+    sample_ranges = np.column_stack((first_sample, last_sample)).flatten()
+    sums = np.add.reduceat(np.append(np.where(not_nan, signal, 0), 0), sample_ranges)[::2]
+    counts = np.add.reduceat(np.append(not_nan, False).astype(int), sample_ranges)[::2]
+    counts[last_sample <= first_sample] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        binned_signal = np.where(counts > 0, sums / counts, np.nan)
+    return _window_output(binned_signal, offsets, padded=padded)
 
 
 def fit_psychfunc(stim_levels, n_trials, proportion):
@@ -1142,11 +2016,15 @@ def fit_glm(behav, prior_blocks=True, opto_stim=False, rt_cutoff=None, folds=3):
 
 def calculate_peths(
         spike_times, spike_clusters, cluster_ids, align_times, pre_time=0.2,
-        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True):
+        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True, dtype=np.float64):
     """
     Calcluate peri-event time histograms; return means and standard deviations
     for each time point across specified clusters
 
+    The window boundaries of every alignment time are looked up in the sorted spike times with
+    searchsorted. Blocks of trials are then binned with one bincount, smoothed along time and
+    written into the preallocated output, so the only full-size array is binned_spikes itself.
+
     :param spike_times: spike times (in seconds)
     :type spike_times: array-like
     :param spike_clusters: cluster ids corresponding to each event in `spikes`
@@ -1166,87 +2044,1392 @@ def calculate_peths(
     :type smoothing: float
     :param return_fr: `True` to return (estimated) firing rate, `False` to return spike counts
     :type return_fr: bool
+    :param dtype: data type of binned_spikes, np.float32 halves the memory footprint and
+        np.int16 can be used for raw spike counts (only when `smoothing=0`)
+    :type dtype: numpy dtype
     :return: peths, binned_spikes
     :rtype: peths: Bunch({'mean': peth_means, 'std': peth_stds, 'tscale': ts, 'cscale': ids})
     :rtype: binned_spikes: np.array (n_align_times, n_clusters, n_bins)
     """
 
+    dtype = np.dtype(dtype)
+    if (smoothing > 0) and (dtype.kind != 'f'):
+        raise ValueError('Smoothed peths can only be returned as a floating point dtype')
+
     # initialize containers
     n_offset = 5 * int(np.ceil(smoothing / bin_size))  # get rid of boundary effects for smoothing
     n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
     n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
     n_bins = n_bins_pre + n_bins_post
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
+    ids = np.unique(cluster_ids)
+    align_times = np.asarray(align_times, dtype=float)
+    spike_times = np.asarray(spike_times)
+    spike_clusters = np.asarray(spike_clusters)
+    if ids.size == 0:
+        tscale = np.arange(n_offset - n_bins_pre, n_bins_post - n_offset + 1) * bin_size
+        n_out = tscale.size - 1
+        peths = dict({'means': np.empty((0, n_out)), 'stds': np.empty((0, n_out)),
+                      'tscale': (tscale[:-1] + tscale[1:]) / 2, 'cscale': ids})
+        return peths, np.empty((align_times.size, 0, n_out), dtype=dtype)
+
+    # only keep spikes of the requested clusters, sorted in time
+    clu_inds = np.searchsorted(ids, spike_clusters)
+    clu_inds[clu_inds == ids.size] = 0
+    idxs = ids[clu_inds] == spike_clusters
+    spike_times = spike_times[idxs]
+    clu_inds = clu_inds[idxs]
+    if np.any(np.diff(spike_times) < 0):
+        order = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[order]
+        clu_inds = clu_inds[order]
+
+    # window boundaries of all trials (ts represent bin edges, there is one extra bin at the end
+    # which holds the spikes that fall exactly on the last edge)
+    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+    win_start = tscale[0] + align_times
+    win_end = tscale[-1] + align_times
+    first_spike = np.searchsorted(spike_times, win_start, side='left')
+    last_spike = np.searchsorted(spike_times, win_end, side='right')
+    n_spikes = last_spike - first_spike
 
-    # build gaussian kernel if requested
     if smoothing > 0:
         w = n_bins - 1 if n_bins % 2 == 0 else n_bins
         window = gaussian(w, std=smoothing / bin_size)
         # half (causal) gaussian filter
         # window[int(np.ceil(w/2)):] = 0
         window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
+        # drop the tails of the kernel that are below floating point precision
+        n_tail = np.argmax(window >= window.max() * np.finfo(float).eps)
+        window = window[n_tail:window.size - n_tail]
+
+    # bin and smooth blocks of trials directly into the output, the boundary bins are dropped
+    keep_bins = slice(n_offset, n_bins - n_offset)
+    binned_spikes = np.empty((align_times.size, ids.size, n_bins - 2 * n_offset), dtype=dtype)
+    block_size = max(1, PETH_BLOCK_ELEMENTS // (ids.size * (n_bins + 1)))
+    for start in range(0, align_times.size, block_size):
+        block = slice(start, min(start + block_size, align_times.size))
+        n_trials = block.stop - block.start
+
+        # gather the spikes of these trials in one flat array (spikes can be in several trials)
+        trial_inds = np.repeat(np.arange(n_trials), n_spikes[block])
+        spike_inds = (np.arange(trial_inds.size)
+                      - np.repeat(np.cumsum(n_spikes[block]) - n_spikes[block], n_spikes[block])
+                      + np.repeat(first_spike[block], n_spikes[block]))
+        xind = np.floor((spike_times[spike_inds] - win_start[block][trial_inds])
+                        / bin_size).astype(np.int64)
+        ind3d = (trial_inds * ids.size + clu_inds[spike_inds]) * (n_bins + 1) + xind
+        block_counts = np.bincount(ind3d, minlength=n_trials * ids.size * (n_bins + 1)).reshape(
+            n_trials, ids.size, n_bins + 1)
 
-    ids = np.unique(cluster_ids)
+        if smoothing > 0:
+            block_counts = convolve1d(block_counts.astype(dtype), window.astype(dtype), axis=2,
+                                      mode='constant')
+            if return_fr:
+                block_counts /= bin_size
+        binned_spikes[block] = block_counts[:, :, keep_bins]
+    tscale = tscale[n_offset:n_bins + 1 - n_offset]
+
+    # average per block of clusters, binned_spikes holds raw counts when smoothing=0
+    peth_means = np.empty(binned_spikes.shape[1:])
+    peth_stds = np.empty(binned_spikes.shape[1:])
+    scale = bin_size if return_fr and (smoothing == 0) else 1
+    clu_block_size = max(1, PETH_BLOCK_ELEMENTS // (align_times.size * binned_spikes.shape[2]))
+    for start in range(0, ids.size, clu_block_size):
+        block = slice(start, start + clu_block_size)
+        block_rates = binned_spikes[:, block].astype(np.float64)
+        if scale != 1:
+            block_rates /= scale
+        peth_means[block] = np.mean(block_rates, axis=0)
+        peth_stds[block] = np.std(block_rates, axis=0)
 
-    # filter spikes outside of the loop
-    idxs = np.bitwise_and(spike_times >= np.min(align_times) - (n_bins_pre + 1) * bin_size,
-                          spike_times <= np.max(align_times) + (n_bins_post + 1) * bin_size)
-    idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
-    spike_times = spike_times[idxs]
-    spike_clusters = spike_clusters[idxs]
+    # package output
+    tscale = (tscale[:-1] + tscale[1:]) / 2
+    peths = dict({'means': peth_means, 'stds': peth_stds, 'tscale': tscale, 'cscale': ids})
+    return peths, binned_spikes
 
-    # compute floating tscale
-    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        xind = (np.floor((i_spikes - np.min(ts)) / bin_size)).astype(np.int64)
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
-
-        # smooth
-        if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode='same', method='auto')[:-1]
 
-    # average
-    if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
+def split_spikes_per_cluster(spike_times, spike_clusters):
+    """
+    Split the spike times per cluster in one pass, using a stable argsort on the cluster ids
+    so that the spikes of each cluster stay in their original (temporal) order.
+
+    Returns
+    cluster_ids : 1D array
+        Sorted unique cluster ids
+    cluster_spikes : list of 1D arrays
+        Spike times of each cluster in cluster_ids
+    """
+    order = np.argsort(spike_clusters, kind='stable')
+    cluster_ids, offsets = np.unique(np.asarray(spike_clusters)[order], return_index=True)
+    return cluster_ids, np.split(np.asarray(spike_times)[order], offsets[1:])
+
+
+def _zeta_single_neuron(args):
+    """
+    Worker of zeta_tests_parallel: ZETA test of one neuron and the latency of the peak of its
+    instantaneous firing rate
+    """
+    from zetapy import getZeta
+    from dlc_functions import smooth_interpolate_signal_sg
+
+    neuron_id, spike_times, event_times, seed, zeta_kwargs = args
+    np.random.seed(seed)
+    p_value, _, dRate = getZeta(spike_times, event_times, boolReturnRate=True, **zeta_kwargs)
+
+    # Find modulation onset
+    if (len(dRate) == 0) | (p_value > 0.05):
+        return neuron_id, p_value, np.nan, np.nan
+    elif dRate['vecRate'].shape[0] < 50:
+        return neuron_id, p_value, np.nan, np.nan
+
+    # Do some smoothing of the inst firing rate to get rid of super narrow peaks
+    smooth_rate = zscore(smooth_interpolate_signal_sg(dRate['vecRate'], window=21, order=3))
+
+    # Find largest positive peak
+    peak_locs, peak_props = find_peaks(smooth_rate[dRate['vecT'] < 1], threshold=0,
+                                       prominence=-np.inf)
+    if len(peak_locs) == 0:
+        pos_peak_loc = []
+        pos_prominence = 0
     else:
-        binned_spikes_ = np.copy(binned_spikes)
-    if return_fr:
-        binned_spikes_ /= bin_size
+        pos_peak_loc = peak_locs[np.argmax(peak_props['prominences'])]
+        pos_prominence = np.max(peak_props['prominences'])
+
+    # Find largest negative peak
+    peak_locs, peak_props = find_peaks(-smooth_rate[dRate['vecT'] < 1], threshold=0,
+                                       prominence=-np.inf)
+    if len(peak_locs) == 0:
+        neg_peak_loc = []
+        neg_prominence = 0
+    else:
+        neg_peak_loc = peak_locs[np.argmax(peak_props['prominences'])]
+        neg_prominence = np.max(peak_props['prominences'])
 
-    peth_means = np.mean(binned_spikes_, axis=0)
-    peth_stds = np.std(binned_spikes_, axis=0)
+    # Get largest peak
+    if pos_prominence > neg_prominence:
+        peak_loc = pos_peak_loc
+    else:
+        peak_loc = neg_peak_loc
+
+    # Get peak onset (zero crossing of the z-scored inst firing rate)
+    if type(peak_loc) == list:
+        return neuron_id, p_value, np.nan, np.nan
+    zero_crossings = np.where(np.diff(np.sign(smooth_rate[dRate['vecT'] < 1])))[0]
+    if zero_crossings.shape[0] == 0:
+        return neuron_id, p_value, dRate['vecT'][peak_loc], np.nan
+    rel_crossings = zero_crossings - peak_loc
+    if np.sum(np.sign(rel_crossings) == -1) == 0:
+        return neuron_id, p_value, dRate['vecT'][peak_loc], np.nan
+    onset_loc = zero_crossings[np.where(
+        rel_crossings == rel_crossings[np.sign(rel_crossings) == -1][-1])[0][0]]
+    return neuron_id, p_value, dRate['vecT'][peak_loc], dRate['vecT'][onset_loc]
+
+
+def zeta_tests_parallel(spike_times, spike_clusters, event_times, cluster_ids=None, n_workers=None,
+                        seed=42, **zeta_kwargs):
+    """
+    Run ZETA tests for all neurons over a pool of worker processes. The spikes are split per
+    neuron once and every neuron is seeded with seed + neuron_id, so that the results do not
+    depend on the number of workers or on the order in which neurons are processed.
 
-    if smoothing > 0:
-        peth_means = peth_means[:, n_offset:-n_offset]
-        peth_stds = peth_stds[:, n_offset:-n_offset]
-        binned_spikes = binned_spikes_[:, :, n_offset:-n_offset]
-        tscale = tscale[n_offset:-n_offset]
+    Parameters
+    ----------
+    spike_times : 1D array
+        Spike times (in seconds)
+    spike_clusters : 1D array
+        Cluster ids of each spike
+    event_times : 1D array
+        Times of the events to test against (e.g. onset of the laser pulse trains)
+    cluster_ids : 1D array
+        Subset of clusters to test, if None all clusters in spike_clusters are tested
+    n_workers : int
+        Number of worker processes, None uses all cores and 1 runs in the current process
+    seed : int
+        Random seed, the seed of each neuron is seed + neuron_id
+    **zeta_kwargs
+        Passed on to zetapy.getZeta
+
+    Yields
+    ------
+    (neuron_id, p_value, latency_peak, latency_peak_onset) per neuron, in order of cluster ids
+    """
+    all_ids, cluster_spikes = split_spikes_per_cluster(spike_times, spike_clusters)
+    if cluster_ids is None:
+        cluster_ids = all_ids
+    tasks = ((neuron_id, cluster_spikes[ind], event_times, seed + int(neuron_id), zeta_kwargs)
+             for ind, neuron_id in zip(np.searchsorted(all_ids, cluster_ids), cluster_ids))
+    if n_workers == 1:
+        yield from map(_zeta_single_neuron, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            yield from executor.map(_zeta_single_neuron, tasks, chunksize=4)
 
-    # package output
-    tscale = (tscale[:-1] + tscale[1:]) / 2
-    peths = dict({'means': peth_means, 'stds': peth_stds, 'tscale': tscale, 'cscale': ids})
-    return peths, binned_spikes
+
+def _hmm_forward(log_likes, log_pi0, log_Ps, log_alpha_prev=None):
+    """
+    Forward pass of an HMM for all sequences at once in log space
+
+    Parameters
+    ----------
+    log_likes : 3D array
+        Log-likelihood of every time bin under every state (sequences x time bins x states)
+    log_pi0 : 1D array
+        Normalized log initial state distribution
+    log_Ps : 2D array
+        Normalized log transition matrix (from state x to state)
+    log_alpha_prev : 2D array
+        Log forward messages of the bin before the first bin (sequences x states) to continue
+        a sequence, if None the sequences start from log_pi0
+
+    Returns
+    -------
+    log_alphas : 3D array
+        Log forward messages (sequences x time bins x states)
+    """
+    n_seqs, n_bins, n_states = log_likes.shape
+    Ps = np.exp(log_Ps)
+    log_alphas = np.empty((n_seqs, n_bins, n_states))
+    with np.errstate(divide='ignore'):
+        if log_alpha_prev is None:
+            log_alphas[:, 0] = log_pi0 + log_likes[:, 0]
+        else:
+            m = log_alpha_prev.max(axis=1, keepdims=True)
+            log_alphas[:, 0] = np.log(np.exp(log_alpha_prev - m) @ Ps) + m + log_likes[:, 0]
+
+        # The transitions are a matrix product relative to the maximum per sequence
+        for t in range(1, n_bins):
+            m = log_alphas[:, t - 1].max(axis=1, keepdims=True)
+            log_alphas[:, t] = (np.log(np.exp(log_alphas[:, t - 1] - m) @ Ps) + m
+                                + log_likes[:, t])
+    return log_alphas
+
+
+def _hmm_backward(log_likes, log_Ps):
+    """
+    Backward pass of an HMM for all sequences at once in log space, see _hmm_forward
+    """
+    n_seqs, n_bins, n_states = log_likes.shape
+    Ps = np.exp(log_Ps)
+    log_betas = np.zeros((n_seqs, n_bins, n_states))
+    with np.errstate(divide='ignore'):
+        for t in range(n_bins - 2, -1, -1):
+            b = log_likes[:, t + 1] + log_betas[:, t + 1]
+            m = b.max(axis=1, keepdims=True)
+            log_betas[:, t] = np.log(np.exp(b - m) @ Ps.T) + m
+    return log_betas
+
+
+def _poisson_hmm_log_likes(counts, log_pi0, log_Ps, log_lambdas):
+    """
+    Normalized log parameters of a Poisson HMM and the log-likelihood of every time bin under
+    every state (trials x time bins x states)
+    """
+    from scipy.special import gammaln, logsumexp
+
+    counts = np.asarray(counts, dtype=float)
+    log_pi0 = log_pi0 - logsumexp(log_pi0)
+    log_Ps = log_Ps - logsumexp(log_Ps, axis=1, keepdims=True)
+    log_likes = (counts @ log_lambdas.T - np.exp(log_lambdas).sum(axis=1)
+                 - gammaln(counts + 1).sum(axis=2, keepdims=True))
+    return log_pi0, log_Ps, log_likes
+
+
+def poisson_hmm_log_likelihood(counts, log_pi0, log_Ps, log_lambdas):
+    """
+    Marginal log-likelihood of every trial under a fitted Poisson HMM, see poisson_hmm_decode
+    for the parameters. Returns a 1D array (trials).
+    """
+    from scipy.special import logsumexp
+    log_pi0, log_Ps, log_likes = _poisson_hmm_log_likes(counts, log_pi0, log_Ps, log_lambdas)
+    return logsumexp(_hmm_forward(log_likes, log_pi0, log_Ps)[:, -1], axis=1)
+
+
+def poisson_hmm_decode(counts, log_pi0, log_Ps, log_lambdas):
+    """
+    Forward filtering, forward-backward smoothing and Viterbi decoding of a fitted Poisson HMM
+    for all trials at once in log space. Every time step is one batched operation over trials,
+    which avoids the per trial overhead of the filter and most_likely_states methods of ssm.
+
+    Parameters
+    ----------
+    counts : 3D array
+        Spike counts (trials x time bins x neurons)
+    log_pi0 : 1D array
+        Log initial state distribution, e.g. hmm.init_state_distn.log_pi0
+    log_Ps : 2D array
+        Log transition matrix (from state x to state), e.g. hmm.transitions.log_Ps
+    log_lambdas : 2D array
+        Log firing rate per state and neuron (states x neurons), e.g. hmm.observations.log_lambdas
+
+    Returns
+    -------
+    filtered : 3D array
+        P(state | counts up to and including this bin) (trials x time bins x states)
+    smoothed : 3D array
+        P(state | all counts of the trial) (trials x time bins x states)
+    states : 2D array
+        Most likely (Viterbi) state path (trials x time bins)
+    """
+    from scipy.special import logsumexp
+
+    log_pi0, log_Ps, log_likes = _poisson_hmm_log_likes(counts, log_pi0, log_Ps, log_lambdas)
+    n_trials, n_bins, n_states = log_likes.shape
+    log_alphas = _hmm_forward(log_likes, log_pi0, log_Ps)
+    log_betas = _hmm_backward(log_likes, log_Ps)
+
+    filtered = np.exp(log_alphas - logsumexp(log_alphas, axis=2, keepdims=True))
+    smoothed = log_alphas + log_betas
+    smoothed = np.exp(smoothed - logsumexp(smoothed, axis=2, keepdims=True))
+
+    # Viterbi: best score of the rest of the trial backwards, then trace the path forwards
+    scores = np.zeros((n_trials, n_states))
+    best_next = np.empty((n_trials, n_bins, n_states), dtype=int)
+    for t in range(n_bins - 2, -1, -1):
+        vals = log_Ps[None, :, :] + (scores + log_likes[:, t + 1])[:, None, :]
+        best_next[:, t + 1] = np.argmax(vals, axis=2)
+        scores = np.max(vals, axis=2)
+    states = np.empty((n_trials, n_bins), dtype=int)
+    states[:, 0] = np.argmax(scores + log_pi0 + log_likes[:, 0], axis=1)
+    for t in range(1, n_bins):
+        states[:, t] = best_next[np.arange(n_trials), t, states[:, t - 1]]
+    return filtered, smoothed, states
+
+
+def _split_hmm_states(log_pi0, log_Ps, log_lambdas, occupancy, n_new, rng, jitter=0.1):
+    """
+    Add n_new states to a fitted Poisson HMM by repeatedly splitting the state with the highest
+    occupancy in two. Both halves share the incoming transitions and the initial probability of
+    the split state and their log firing rates are pushed apart by a small random jitter.
+    """
+    pi0 = np.exp(log_pi0 - np.max(log_pi0))
+    pi0 /= pi0.sum()
+    Ps = np.exp(log_Ps - np.max(log_Ps, axis=1, keepdims=True))
+    Ps /= Ps.sum(axis=1, keepdims=True)
+    log_lambdas = log_lambdas.copy()
+    occupancy = np.asarray(occupancy, dtype=float).copy()
+    for _ in range(n_new):
+        s = np.argmax(occupancy)
+        pi0[s] /= 2
+        pi0 = np.append(pi0, pi0[s])
+        Ps[:, s] /= 2
+        Ps = np.column_stack((Ps, Ps[:, s]))
+        Ps = np.vstack((Ps, Ps[s]))
+        shift = rng.normal(0, jitter, log_lambdas.shape[1])
+        log_lambdas = np.vstack((log_lambdas, log_lambdas[s] + shift))
+        log_lambdas[s] -= shift
+        occupancy[s] /= 2
+        occupancy = np.append(occupancy, occupancy[s])
+    return np.log(pi0), np.log(Ps), log_lambdas
+
+
+def cross_validate_poisson_hmm(binned_spikes, n_states, train_index, test_index, seed=0,
+                               num_iters=100, tolerance=1e-4):
+    """
+    Fit Poisson HMMs with an increasing number of states on the training trials of one fold and
+    get their log-likelihood on the held-out trials. The smallest number of states is
+    initialized by ssm, every next model is warm-started from the previous solution by splitting
+    its most occupied states. EM stops when the training log-likelihood reaches a plateau.
+    This is one independent task so that all folds and restarts can be run on a process pool.
+
+    Parameters
+    ----------
+    binned_spikes : 3D array
+        Spike counts (trials x neurons x time bins)
+    n_states : 1D array
+        Increasing numbers of states to fit
+    train_index, test_index : 1D arrays
+        Trials to fit the HMMs on and to evaluate them on
+    seed : int
+        Random seed of the initialization and the state splits (one per restart)
+    num_iters : int
+        Maximum number of EM iterations per model
+    tolerance : float
+        EM stops when the training log-likelihood per time bin improves less than this
+
+    Returns
+    -------
+    train_ll, test_ll : 1D arrays
+        Log-likelihood of the training and the held-out trials per number of states
+    """
+    import ssm
+
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    trial_data = np.transpose(binned_spikes, (0, 2, 1))
+    train_data, test_data = trial_data[train_index], trial_data[test_index]
+    n_neurons = trial_data.shape[2]
+    em_tolerance = tolerance * train_data.shape[0] * train_data.shape[1]
+
+    train_ll, test_ll = np.empty(len(n_states)), np.empty(len(n_states))
+    for j, K in enumerate(n_states):
+        simple_hmm = ssm.HMM(K, n_neurons, observations='poisson')
+        if j == 0:
+            simple_hmm.fit(list(train_data), method='em', transitions='sticky',
+                           num_iters=num_iters, tolerance=em_tolerance)
+        else:
+            # Warm start from the previous solution
+            _, smoothed, _ = poisson_hmm_decode(train_data, *params)
+            (simple_hmm.init_state_distn.log_pi0, simple_hmm.transitions.log_Ps,
+             simple_hmm.observations.log_lambdas) = _split_hmm_states(
+                *params, smoothed.sum(axis=(0, 1)), K - n_states[j - 1], rng)
+            simple_hmm.fit(list(train_data), method='em', transitions='sticky', initialize=False,
+                           num_iters=num_iters, tolerance=em_tolerance)
+        params = (simple_hmm.init_state_distn.log_pi0, simple_hmm.transitions.log_Ps,
+                  simple_hmm.observations.log_lambdas)
+        train_ll[j] = np.sum(poisson_hmm_log_likelihood(train_data, *params))
+        test_ll[j] = np.sum(poisson_hmm_log_likelihood(test_data, *params))
+    return train_ll, test_ll
+
+
+def finished_futures(futures, max_pending=0):
+    """
+    Wait until at most max_pending of the submitted futures are unfinished and yield the finished
+    ones. Calling this after every submit bounds the number of tasks, and so the copies of their
+    input data, that wait in the queue of a process pool; max_pending=0 waits for all futures.
+
+    Parameters
+    ----------
+    futures : dict
+        Submitted futures with a description of their task, finished futures are removed
+
+    Yields
+    ------
+    future, task
+        A finished future and its task description
+    """
+    while len(futures) > max_pending:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future, futures.pop(future)
+
+
+def fit_poisson_hmm(binned_spikes, n_states, save_file, folds=None, **save_kwargs):
+    """
+    Fit a Poisson HMM to the binned spike counts of one insertion and region and save the fit.
+    Every fit is an independent task so that the fits of all insertions and regions can be run on
+    a process pool.
+
+    Parameters
+    ----------
+    binned_spikes : 3D array
+        Spike counts (trials x neurons x time bins)
+    n_states : int
+        Number of hidden states
+    save_file : str
+        Path of the .npz file the fit is saved to
+    folds : list of (train_index, test_index)
+        Cross-validation folds, the HMM is fit on the training trials of each fold and the states
+        of the test trials are inferred. If None the HMM is fit and decoded on all trials.
+    **save_kwargs
+        Extra arrays that are saved with the fit (e.g. event times and time axis)
+
+    Returns
+    -------
+    save_file : str
+        Path of the saved fit, which holds the arrays in save_kwargs and
+        lls : log-likelihood per EM iteration, concatenated over folds (fold in lls_fold)
+        log_pi0, log_Ps, log_lambdas : fitted parameters (of the last fold)
+        posterior, smoothed : filtered and smoothed state probabilities (trials x bins x states)
+        states : most likely (Viterbi) states (trials x time bins)
+        state_rates : mean spike count per trial and state (trials x states)
+    """
+    import ssm
+
+    n_trials, n_neurons, n_bins = binned_spikes.shape
+    if folds is None:
+        folds = [(np.arange(n_trials), np.arange(n_trials))]
+
+    # Spike counts as (trials x time_bins x neurons)
+    trial_data = np.transpose(binned_spikes, (0, 2, 1))
+
+    simple_hmm = ssm.HMM(n_states, n_neurons, observations='poisson')
+    posterior = np.empty((n_trials, n_bins, n_states))
+    smoothed = np.empty((n_trials, n_bins, n_states))
+    states = np.empty((n_trials, n_bins), dtype=int)
+    lls, lls_fold = [], []
+    for k, (train_index, test_index) in enumerate(folds):
+
+        # Fit HMM on training data
+        these_lls = simple_hmm.fit(list(trial_data[train_index]), method='em',
+                                   transitions='sticky')
+        lls.append(np.asarray(these_lls))
+        lls_fold.append(np.full(len(these_lls), k))
+
+        # Get posterior probability and most likely states of all test trials at once
+        (posterior[test_index], smoothed[test_index],
+         states[test_index]) = poisson_hmm_decode(
+            trial_data[test_index], simple_hmm.init_state_distn.log_pi0,
+            simple_hmm.transitions.log_Ps, simple_hmm.observations.log_lambdas)
+
+    # Mean spike count over neurons and time bins per trial and state
+    state_rates = np.full((n_trials, n_states), np.nan)
+    for s in range(n_states):
+        in_state = states == s
+        state_counts = np.einsum('tnb,tb->t', binned_spikes, in_state)
+        n_counts = in_state.sum(axis=1) * n_neurons
+        np.divide(state_counts, n_counts, out=state_rates[:, s], where=n_counts > 0)
+
+    makedirs(dirname(save_file), exist_ok=True)
+    np.savez_compressed(save_file, lls=np.concatenate(lls), lls_fold=np.concatenate(lls_fold),
+                        log_pi0=simple_hmm.init_state_distn.log_pi0,
+                        log_Ps=simple_hmm.transitions.log_Ps,
+                        log_lambdas=simple_hmm.observations.log_lambdas,
+                        posterior=posterior, smoothed=smoothed, states=states,
+                        state_rates=state_rates,
+                        **save_kwargs)
+    return save_file
+
+
+def load_hmm_fits(fit_dir, pids=None):
+    """
+    Load the HMM fits saved in fit_dir, the Poisson HMM fits of fit_poisson_hmm
+    ({pid}_{region}.npz) or the face states of fit_face_arhmm ({eid}.npz)
+
+    Parameters
+    ----------
+    fit_dir : str
+        Directory with the saved fits
+    pids : list
+        Only load the fits of these insertions (or sessions for the face states), the id is the
+        part of the file name before the first underscore. If None all fits are loaded.
+
+    Returns
+    -------
+    fits : list of Bunch
+        The saved arrays of every fit, zero-dimensional arrays (e.g. subject, pid and region)
+        are returned as scalars
+    """
+    fits = []
+    for fit_file in sorted(glob(join(fit_dir, '*.npz'))):
+        if (pids is not None) and (basename(fit_file)[:-4].split('_')[0] not in pids):
+            continue
+        with np.load(fit_file) as fit_data:
+            fits.append(Bunch({key: fit_data[key][()] if fit_data[key].ndim == 0 else fit_data[key]
+                               for key in fit_data.files}))
+    return fits
+
+
+def smoothed_rate_chunks(spike_times, spike_clusters, cluster_ids, t_start, t_end, bin_size,
+                         smoothing, chunk_size=60):
+    """
+    Smoothed firing rates of a long recording in time chunks, so that the rates of the whole
+    recording never have to be in memory at once. Every chunk is binned with calculate_peths on
+    the spikes around it, which makes the Gaussian smoothing continuous over the chunk borders.
+
+    Parameters
+    ----------
+    spike_times : 1D array
+        Spike times (in seconds), sorted
+    spike_clusters : 1D array
+        Cluster ids of each spike
+    cluster_ids : 1D array
+        Clusters to get the rates of
+    t_start, t_end : float
+        Start and end of the period (in seconds)
+    bin_size, smoothing : float
+        Bin size and standard deviation of the Gaussian smoothing kernel (in seconds)
+    chunk_size : float
+        Duration of the chunks (in seconds)
+
+    Yields
+    ------
+    times : 1D array
+        Time of the bin centers of this chunk
+    rates : 2D array
+        Firing rates (time bins x neurons)
+    """
+    n_bins = int(np.ceil((t_end - t_start) / bin_size))
+    chunk_bins = max(int(np.round(chunk_size / bin_size)), 1)
+    margin = (5 * np.ceil(smoothing / bin_size) + 1) * bin_size
+    for first_bin in range(0, n_bins, chunk_bins):
+        n_chunk_bins = min(chunk_bins, n_bins - first_bin)
+        chunk_start = t_start + first_bin * bin_size
+        first_spike, last_spike = np.searchsorted(
+            spike_times, [chunk_start - margin, chunk_start + n_chunk_bins * bin_size + margin])
+        peth, _ = calculate_peths(spike_times[first_spike:last_spike],
+                                  spike_clusters[first_spike:last_spike], cluster_ids,
+                                  [chunk_start], pre_time=0, post_time=n_chunk_bins * bin_size,
+                                  bin_size=bin_size, smoothing=smoothing)
+        yield peth['tscale'][:n_chunk_bins] + chunk_start, peth['means'][:, :n_chunk_bins].T
+
+
+def incremental_pca(make_chunks, n_components):
+    """
+    Standardize the firing rates of a long recording and project them onto their principal
+    components chunk by chunk with an incremental PCA
+
+    Parameters
+    ----------
+    make_chunks : function
+        Returns a new iterator over (times, rates) chunks, e.g. smoothed_rate_chunks. It is called
+        three times: to fit the scaling, to fit the PCA and to project the rates.
+    n_components : int
+        Number of principal components
+
+    Returns
+    -------
+    Bunch with times (time bins), projection (time bins x components), mean_rate (mean firing
+    rate over neurons per time bin) and the fitted scaler and pca
+    """
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler(with_mean=True, with_std=True)
+    for _, rates in make_chunks():
+        scaler.partial_fit(rates)
+
+    # Chunks with fewer time bins than components are added to the next chunk
+    pca = IncrementalPCA(n_components=n_components)
+    leftover = np.empty((0, scaler.n_features_in_))
+    for _, rates in make_chunks():
+        leftover = np.vstack((leftover, scaler.transform(rates)))
+        if leftover.shape[0] >= n_components:
+            pca.partial_fit(leftover)
+            leftover = leftover[:0]
+
+    times, projection, mean_rate = [], [], []
+    for these_times, rates in make_chunks():
+        times.append(these_times)
+        projection.append(pca.transform(scaler.transform(rates)))
+        mean_rate.append(np.mean(rates, axis=1))
+    return Bunch(times=np.concatenate(times), projection=np.concatenate(projection),
+                 mean_rate=np.concatenate(mean_rate), scaler=scaler, pca=pca)
+
+
+def _arhmm_log_likes(x_prev, x, weights, Sigmas):
+    """
+    Log-likelihood of every time bin of x (... x dimensions) under every state of a Gaussian
+    AR(1)-HMM, given the bins before them in x_prev. Returns an array (... x states).
+    """
+    n_dims = x.shape[-1]
+    regressors = np.concatenate((x_prev, np.ones(x_prev.shape[:-1] + (1,))), axis=-1)
+    resid = x[..., None, :] - np.einsum('...r,kdr->...kd', regressors, weights)
+    precisions = np.linalg.inv(Sigmas)
+    _, log_dets = np.linalg.slogdet(Sigmas)
+    mahalanobis = np.einsum('...kd,kde,...ke->...k', resid, precisions, resid)
+    return -0.5 * (mahalanobis + log_dets + n_dims * np.log(2 * np.pi))
+
+
+def fit_arhmm_stochastic(x, n_states, autoregressive=True, seq_len=100, batch_size=20,
+                         n_iters=300, forgetting=0.6, seed=0):
+    """
+    Fit a Gaussian AR(1)-HMM (ssm observations='ar') to one long sequence with stochastic EM on
+    minibatches of random subsequences. The sufficient statistics of every minibatch are blended
+    into running averages with a step size of (iteration + 1) ** -forgetting, so the time and
+    memory per iteration do not depend on the length of the recording.
+
+    Parameters
+    ----------
+    x : 2D array
+        Observations (time bins x dimensions), e.g. the projection of incremental_pca
+    n_states : int
+        Number of states
+    autoregressive : bool
+        If False the observations are Gaussian without dependence on the previous bin (ssm
+        observations='gaussian')
+    seq_len, batch_size : int
+        Length (in time bins) and number of the random subsequences per iteration
+    n_iters : int
+        Number of stochastic EM iterations
+    forgetting : float
+        Decay of the step size, between 0.5 and 1
+    seed : int
+        Random seed of the initialization and the subsequences
+
+    Returns
+    -------
+    params : Bunch
+        log_pi0, log_Ps, weights (states x dimensions x dimensions + 1, the last column is the
+        bias) and Sigmas (states x dimensions x dimensions)
+    lls : 1D array
+        Log-likelihood per time bin of the minibatch of every iteration
+    """
+    from scipy.special import logsumexp
+    from sklearn.cluster import KMeans
+
+    rng = np.random.default_rng(seed)
+    n_bins, n_dims = x.shape
+    seq_len = min(seq_len, n_bins - 1)
+    n_reg = n_dims + 1 if autoregressive else 1
+
+    # Initialize the means with k-means on a random subset of time bins
+    init_bins = np.sort(rng.choice(np.arange(1, n_bins), size=min(n_bins - 1, 5000),
+                                   replace=False))
+    kmeans = KMeans(n_clusters=n_states, n_init=10, random_state=seed).fit(x[init_bins])
+    weights = np.zeros((n_states, n_dims, n_dims + 1))
+    weights[:, :, -1] = kmeans.cluster_centers_
+    Sigmas = np.tile(np.atleast_2d(np.cov(x[init_bins].T)) + 1e-4 * np.eye(n_dims),
+                     (n_states, 1, 1))
+    log_pi0 = np.full(n_states, -np.log(n_states))
+    log_Ps = np.log(0.95 * np.eye(n_states) + 0.05 / n_states)
+
+    stats, lls = None, np.empty(n_iters)
+    for it in range(n_iters):
+
+        # E-step on a minibatch of random subsequences
+        bins = rng.integers(1, n_bins - seq_len + 1, size=batch_size)[:, None] + np.arange(seq_len)
+        x_batch, x_prev = x[bins], x[bins - 1]
+        log_likes = _arhmm_log_likes(x_prev, x_batch, weights, Sigmas)
+        log_alphas = _hmm_forward(log_likes, log_pi0, log_Ps)
+        log_betas = _hmm_backward(log_likes, log_Ps)
+        log_Z = logsumexp(log_alphas[:, -1], axis=1)
+        lls[it] = np.sum(log_Z) / bins.size
+        gamma = np.exp(log_alphas + log_betas - log_Z[:, None, None]).reshape(-1, n_states)
+        xi = np.exp(log_alphas[:, :-1, :, None] + log_Ps
+                    + (log_likes + log_betas)[:, 1:, None, :] - log_Z[:, None, None, None])
+
+        # Sufficient statistics per time bin
+        if autoregressive:
+            regressors = np.concatenate((x_prev, np.ones(x_prev.shape[:-1] + (1,))), axis=-1)
+        else:
+            regressors = np.ones(x_prev.shape[:-1] + (1,))
+        regressors, x_flat = regressors.reshape(-1, n_reg), x_batch.reshape(-1, n_dims)
+        new_stats = dict(
+            n=gamma.sum(axis=0), trans=xi.sum(axis=(0, 1)),
+            rr=np.einsum('nk,ni,nj->kij', gamma, regressors, regressors),
+            xr=np.einsum('nk,ni,nj->kij', gamma, x_flat, regressors),
+            xx=np.einsum('nk,ni,nj->kij', gamma, x_flat, x_flat))
+        new_stats = {key: value / bins.size for key, value in new_stats.items()}
+        rho = (it + 1) ** -forgetting
+        if stats is None:
+            stats = new_stats
+        else:
+            stats = {key: (1 - rho) * stats[key] + rho * new_stats[key] for key in stats}
+
+        # M-step
+        W = np.linalg.solve(stats['rr'] + 1e-6 * np.eye(n_reg),
+                            np.transpose(stats['xr'], (0, 2, 1))).transpose(0, 2, 1)
+        weights[:, :, -n_reg:] = W
+        n = np.maximum(stats['n'], 1e-8)[:, None, None]
+        Sigmas = (stats['xx'] - W @ np.transpose(stats['xr'], (0, 2, 1))) / n
+        Sigmas = (Sigmas + np.transpose(Sigmas, (0, 2, 1))) / 2 + 1e-4 * np.eye(n_dims)
+        Ps = stats['trans'] + 1e-8
+        log_Ps = np.log(Ps / Ps.sum(axis=1, keepdims=True))
+
+    return Bunch(log_pi0=log_pi0, log_Ps=log_Ps, weights=weights, Sigmas=Sigmas), lls
+
+
+def decode_arhmm_chunks(x, params, chunk_size=10000):
+    """
+    Filter the states of a long sequence under a Gaussian AR(1)-HMM (fit_arhmm_stochastic)
+    chunk by chunk. The forward message of the last bin of every chunk is carried over to the
+    next chunk, so the memory use is bounded by the chunk size. The first bin has no previous
+    bin and only gets the initial state distribution.
+
+    Parameters
+    ----------
+    x : 2D array
+        Observations (time bins x dimensions)
+    params : Bunch
+        Fitted parameters from fit_arhmm_stochastic
+    chunk_size : int
+        Number of time bins per chunk
+
+    Returns
+    -------
+    states : 1D array
+        Most likely state of every time bin given the bins up to and including it
+    filtered : 2D array
+        P(state | bins up to and including this bin) (time bins x states)
+    """
+    from scipy.special import logsumexp
+
+    n_bins = x.shape[0]
+    n_states = params['log_Ps'].shape[0]
+    states = np.empty(n_bins, dtype=int)
+    filtered = np.empty((n_bins, n_states))
+    log_alpha = None
+    for start in range(0, n_bins, chunk_size):
+        stop = min(start + chunk_size, n_bins)
+        if start == 0:
+            log_likes = np.zeros((stop, n_states))
+            log_likes[1:] = _arhmm_log_likes(np.asarray(x[:stop - 1]), np.asarray(x[1:stop]),
+                                             params['weights'], params['Sigmas'])
+        else:
+            log_likes = _arhmm_log_likes(np.asarray(x[start - 1:stop - 1]),
+                                         np.asarray(x[start:stop]), params['weights'],
+                                         params['Sigmas'])
+        log_alphas = _hmm_forward(log_likes[None], params['log_pi0'], params['log_Ps'],
+                                  log_alpha_prev=log_alpha)[0]
+        log_alphas -= logsumexp(log_alphas, axis=1, keepdims=True)
+        log_alpha = log_alphas[-1:]
+        filtered[start:stop] = np.exp(log_alphas)
+        states[start:stop] = np.argmax(log_alphas, axis=1)
+    return states, filtered
+
+
+def load_face_features(eid, fm_file=None, n_components=25, downsample=1, one=None,
+                       force_rerun=False):
+    """
+    Load the facemap motion SVD of a session from the local face feature store. The first time a
+    session is requested the facemap output is loaded, aligned to the left camera timestamps (the
+    facemap data is the last part of the video), averaged over blocks of downsample frames and
+    written to disk as float32. Subsequent calls open the arrays as memory-mapped .npy files.
+
+    Parameters
+    ----------
+    eid : str
+        Session id
+    fm_file : str
+        Path to the facemap output of this session (*_proc.npy), only needed to build the store
+    n_components : int
+        Number of motion SVD components
+    downsample : int
+        Number of camera frames that are averaged into one sample
+    force_rerun : bool
+        Whether to rebuild the store of this session from the facemap output
+
+    Returns
+    -------
+    features : Bunch
+        Memory-mapped times (float64, samples) and motSVD (float32, samples x components)
+    """
+
+    store_path = join(paths()[1], 'FaceFeatures', eid)
+    if isfile(join(store_path, 'feature_info.json')) and not force_rerun:
+        with open(join(store_path, 'feature_info.json')) as json_file:
+            feature_info = json.load(json_file)
+        if ((feature_info['version'] == FACE_FEATURE_VERSION)
+                and (feature_info['n_components'] >= n_components)
+                and (feature_info['downsample'] == downsample)):
+            return Bunch(times=np.load(join(store_path, 'times.npy'), mmap_mode='r'),
+                         motSVD=np.load(join(store_path, 'motSVD.npy'),
+                                        mmap_mode='r')[:, :n_components])
+        fm_file = fm_file or feature_info['fm_file']
+        print('Face feature store is outdated, rebuilding..')
+    if fm_file is None:
+        raise FileNotFoundError(f'No face features stored for {eid}, pass the facemap file')
+
+    # Facemap data is the last part of the video
+    one = one or ONE()
+    times = one.load_dataset(eid, '_ibl_leftCamera.times.npy')
+    motSVD = np.load(fm_file, allow_pickle=True).item()['motSVD'][1][:, :n_components]
+    times = times[times.shape[0] - motSVD.shape[0]:]
+
+    # Average blocks of frames
+    n_samples = times.shape[0] // downsample
+    times = times[:n_samples * downsample].reshape(n_samples, downsample).mean(axis=1)
+    motSVD = motSVD[:n_samples * downsample].reshape(
+        n_samples, downsample, motSVD.shape[1]).mean(axis=1)
+
+    print('Writing face features to local store')
+    makedirs(store_path, exist_ok=True)
+    np.save(join(store_path, 'times.npy'), times.astype(np.float64))
+    np.save(join(store_path, 'motSVD.npy'), motSVD.astype(np.float32))
+
+    # Write feature info last so that an interrupted write is rebuilt the next time
+    with open(join(store_path, 'feature_info.json'), 'w') as json_file:
+        json.dump({'version': FACE_FEATURE_VERSION, 'eid': eid, 'fm_file': fm_file,
+                   'n_components': int(motSVD.shape[1]), 'downsample': downsample,
+                   'n_samples': int(n_samples)}, json_file)
+
+    return Bunch(times=np.load(join(store_path, 'times.npy'), mmap_mode='r'),
+                 motSVD=np.load(join(store_path, 'motSVD.npy'), mmap_mode='r')[:, :n_components])
+
+
+def fit_face_arhmm(eid, start_time, n_states, n_dims, save_file, downsample=1, **save_kwargs):
+    """
+    Fit an AR-HMM to the stored motion SVD of a session from start_time onwards and save the
+    most likely states, so that the state analyses can use them without refitting. Every session
+    is an independent task so that all sessions can be fit on a process pool.
+
+    Parameters
+    ----------
+    eid : str
+        Session id, the face features of this session need to be stored (load_face_features)
+    start_time : float
+        Only fit the samples after this time
+    n_states : int
+        Number of states
+    n_dims : int
+        Number of motion SVD components to fit
+    save_file : str
+        Path of the .npz file the states are saved to
+    downsample : int
+        Downsampling of the stored face features
+    **save_kwargs
+        Extra arrays that are saved with the states (e.g. laser stimulation times)
+
+    Returns
+    -------
+    save_file : str
+        Path of the saved states, which holds the arrays in save_kwargs and times, states (state
+        0 has the lowest first motion SVD component) and lls (log-likelihood per EM iteration)
+    """
+    import ssm
+
+    features = load_face_features(eid, n_components=n_dims, downsample=downsample)
+    use = features['times'] > start_time
+    motSVD = np.asarray(features['motSVD'][use], dtype=float)
+
+    arhmm = ssm.HMM(n_states, n_dims, observations='ar')
+    lls = arhmm.fit(motSVD)
+    zhat = arhmm.most_likely_states(motSVD)
+
+    # Make sure state 0 is inactive and state 1 active
+    if np.mean(motSVD[zhat == 0, 0]) > np.mean(motSVD[zhat == 1, 0]):
+        zhat = np.where((zhat == 0) | (zhat == 1), zhat ^ 1, zhat)
+
+    makedirs(dirname(save_file), exist_ok=True)
+    np.savez_compressed(save_file, times=np.asarray(features['times'][use]), states=zhat,
+                        lls=np.asarray(lls), **save_kwargs)
+    return save_file
+
+
+def count_spikes_in_windows(spike_times, spike_clusters, starts, ends, cluster_ids=None):
+    """
+    Count the spikes of every cluster in many time windows [start, end) with one
+    cumulative-count lookup: the window edges are located in the sorted spike times with
+    searchsorted and the spike counts per cluster are read from a cumulative histogram of the
+    spikes between consecutive edges.
+
+    Parameters
+    ----------
+    spike_times : 1D array
+        Spike times (in seconds), sorted
+    spike_clusters : 1D array
+        Cluster ids of each spike
+    starts, ends : array
+        Start and end times of the windows, can have any (matching) shape
+    cluster_ids : 1D array
+        Clusters to return counts for, if None all clusters in spike_clusters are returned
+
+    Returns
+    counts : array
+        Spike counts of shape starts.shape + (n_clusters,)
+    cluster_ids : 1D array
+        Cluster ids corresponding to the last axis of counts
+    """
+    starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
+    if (cluster_ids.size == 0) or (starts.size == 0):
+        return np.zeros(starts.shape + (cluster_ids.size,), dtype=np.int64), cluster_ids
+    clu_inds = np.searchsorted(cluster_ids, spike_clusters)
+    clu_inds[clu_inds == cluster_ids.size] = 0
+    clu_inds[cluster_ids[clu_inds] != spike_clusters] = cluster_ids.size  # not requested
+
+    # Cumulative spike count of every cluster at each unique window edge
+    edge_inds = np.searchsorted(spike_times, np.concatenate((starts.ravel(), ends.ravel())))
+    unique_inds, edge_pos = np.unique(edge_inds, return_inverse=True)
+    segment = np.searchsorted(unique_inds, np.arange(unique_inds[0], unique_inds[-1]), side='right')
+    cum_counts = np.bincount(segment * (cluster_ids.size + 1)
+                             + clu_inds[unique_inds[0]:unique_inds[-1]],
+                             minlength=unique_inds.size * (cluster_ids.size + 1))
+    cum_counts = np.cumsum(cum_counts.reshape(unique_inds.size, cluster_ids.size + 1)[:, :-1],
+                           axis=0)
+
+    edge_pos = edge_pos.ravel()
+    counts = cum_counts[edge_pos[starts.size:]] - cum_counts[edge_pos[:starts.size]]
+    return counts.reshape(starts.shape + (cluster_ids.size,)), cluster_ids
+
+
+def rank_sum_auc(counts_base, counts_stim, axis=0):
+    """
+    Area under the ROC curve of stim versus baseline for all remaining axes at once, computed
+    from the Mann-Whitney U statistic (tied values get the average rank). Equivalent to calling
+    sklearn's roc_auc_score for every neuron with labels 0 for baseline and 1 for stim.
+
+    Parameters
+    ----------
+    counts_base, counts_stim : array
+        Baseline and stimulation values, the observations are along axis
+    axis : int
+        Axis of the observations
+
+    Returns
+    auc : array
+        AUC with axis removed, 0.5 means no difference and 1 means stim > baseline
+    """
+    n_base, n_stim = counts_base.shape[axis], counts_stim.shape[axis]
+    ranks = rankdata(np.concatenate((counts_base, counts_stim), axis=axis), axis=axis)
+    rank_sum = np.sum(np.take(ranks, np.arange(n_base, n_base + n_stim), axis=axis), axis=axis)
+    return (rank_sum - n_stim * (n_stim + 1) / 2) / (n_base * n_stim)
+
+
+def permutation_modulation_index(spike_times, spike_clusters, event_times, pre_time=[0.5, 0],
+                                 post_time=[0, 0.5], n_permutations=500, time_range=None,
+                                 percentiles=[2.5, 97.5], chunk_size=100, seed=None):
+    """
+    Modulation index (2 * (AUC - 0.5)) of spike counts after versus before the events, together
+    with a null distribution obtained from pseudo-events drawn uniformly in time_range. All
+    pseudo-event times are drawn at once and the permutations are processed in chunks, counting
+    the spikes of every (permutation, event, neuron) with one lookup per chunk.
+
+    Parameters
+    ----------
+    spike_times : 1D array
+        Spike times (in seconds)
+    spike_clusters : 1D array
+        Cluster ids of each spike
+    event_times : 1D array
+        Times of the events
+    pre_time : two-element list
+        Baseline window relative to the events as [time before, time before], like
+        roc_single_event: [0.5, 0] is the 0.5 s before each event
+    post_time : two-element list
+        Window after the events, [0, 0.5] is the 0.5 s after each event
+    n_permutations : int
+        Number of sets of pseudo-events
+    time_range : two-element list
+        Interval from which the pseudo-events are drawn, defaults to first to last event
+    percentiles : list
+        Percentiles of the null distribution to return per neuron
+    chunk_size : int
+        Number of permutations that are processed at once, limits memory use
+    seed : int
+        Random seed for the pseudo-events
+
+    Returns
+    mod_idx : 1D array
+        Modulation index of each neuron
+    mod_idx_null : 2D array
+        Null distribution of the modulation index (n_permutations x n_neurons)
+    thresholds : 2D array
+        Percentiles of the null distribution (n_percentiles x n_neurons)
+    cluster_ids : 1D array
+        Cluster ids of the neurons
+    """
+    spike_times, spike_clusters = np.asarray(spike_times), np.asarray(spike_clusters)
+    if np.any(np.diff(spike_times) < 0):
+        order = np.argsort(spike_times, kind='stable')
+        spike_times, spike_clusters = spike_times[order], spike_clusters[order]
+    if time_range is None:
+        time_range = [np.min(event_times), np.max(event_times)]
+    cluster_ids = np.unique(spike_clusters)
+
+    def get_mod_idx(events):
+        base_counts, _ = count_spikes_in_windows(spike_times, spike_clusters,
+                                                 events - pre_time[0], events - pre_time[1],
+                                                 cluster_ids=cluster_ids)
+        stim_counts, _ = count_spikes_in_windows(spike_times, spike_clusters,
+                                                 events + post_time[0], events + post_time[1],
+                                                 cluster_ids=cluster_ids)
+        return 2 * (rank_sum_auc(base_counts, stim_counts, axis=-2) - 0.5)
+
+    mod_idx = get_mod_idx(np.asarray(event_times))
+
+    # Draw all pseudo-events at once
+    rng = np.random.default_rng(seed)
+    pseudo_events = rng.uniform(low=time_range[0], high=time_range[1],
+                                size=(n_permutations, len(event_times)))
+    mod_idx_null = np.empty((n_permutations, cluster_ids.size))
+    for k in range(0, n_permutations, chunk_size):
+        mod_idx_null[k:k + chunk_size] = get_mod_idx(pseudo_events[k:k + chunk_size])
+    thresholds = np.percentile(mod_idx_null, percentiles, axis=0)
+
+    return mod_idx, mod_idx_null, thresholds, cluster_ids
+
+
+def modulation_index_over_time(spike_times, spike_clusters, event_times, win_centers, win_size,
+                               baseline=None, cluster_ids=None):
+    """
+    Modulation index (2 * (AUC - 0.5)) of stimulation versus baseline spike counts for a series
+    of (possibly overlapping) time windows around the events. The spike counts of all windows
+    and events are obtained in one pass and the AUC of every neuron and window is computed from
+    rank statistics at once.
+
+    Parameters
+    ----------
+    spike_times : 1D array
+        Spike times (in seconds), sorted
+    spike_clusters : 1D array
+        Cluster ids of each spike
+    event_times : 1D array
+        Times of the events (e.g. laser train onsets)
+    win_centers : 1D array
+        Centers of the windows relative to the events (in seconds)
+    win_size : float
+        Width of each window (in seconds)
+    baseline : list
+        Baseline period [time before, time after] the event (e.g. [0.5, 0]), the baseline count
+        is the mean count over the windows with a center in this period. If None the last
+        window before the event is used as baseline.
+    cluster_ids : 1D array
+        Neurons to compute the modulation index for, if None all neurons in spike_clusters
+
+    Returns
+    mod_idx : 2D array
+        Modulation index of every neuron in every window (neurons x windows), float32
+    cluster_ids : 1D array
+        Cluster ids corresponding to the rows of mod_idx
+    """
+    win_centers = np.asarray(win_centers, dtype=float)
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
+    cluster_ids = np.asarray(cluster_ids)
+    sorted_ids = np.unique(cluster_ids)
+
+    # Spike counts of every event and window (events x windows x neurons)
+    win_starts = np.asarray(event_times)[:, None] + win_centers[None, :] - win_size / 2
+    counts, _ = count_spikes_in_windows(spike_times, spike_clusters, win_starts,
+                                        win_starts + win_size, cluster_ids=sorted_ids)
+    counts = counts[..., np.searchsorted(sorted_ids, cluster_ids)]
+
+    # Baseline spike counts (events x neurons)
+    if baseline is None:
+        counts_base = counts[:, np.where(win_centers < 0)[0][-1]]
+    else:
+        baseline_wins = (win_centers >= -baseline[0]) & (win_centers < baseline[1])
+        counts_base = np.mean(counts[:, baseline_wins], axis=1)
+
+    # AUC of all neurons and windows at once
+    auc = rank_sum_auc(np.broadcast_to(counts_base[:, None], counts.shape), counts, axis=0)
+    mod_idx = (2 * (auc.T - 0.5)).astype(np.float32)
+    return mod_idx, cluster_ids
+
+
+def pca_time_bins(binned_spks, n_components=10):
+    """
+    Principal component analysis of every time bin of a population activity tensor at once, gives
+    the same result as fitting sklearn's PCA(n_components) on binned_spks[:, :, tb] per time bin.
+
+    Parameters
+    ----------
+    binned_spks : 3D array
+        Population activity (trials x neurons x time bins)
+    n_components : int
+        Number of principal components to keep
+
+    Returns
+    pca_proj : 3D array
+        Projection onto the principal components (trials x components x time bins)
+    pca_fit : Bunch
+        'components' (time bins x components x neurons), 'mean' (time bins x neurons),
+        'explained_variance' and 'explained_variance_ratio' (time bins x components)
+    """
+    n_trials, n_neurons, _ = binned_spks.shape
+    if n_components > min(n_trials, n_neurons):
+        raise ValueError(f'n_components={n_components} must be between 0 and '
+                         f'min(n_trials, n_neurons)={min(n_trials, n_neurons)}')
+
+    # Batched SVD of the centered trials x neurons matrix of every time bin
+    act = np.transpose(binned_spks, (2, 0, 1)).astype(np.float64)
+    mean = np.mean(act, axis=1)
+    u, s, vh = np.linalg.svd(act - mean[:, None, :], full_matrices=False)
+
+    # Same sign convention as sklearn: largest absolute loading of each component is positive
+    sign = np.sign(np.take_along_axis(vh, np.argmax(np.abs(vh), axis=2)[..., None], axis=2))
+    vh *= sign
+    u *= np.swapaxes(sign, 1, 2)
+
+    explained_variance = s ** 2 / (n_trials - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        explained_variance_ratio = (explained_variance
+                                    / np.sum(explained_variance, axis=1, keepdims=True))
+    pca_fit = Bunch(components=vh[:, :n_components], mean=mean,
+                    explained_variance=explained_variance[:, :n_components],
+                    explained_variance_ratio=explained_variance_ratio[:, :n_components])
+    pca_proj = np.transpose(u[..., :n_components] * s[:, None, :n_components], (1, 2, 0))
+    return pca_proj, pca_fit
+
+
+def _zscore_trials(act):
+    """
+    Z-score activity (trials x neurons x time bins) over trials, scaled such that the dot product
+    of two neurons over trials is their Pearson correlation. Neurons without variance become NaN.
+    """
+    centered = act - np.mean(act, axis=0)
+    norm = np.sqrt(np.sum(centered ** 2, axis=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norm > 0, centered / norm, np.nan)
+
+
+def pairwise_correlation_time_bins(act_1, act_2, chunk_size=None, return_matrix=False):
+    """
+    Pearson correlation over trials between all pairs of neurons of two populations, per time bin.
+    Both populations are z-scored once after which the correlation block of every time bin is a
+    single matrix product. Pairs with a neuron without variance in a time bin are NaN and are
+    ignored in the mean.
+
+    Parameters
+    ----------
+    act_1, act_2 : 3D arrays
+        Activity of the two populations (trials x neurons x time bins)
+    chunk_size : int
+        Number of neurons of act_1 to correlate at once, limits memory use for large regions.
+        None correlates all neurons at once.
+    return_matrix : bool
+        Whether to also return the full correlation matrix (time bins x neurons 1 x neurons 2)
+
+    Returns
+    corr_mean : 1D array
+        Mean correlation over all neuron pairs per time bin
+    corr : 3D array
+        Correlation of every neuron pair per time bin, only if return_matrix is True
+    """
+    z_1, z_2 = _zscore_trials(act_1), _zscore_trials(act_2)
+    if chunk_size is None:
+        chunk_size = max(z_1.shape[1], 1)
+    if return_matrix:
+        corr = np.empty((z_1.shape[2], z_1.shape[1], z_2.shape[1]))
+    corr_sum = np.zeros(z_1.shape[2])
+    n_pairs = np.zeros(z_1.shape[2])
+    for start in range(0, z_1.shape[1], chunk_size):
+        corr_chunk = np.clip(np.einsum('nit,njt->tij', z_1[:, start:start + chunk_size], z_2,
+                                       optimize=True), -1, 1)
+        corr_sum += np.nansum(corr_chunk, axis=(1, 2))
+        n_pairs += np.sum(~np.isnan(corr_chunk), axis=(1, 2))
+        if return_matrix:
+            corr[:, start:start + chunk_size] = corr_chunk
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr_mean = corr_sum / n_pairs
+
+    if return_matrix:
+        return corr_mean, corr
+    return corr_mean
+
+
+def kfold_bootstrap_folds(n_trials, n_splits=2, n_bootstraps=50, shuffle=True, seed=None):
+    """
+    Fold assignment of every trial for repeated k-fold cross-validation, as an index tensor of
+    shape (n_bootstraps, n_trials). Folds are contiguous blocks of the (shuffled) trial order
+    with the same sizes as sklearn's KFold.
+    """
+    rng = np.random.default_rng(seed)
+    if shuffle:
+        order = np.argsort(rng.random((n_bootstraps, n_trials)), axis=1)
+    else:
+        order = np.tile(np.arange(n_trials), (n_bootstraps, 1))
+    fold_sizes = np.full(n_splits, n_trials // n_splits)
+    fold_sizes[:n_trials % n_splits] += 1
+    folds = np.empty((n_bootstraps, n_trials), dtype=int)
+    np.put_along_axis(folds, order, np.repeat(np.arange(n_splits), fold_sizes)[None, :], axis=1)
+    return folds
+
+
+def _whiten_time_bins(act, train_index):
+    """
+    Center and whiten the features of every time bin of act (trials x features x time bins) on
+    the training trials. Returns the whitened activity of all trials (trials x time bins x
+    features), the whitening matrices and the standard deviation of the features per time bin.
+    """
+    mean = np.mean(act[train_index], axis=0)
+    centered = act[train_index] - mean
+    cov = np.einsum('nit,njt->tij', centered, centered) / (train_index.size - 1)
+    evals, evecs = np.linalg.eigh(cov)
+    evals = np.maximum(evals, evals[:, -1:] * 1e-10)  # guard against rank deficient bins
+    whitener = np.einsum('tij,tj,tkj->tik', evecs, 1 / np.sqrt(evals), evecs)
+    std = np.sqrt(np.einsum('tii->ti', cov))
+    return np.einsum('nit,tij->ntj', act - mean, whitener), whitener, std
+
+
+def _pearson_last_axis(x, y):
+    x = x - np.mean(x, axis=-1, keepdims=True)
+    y = y - np.mean(y, axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.sum(x * y, axis=-1) / np.sqrt(np.sum(x ** 2, axis=-1) * np.sum(y ** 2, axis=-1))
+        r = np.clip(r, -1, 1)
+        t_stat = r * np.sqrt((x.shape[-1] - 2) / (1 - r ** 2))
+    return r, 2 * t_dist.sf(np.abs(t_stat), x.shape[-1] - 2)
+
+
+def jpecc(act_1, act_2, n_splits=2, n_bootstraps=50, shuffle=True, folds=None, pool_folds=False,
+          seed=None, n_threads=1, block_size=50):
+    """
+    Joint peri-event canonical correlation (jPECC) between two populations for every pair of
+    time bins. Instead of fitting an iterative CCA per pair of time bins, the activity of each
+    time bin is whitened once per training set, after which the first canonical pair of all
+    time bin pairs follows from a batched SVD of the whitened cross-covariance blocks. The
+    canonical weights are fit on the training trials and the correlation is computed on the
+    held-out trials.
+
+    Parameters
+    ----------
+    act_1, act_2 : 3D arrays
+        Activity (e.g. PCA projections) of the two populations (trials x features x time bins)
+    n_splits : int
+        Number of folds (k in k-fold), 1 fits and correlates on all trials (no cross-validation)
+    n_bootstraps : int
+        Number of times the k-fold split is repeated with a different random trial order
+    shuffle : bool
+        Whether to shuffle the trial order before splitting into folds
+    folds : 2D array
+        Custom fold assignment of every trial (n_bootstraps x n_trials), e.g. odd and even
+        trials, overrides n_splits, n_bootstraps and shuffle
+    pool_folds : bool
+        If True the held-out canonical scores of all folds are pooled and correlated once per
+        bootstrap, if False each fold is correlated separately
+    seed : int
+        Random seed for the trial shuffling
+    n_threads : int
+        Number of threads over which the rows (time bins of act_1) are divided
+    block_size : int
+        Number of rows that are processed at once, limits memory use
+
+    Returns
+    r_opto : 2D array
+        Median canonical correlation over all splits (time bins act_1 x time bins act_2)
+    p_opto : 2D array
+        Median p-value of the correlation over all splits
+    r_splits : 3D array
+        Canonical correlation of every split (n_splits x time bins x time bins)
+    """
+    n_trials, _, n_bins = act_1.shape
+    if folds is None:
+        folds = kfold_bootstrap_folds(n_trials, n_splits=n_splits, n_bootstraps=n_bootstraps,
+                                      shuffle=shuffle, seed=seed)
+    folds = np.atleast_2d(folds)
+    row_blocks = [np.arange(n_bins)[i:i + block_size] for i in range(0, n_bins, block_size)]
+
+    def correlate_block(rows, splits):
+        r_block, p_block = [], []
+        if pool_folds:
+            x_pooled = np.empty((rows.size, n_bins, n_trials))
+            y_pooled = np.empty((rows.size, n_bins, n_trials))
+        for train_index, test_index, whitened_1, whitened_2 in splits:
+            (act_1_w, whitener_1, std_1), (act_2_w, whitener_2, std_2) = whitened_1, whitened_2
+
+            # First canonical pair of all time bin pairs of this block
+            cross_cov = (act_1_w[train_index][:, rows].reshape(train_index.size, -1).T
+                         @ act_2_w[train_index].reshape(train_index.size, -1))
+            cross_cov = cross_cov.reshape(rows.size, act_1.shape[1], n_bins, act_2.shape[1])
+            u, _, vh = np.linalg.svd(cross_cov.transpose(0, 2, 1, 3))
+
+            # Canonical scores of the held-out trials
+            x = np.einsum('nti,tsi->tsn', act_1_w[test_index][:, rows], u[..., 0])
+            y = np.einsum('nsj,tsj->tsn', act_2_w[test_index], vh[..., 0, :])
+            if pool_folds:
+                # Scale and sign the scores like sklearn's CCA: unit norm weights on standardized
+                # features with the largest weight of act_1 positive, so that folds can be pooled
+                weights_1 = np.einsum('tij,tsj->tsi', whitener_1[rows], u[..., 0]) * std_1[rows, None]
+                weights_2 = np.einsum('sij,tsj->tsi', whitener_2, vh[..., 0, :]) * std_2[None]
+                sign = np.sign(np.take_along_axis(
+                    weights_1, np.argmax(np.abs(weights_1), axis=2)[..., None], axis=2))
+                x_pooled[:, :, test_index] = x * sign / np.linalg.norm(weights_1, axis=2, keepdims=True)
+                y_pooled[:, :, test_index] = y * sign / np.linalg.norm(weights_2, axis=2, keepdims=True)
+            else:
+                r, p = _pearson_last_axis(x, y)
+                r_block.append(r)
+                p_block.append(p)
+        if pool_folds:
+            r, p = _pearson_last_axis(x_pooled, y_pooled)
+            r_block.append(r)
+            p_block.append(p)
+        return r_block, p_block
+
+    r_splits, p_splits = [], []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for bootstrap_folds in folds:
+
+            # Whiten every time bin once per training set
+            splits = []
+            for fold in np.unique(bootstrap_folds):
+                test_index = np.where(bootstrap_folds == fold)[0]
+                train_index = np.where(bootstrap_folds != fold)[0]
+                if train_index.size == 0:
+                    train_index = test_index  # no cross-validation
+                splits.append((train_index, test_index, _whiten_time_bins(act_1, train_index),
+                               _whiten_time_bins(act_2, train_index)))
+
+            # Divide the rows over threads
+            blocks = list(executor.map(lambda rows: correlate_block(rows, splits), row_blocks))
+            for k in range(len(blocks[0][0])):
+                r_splits.append(np.concatenate([block[0][k] for block in blocks]).astype(np.float32))
+                p_splits.append(np.concatenate([block[1][k] for block in blocks]).astype(np.float32))
+    r_splits, p_splits = np.array(r_splits), np.array(p_splits)
+
+    return np.median(r_splits, axis=0), np.median(p_splits, axis=0), r_splits
 
 
 def peri_multiple_events_time_histogram(
@@ -1394,5 +3577,3 @@ def peri_multiple_events_time_histogram(
     ax.spines['right'].set_visible(False)
     ax.set_xlabel('Time (s) after event')
     return ax
-
-
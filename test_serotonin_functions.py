@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the spike counting functions in serotonin_functions, run with pytest from the root of
+the repository.
+"""
+
+import numpy as np
+from serotonin_functions import calculate_peths, count_spikes_in_windows
+
+SPIKE_TIMES = np.sort(np.random.default_rng(0).uniform(0, 100, 5000))
+SPIKE_CLUSTERS = np.random.default_rng(1).integers(0, 5, 5000)
+ALIGN_TIMES = np.arange(5, 95, 3.)
+
+
+def test_calculate_peths_empty_clusters():
+    for smoothing in (0, 0.025):
+        peths, binned_spikes = calculate_peths(
+            SPIKE_TIMES, SPIKE_CLUSTERS, np.array([], dtype=int), ALIGN_TIMES,
+            smoothing=smoothing)
+        _, binned_all = calculate_peths(SPIKE_TIMES, SPIKE_CLUSTERS, np.arange(5), ALIGN_TIMES,
+                                        smoothing=smoothing)
+        assert binned_spikes.shape == (ALIGN_TIMES.size, 0, binned_all.shape[2])
+        assert peths['means'].shape == peths['stds'].shape == (0, binned_all.shape[2])
+        assert peths['tscale'].size == binned_all.shape[2]
+        assert peths['cscale'].size == 0
+
+
+def test_count_spikes_in_windows_empty_clusters():
+    counts, cluster_ids = count_spikes_in_windows(SPIKE_TIMES, SPIKE_CLUSTERS, ALIGN_TIMES,
+                                                  ALIGN_TIMES + 1,
+                                                  cluster_ids=np.array([], dtype=int))
+    assert counts.shape == (ALIGN_TIMES.size, 0)
+    assert cluster_ids.size == 0